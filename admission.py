@@ -0,0 +1,87 @@
+import time
+import asyncio
+import logging
+import contextlib
+from config import conf
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class QueueFull(Exception):
+    """Raised when a request is shed because the user's or the global queue is full."""
+
+class Admission:
+    """Admission control in front of the model calls.
+
+    Turns of one session run one at a time in arrival order (asyncio.Lock is
+    FIFO), so a user spamming messages can't interleave writes to the same
+    chat history. Running calls are capped per model with a semaphore. Both
+    the per-session and the global queue are bounded; past that, admit()
+    raises QueueFull instead of queueing.
+    """
+
+    def __init__(self, model_limits=None, default_limit=16, max_session_queue=3, max_queue=200):
+        self.model_limits = model_limits or {}
+        self.default_limit = default_limit
+        self.max_session_queue = max_session_queue
+        self.max_queue = max_queue
+        self._sessions = {}    # session key -> [lock, requests queued or running]
+        self._semaphores = {}  # model -> semaphore
+        self._running = {}     # model -> running calls
+        self.waiting = 0
+        self.metrics = {"admitted": 0, "rejected": 0, "wait_time_total": 0.0, "wait_time_max": 0.0}
+
+    def _semaphore(self, model):
+        if model not in self._semaphores:
+            self._semaphores[model] = asyncio.Semaphore(self.model_limits.get(model, self.default_limit))
+            self._running[model] = 0
+        return self._semaphores[model]
+
+    @contextlib.asynccontextmanager
+    async def admit(self, session, model):
+        entry = self._sessions.get(session)
+        if (entry and entry[1] >= self.max_session_queue) or self.waiting >= self.max_queue:
+            self.metrics["rejected"] += 1
+            raise QueueFull(session)
+        if entry is None:
+            entry = self._sessions[session] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        self.waiting += 1
+        started = time.monotonic()
+        queued = True
+        try:
+            async with entry[0]:
+                async with self._semaphore(model):
+                    queued = False
+                    self.waiting -= 1
+                    waited = time.monotonic() - started
+                    self.metrics["admitted"] += 1
+                    self.metrics["wait_time_total"] += waited
+                    self.metrics["wait_time_max"] = max(self.metrics["wait_time_max"], waited)
+                    self._running[model] += 1
+                    try:
+                        yield waited
+                    finally:
+                        self._running[model] -= 1
+        finally:
+            if queued:
+                self.waiting -= 1
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._sessions[session]
+
+    def stats(self):
+        m = dict(self.metrics)
+        m["queue_depth"] = self.waiting
+        m["sessions"] = len(self._sessions)
+        m["running"] = dict(self._running)
+        return m
+
+admission = Admission(
+    model_limits=conf["model_concurrency"],
+    default_limit=conf["default_model_concurrency"],
+    max_session_queue=conf["session_queue_depth"],
+    max_queue=conf["admission_queue_depth"],
+)
+
+metrics.stats_gauge("bot_admission", "Admission queue state and totals", admission.stats)
@@ -0,0 +1,57 @@
+import asyncio
+import logging
+from config import conf
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class _Group:
+    def __init__(self, message):
+        self.messages = [message]
+        self.arrived = asyncio.Event()
+
+class AlbumCollector:
+    """Gathers the messages of a Telegram media group (album).
+
+    Telegram delivers every photo of an album as its own message with the same
+    media_group_id, and only one of them carries the caption. The first message
+    of a group to arrive waits until no further one has come for `window`
+    seconds (or max_items are in) and gets the whole album back; the handlers
+    of the other messages get None and return, so an album becomes one request.
+    """
+
+    def __init__(self, window=1.0, max_items=10):
+        self.window = window
+        self.max_items = max_items
+        self._groups = {}  # (chat id, media_group_id) -> _Group
+        self.metrics = {"albums": 0, "photos": 0, "largest": 0}
+
+    async def collect(self, message):
+        """All messages of message's album in order for the first one to arrive, None for the rest."""
+        key = (message.chat.id, message.media_group_id)
+        group = self._groups.get(key)
+        if group is not None:
+            group.messages.append(message)
+            group.arrived.set()
+            return None
+        group = self._groups[key] = _Group(message)
+        try:
+            while len(group.messages) < self.max_items:
+                group.arrived.clear()
+                try:
+                    await asyncio.wait_for(group.arrived.wait(), self.window)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            del self._groups[key]
+        self.metrics["albums"] += 1
+        self.metrics["photos"] += len(group.messages)
+        self.metrics["largest"] = max(self.metrics["largest"], len(group.messages))
+        return sorted(group.messages, key=lambda m: m.message_id)
+
+    def stats(self):
+        return dict(self.metrics, collecting=len(self._groups))
+
+collector = AlbumCollector(window=conf["album_window"], max_items=conf["album_max_photos"])
+
+metrics.stats_gauge("albums", "Media groups collected into single requests", collector.stats)
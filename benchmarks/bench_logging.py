@@ -0,0 +1,104 @@
+"""Event-loop lag while logging heavily to a slow sink.
+
+Simulates an error burst: concurrent fake requests each log a few info
+lines, a share of them log an exception with traceback, and many log the
+"message is not modified" warning Telegram returns for no-op edits. The sink
+blocks for --write-delay per write, like stdout piped into a busy log
+collector. Runs the workload with a plain StreamHandler on the root logger
+(what logging.basicConfig sets up) and with logs.setup()'s queue and writer
+thread, and prints loop lag percentiles and what reached the sink.
+
+    python benchmarks/bench_logging.py [--requests 2000] [--write-delay 0.002]
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import logs
+from loadtest import LoopLag, percentile
+
+class SlowStream:
+    """A text stream whose writes block, counting the lines that got through."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.lines = 0
+
+    def write(self, text):
+        time.sleep(self.delay)
+        self.lines += text.count("\n")
+
+    def flush(self):
+        pass
+
+async def workload(args, rng):
+    logger = logging.getLogger("bench")
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def request(i):
+        async with semaphore:
+            logs.bind(request_id=f"bench-{i}", user=str(100000 + i % 500), model="fake-model")
+            logger.info(f"Handling request {i}")
+            await asyncio.sleep(rng.uniform(0, 0.01))
+            for chunk in range(args.edits):
+                if rng.random() < args.not_modified:
+                    logger.warning(f"Error updating message {i}/{chunk}: A request to the Telegram API was unsuccessful. "
+                                   "Error code: 400. Description: Bad Request: message is not modified")
+                await asyncio.sleep(0)
+            if rng.random() < args.error_rate:
+                try:
+                    raise RuntimeError(f"model call {i} failed")
+                except RuntimeError:
+                    logger.exception("Streaming answer failed")
+            logger.info(f"Request {i} done")
+
+    await asyncio.gather(*(request(i) for i in range(args.requests)))
+
+async def run(args, mode):
+    sink = SlowStream(args.write_delay)
+    if mode == "sync":
+        logs.stop()
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        handler = logging.StreamHandler(sink)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        root.addHandler(handler)
+        root.setLevel(logging.INFO)
+    else:
+        logs.setup(level="INFO", fmt="json", stream=sink)
+    lag = LoopLag(interval=0.01)
+    lag.start()
+    started = time.perf_counter()
+    await workload(args, random.Random(args.seed))
+    elapsed = time.perf_counter() - started
+    lag.stop()
+    stats = logs.stats() if mode == "queue" else {}
+    logs.stop()  # drains the queue
+    print(f"{mode:<6} loop lag p50 {percentile(lag.samples, 50) * 1000:7.1f}ms  p99 {percentile(lag.samples, 99) * 1000:7.1f}ms  "
+          f"max {max(lag.samples, default=0.0) * 1000:7.1f}ms  workload {elapsed:.2f}s  lines written {sink.lines}  "
+          f"suppressed {stats.get('suppressed', 0)}  dropped {stats.get('dropped', 0)}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--edits", type=int, default=5, help="stream edits per request")
+    parser.add_argument("--not-modified", type=float, default=0.3, help="chance an edit logs 'message is not modified'")
+    parser.add_argument("--error-rate", type=float, default=0.2, help="share of requests logging an exception")
+    parser.add_argument("--write-delay", type=float, default=0.002, help="seconds each write to the sink blocks")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    for mode in ("sync", "queue"):
+        asyncio.run(run(args, mode))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Micro-benchmark: escaping cost of streaming a long response.
+
+Compares re-escaping the whole response on every update (the old
+gemini_stream behaviour) with renderer.StreamRenderer.
+
+    python benchmarks/bench_renderer.py [--chars 50000] [--chunk 60] [--every 5]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from md2tgmd import escape
+from renderer import StreamRenderer
+
+PARAGRAPHS = [
+    "## Section {n}\n",
+    "Some text with *emphasis*, numbers like 3.14 and (parentheses) - plus a dash {n}!",
+    "- first item\n- second item {n}\n- third item",
+    "1. step one\n2. step two {n}",
+    "```python\ndef f_{n}(x):\n    return x * 2  # comment\n```",
+    "> a quoted line {n}",
+    "**bold {n}** and _italic_ with `inline_code()`",
+]
+
+def make_response(chars, seed=0):
+    rng = random.Random(seed)
+    parts, size, n = [], 0, 0
+    while size < chars:
+        p = rng.choice(PARAGRAPHS).format(n=n)
+        parts.append(p)
+        size += len(p) + 2
+        n += 1
+    return "\n\n".join(parts)[:chars]
+
+def chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+def run_naive(pieces, every):
+    full, escaped_chars = "", 0
+    start = time.perf_counter()
+    for i, piece in enumerate(pieces):
+        full += piece
+        if i % every == 0:
+            escaped_chars += len(escape(full))
+    escaped_chars += len(escape(full))
+    return time.perf_counter() - start, escaped_chars
+
+def run_incremental(pieces, every):
+    renderer, escaped_chars = StreamRenderer(), 0
+    start = time.perf_counter()
+    for i, piece in enumerate(pieces):
+        renderer.feed(piece)
+        if i % every == 0:
+            escaped_chars += len(renderer.render()[0])
+    # Like StreamReply: the pages feed() closed, then the final render of the current message
+    pages = renderer.pages + [renderer.render()]
+    return time.perf_counter() - start, sum(len(e) for e, _ in pages), len(pages)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chars", type=int, default=50000)
+    parser.add_argument("--chunk", type=int, default=60, help="characters per streamed chunk")
+    parser.add_argument("--every", type=int, default=5, help="render every N chunks")
+    args = parser.parse_args()
+
+    pieces = chunks(make_response(args.chars), args.chunk)
+    naive_s, _ = run_naive(pieces, args.every)
+    inc_s, inc_chars, pages = run_incremental(pieces, args.every)
+    print(f"response: {args.chars} chars in {len(pieces)} chunks, render every {args.every}")
+    print(f"full re-escape: {naive_s * 1000:9.1f} ms (single message, over the 4096 limit)")
+    print(f"incremental:    {inc_s * 1000:9.1f} ms ({pages} messages, {inc_chars} escaped chars)")
+    print(f"speedup:        {naive_s / inc_s:9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Exercises router.Router against stub providers.
+
+Three phases over the same router: a healthy primary with a slower fallback,
+an outage of the primary (every request fails before its first token), and
+recovery. Then a primary with a slow tail (a few requests take seconds to
+their first token), without and with hedging. Prints per-phase TTFT
+percentiles, which backend answered and how many requests failed over or
+failed outright.
+
+    python benchmarks/bench_router.py [--requests 300] [--concurrency 20]
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from providers import StubProvider
+from router import Router
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))] if values else 0.0
+
+async def phase(router, name, requests, concurrency, choice="primary"):
+    semaphore = asyncio.Semaphore(concurrency)
+    ttfts, answered, failed = [], {}, 0
+
+    async def one():
+        nonlocal failed
+        async with semaphore:
+            turn = SimpleNamespace(history=[], chat=None, backend=None)
+            started = time.perf_counter()
+            first = None
+            try:
+                async for _ in router.stream(choice, turn, "hello"):
+                    if first is None:
+                        first = time.perf_counter() - started
+            except Exception:
+                failed += 1
+                return
+            ttfts.append(first)
+            answered[turn.backend.name] = answered.get(turn.backend.name, 0) + 1
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+    print(f"{name:<10} ttft p50 {percentile(ttfts, 50) * 1000:7.1f}ms  p99 {percentile(ttfts, 99) * 1000:7.1f}ms  "
+          f"answered {answered}  failed {failed}")
+
+async def main(args):
+    primary = StubProvider("primary", first_token=0.05, seed=1)
+    fallback = StubProvider("fallback", first_token=0.15, seed=2)
+    router = Router(
+        {"primary": (primary, "model-a"), "fallback": (fallback, "model-b")},
+        routes={"primary": ["fallback"]},
+        cooldown=args.cooldown,
+    )
+    await phase(router, "healthy", args.requests, args.concurrency)
+    primary.error_rate = 1.0
+    await phase(router, "outage", args.requests, args.concurrency)
+    primary.error_rate = 0.0
+    await asyncio.sleep(args.cooldown)
+    await phase(router, "recovered", args.requests, args.concurrency)
+    for name, stats in router.stats().items():
+        print(name, stats)
+
+    for hedge in (False, True):
+        tail = StubProvider("tail", first_token=0.05, slow_rate=0.05, slow_first_token=1.0, seed=3)
+        router = Router({"tail": (tail, "model-a")}, hedge=hedge, hedge_default_delay=0.2, hedge_max_rate=0.2)
+        await phase(router, "hedged" if hedge else "unhedged", args.requests, args.concurrency, "tail")
+        if hedge:
+            print(router.hedge_stats())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--cooldown", type=float, default=1.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,121 @@
+"""Measures how long a fresh bot process takes until it is polling for updates.
+
+Each run starts `main.py` in a new interpreter against benchmarks.fakes
+(Telegram with optional per-call latency, an in-memory Postgres with optional
+connect latency) and stops it as soon as its first getUpdates reaches the
+fake Telegram. Reports the time spent importing main, the time to that first
+poll and the Bot API calls made on the way. The stored bot_state survives
+between runs like the real table would, so the first run registers the
+commands and the following ones show the restart path.
+
+    python benchmarks/bench_startup.py [--runs 5] [--telegram-latency 0.1] [--db-latency 0.2]
+    python benchmarks/bench_startup.py --tree /path/to/other/checkout   # compare another revision
+"""
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+def child(args):
+    """Runs inside the measured process."""
+    started = time.perf_counter()
+    sys.path[:0] = [args.tree, HERE]
+    os.chdir(args.tree)
+    for name, value in (("DATABASE_URL", "postgresql://fake"), ("GEMINI_API_KEYS", "fake-key"), ("BOT_TOKEN", "1:fake")):
+        os.environ.setdefault(name, value)
+    import main
+    imported = time.perf_counter() - started
+
+    from telebot import asyncio_helper
+    import db
+    from fakes import FakeStore, FakeConnection
+
+    asyncio_helper.API_URL = args.telegram + "/bot{0}/{1}"
+    main.conf["metrics_port"] = None
+
+    class PersistentStore(FakeStore):
+        def execute(self, sql, query_args):
+            super().execute(sql, query_args)
+            if "bot_state_set" in sql:
+                with open(args.state, "w") as f:
+                    json.dump(self.state, f)
+
+    with open(args.state) as f:
+        store = PersistentStore(state=json.load(f))
+
+    def connect(dsn):
+        time.sleep(args.db_latency)
+        return FakeConnection(store)
+
+    init_pool = db.init_pool
+    db.init_pool = lambda connect_=None: init_pool(connect=connect)
+    print(json.dumps({"import": imported}), flush=True)
+    asyncio.run(main.main())
+
+async def run_once(args, telegram, url, state):
+    telegram.calls.clear()
+    telegram.first_call.clear()
+    started = time.monotonic()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), "--child", "--telegram", url, "--state", state,
+        "--tree", args.tree, "--db-latency", str(args.db_latency),
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+    )
+    deadline = started + 60
+    while "getUpdates" not in telegram.first_call:
+        if process.returncode is not None or time.monotonic() > deadline:
+            raise RuntimeError("bot process never started polling")
+        await asyncio.sleep(0.005)
+    ready = telegram.first_call["getUpdates"] - started
+    calls = {m: n for m, n in telegram.calls.items() if m != "getUpdates"}
+    process.send_signal(signal.SIGKILL)
+    out, _ = await process.communicate()
+    imported = json.loads(out.decode().splitlines()[0])["import"]
+    return {"import": imported, "ready": ready, "calls": calls}
+
+async def main(args):
+    from fakes import FakeTelegram
+    telegram = FakeTelegram(latency=args.telegram_latency, poll_timeout=1.0)
+    url = await telegram.start()
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump({}, f)
+        state = f.name
+    results = []
+    try:
+        for i in range(args.runs):
+            result = await run_once(args, telegram, url, state)
+            results.append(result)
+            label = "first boot" if i == 0 else "restart"
+            print(f"run {i + 1} ({label:<10})  import {result['import'] * 1000:7.1f}ms  "
+                  f"ready {result['ready'] * 1000:7.1f}ms  calls {result['calls']}")
+    finally:
+        await telegram.stop()
+        os.unlink(state)
+    restarts = results[1:] or results
+    print(f"restart median: import {statistics.median(r['import'] for r in restarts) * 1000:.1f}ms  "
+          f"ready {statistics.median(r['ready'] for r in restarts) * 1000:.1f}ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--telegram-latency", type=float, default=0.1, help="seconds per Bot API call")
+    parser.add_argument("--db-latency", type=float, default=0.2, help="seconds per database connect")
+    parser.add_argument("--tree", default=ROOT, help="checkout to start main.py from")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--telegram", help=argparse.SUPPRESS)
+    parser.add_argument("--state", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.tree = os.path.abspath(args.tree)
+    if args.child:
+        child(args)
+    else:
+        sys.path.insert(0, HERE)
+        asyncio.run(main(args))
@@ -0,0 +1,263 @@
+"""Local stand-ins for the services the bot talks to, used by the load test.
+
+FakeTelegram and FakeGemini are small aiohttp apps that speak just enough of
+the Bot API and the Gemini REST API for the real handlers to run unchanged;
+FakeConnection replaces psycopg2 behind db.Pool.
+"""
+import io
+import json
+import time
+import random
+import asyncio
+import base64
+from collections import Counter
+from aiohttp import web
+
+def _png(side=64, seed=0):
+    """A small valid PNG, generated once per size so image paths do real decoding work."""
+    from PIL import Image
+    rng = random.Random(seed)
+    image = Image.new("RGB", (side, side), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    buf = io.BytesIO()
+    image.save(buf, format="PNG")
+    return buf.getvalue()
+
+class FakeTelegram:
+    """Bot API on /bot{token}/{method} plus file downloads on /file/bot{token}/{path}."""
+
+    def __init__(self, latency=0.0, photo_side=512, poll_timeout=0.5):
+        self.latency = latency
+        self.poll_timeout = poll_timeout
+        self.photo = _png(photo_side, seed=1)
+        self.calls = Counter()
+        self.first_call = {}  # method -> monotonic time of its first call
+        self._message_id = 0
+        self._file_id = 0
+        self.app = web.Application(client_max_size=32 * 1024 * 1024)
+        self.app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        self.app.router.add_get("/file/bot{token}/{path:.*}", self.file)
+        self.runner = None
+        self.port = None
+
+    async def start(self, host="127.0.0.1"):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{self.port}"
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    def _message(self, chat_id, text=None, photo=False):
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private" if int(chat_id) > 0 else "group"},
+            "from": {"id": 1, "is_bot": True, "first_name": "bot"},
+        }
+        if text is not None:
+            message["text"] = text
+        if photo:
+            self._file_id += 1
+            message["photo"] = [{"file_id": f"sent-{self._file_id}", "file_unique_id": f"sent-u-{self._file_id}",
+                                 "width": 512, "height": 512, "file_size": 1024}]
+        return message
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        self.first_call.setdefault(method, time.monotonic())
+        params = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = params.get("chat_id", 0)
+        if method == "sendMessage":
+            result = self._message(chat_id, params.get("text", ""))
+        elif method == "editMessageText":
+            result = self._message(chat_id, params.get("text", ""))
+        elif method == "sendPhoto":
+            result = self._message(chat_id, photo=True)
+        elif method == "getFile":
+            file_id = params.get("file_id", "")
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.photo), "file_path": f"photos/{file_id}.png"}
+        elif method == "getUpdates":
+            # An idle long poll
+            await asyncio.sleep(self.poll_timeout)
+            result = []
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bot", "username": "fake_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def file(self, request):
+        self.calls["download"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.Response(body=self.photo, content_type="image/png")
+
+class FakeGemini:
+    """generateContent and streamGenerateContent (SSE) for any model.
+
+    Streams first_chunk_latency, then chunks text pieces chunk_interval apart.
+    A fraction error_rate of requests fails with 429 RESOURCE_EXHAUSTED, and
+    requests asking for image output get an inline PNG back.
+    """
+
+    def __init__(self, first_chunk_latency=0.3, chunks=20, chunk_interval=0.05, chunk_chars=60,
+                 error_rate=0.0, image_side=256, seed=0):
+        self.first_chunk_latency = first_chunk_latency
+        self.chunks = chunks
+        self.chunk_interval = chunk_interval
+        self.chunk_chars = chunk_chars
+        self.error_rate = error_rate
+        self.image = base64.b64encode(_png(image_side, seed=2)).decode()
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.errors = 0
+        self.app = web.Application(client_max_size=32 * 1024 * 1024)
+        self.app.router.add_post("/{version}/models/{model_method}", self.handle)
+        self.runner = None
+
+    async def start(self, host="127.0.0.1"):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, 0)
+        await site.start()
+        return f"http://{host}:{site._server.sockets[0].getsockname()[1]}/"
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    def _text(self):
+        words = ["Lorem", "ipsum", "dolor", "sit", "amet,", "*consectetur*", "adipiscing", "elit.", "`code()`", "- item\n"]
+        out = []
+        while sum(len(w) + 1 for w in out) < self.chunk_chars:
+            out.append(self.rng.choice(words))
+        return " ".join(out) + " "
+
+    def _chunk(self, text=None, image=False, finish=False):
+        parts = []
+        if text:
+            parts.append({"text": text})
+        if image:
+            parts.append({"inlineData": {"mimeType": "image/png", "data": self.image}})
+        candidate = {"content": {"role": "model", "parts": parts}, "index": 0}
+        if finish:
+            candidate["finishReason"] = "STOP"
+        return {"candidates": [candidate], "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": 5, "totalTokenCount": 15}}
+
+    async def handle(self, request):
+        model, _, method = request.match_info["model_method"].partition(":")
+        self.calls[f"{model}:{method}"] += 1
+        body = await request.json()
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response(
+                {"error": {"code": 429, "message": "Resource has been exhausted (fake).", "status": "RESOURCE_EXHAUSTED"}},
+                status=429,
+            )
+        modalities = (body.get("generationConfig") or {}).get("responseModalities") or []
+        wants_image = any(m.upper() == "IMAGE" for m in modalities)
+        await asyncio.sleep(self.first_chunk_latency)
+        if method == "generateContent":
+            text = "".join(self._text() for _ in range(self.chunks))
+            return web.json_response(self._chunk(text, image=wants_image, finish=True))
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i in range(self.chunks):
+            if i:
+                await asyncio.sleep(self.chunk_interval)
+            last = i == self.chunks - 1
+            chunk = self._chunk(self._text(), image=wants_image and last, finish=last)
+            await response.write(f"data: {json.dumps(chunk)}\r\n\r\n".encode())
+        await response.write_eof()
+        return response
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self.rowcount = 0
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, args=None):
+        self.conn.store.execute(sql, args or ())
+        statement = sql.strip().split(None, 2)
+        self.description = None
+        self._rows = []
+        if statement[0].upper() == "EXECUTE" and statement[1] == "history_load":
+            self._rows = self.conn.store.load(*args)
+            self.description = [("content",)]
+        elif statement[0].upper() == "EXECUTE" and statement[1] == "bot_state_get":
+            self._rows = [(self.conn.store.state[args[0]],)] if args[0] in self.conn.store.state else []
+            self.description = [("value",)]
+        elif statement[0].upper() == "SELECT":
+            self._rows = [(1,)]
+            self.description = [("?column?",)]
+        self.rowcount = len(self._rows)
+
+    def executemany(self, sql, rows):
+        for args in rows:
+            self.execute(sql, args)
+
+    def fetchall(self):
+        return self._rows
+
+class FakeStore:
+    """Keeps chat_history rows and bot_state in memory and understands the few statements they issue."""
+
+    def __init__(self, latency=0.0, state=None):
+        self.latency = latency
+        self.rows = []  # (user_id, kind, content)
+        self.state = state if state is not None else {}  # bot_state key -> value
+        self.statements = Counter()
+
+    def execute(self, sql, args):
+        if self.latency:
+            time.sleep(self.latency)
+        words = sql.strip().split(None, 2)
+        verb = words[0].upper()
+        self.statements[verb] += 1
+        if verb == "INSERT" and "chat_history" in sql:
+            for i in range(0, len(args), 3):
+                self.rows.append((args[i], args[i + 1], json.loads(args[i + 2])))
+        elif verb == "EXECUTE" and words[1] == "history_clear":
+            self.rows = [row for row in self.rows if row[0] != args[0]]
+        elif verb == "EXECUTE" and words[1] == "bot_state_set":
+            self.state[args[0]] = args[1]
+
+    def load(self, user_id, kind, limit=None):
+        rows = [(content,) for u, k, content in self.rows if u == user_id and k == kind]
+        return rows[-limit:] if limit else rows
+
+class FakeConnection:
+    """Just enough of a psycopg2 connection for db.Pool."""
+
+    def __init__(self, store):
+        self.store = store
+        self.autocommit = False
+        self.closed = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
@@ -0,0 +1,339 @@
+"""Offline load test: the real handlers against fake Telegram, Gemini and Postgres.
+
+Registers main.py's handlers on an AsyncTeleBot whose Bot API and file URLs
+point at benchmarks.fakes.FakeTelegram, points the Gemini client at
+FakeGemini and backs db.py with an in-memory connection. Synthetic users then
+send /gemini, private text, /draw, photo edits, albums and /clear through
+bot.process_new_updates, each waiting for its reply before thinking and
+sending the next message.
+
+    python benchmarks/loadtest.py --users 2000 --messages 3 --save results.json
+    python benchmarks/loadtest.py --users 2000 --messages 3 --baseline results.json
+
+Reports per-command p50/p95/p99 latency, messages/s, event-loop lag, RSS
+growth, Telegram calls by method, Gemini 429s and shed requests. With
+--baseline, prints the relative change of every headline number.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import importlib
+import argparse
+import tempfile
+import statistics
+import contextvars
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = ("gemini", "private", "draw", "edit", "clear", "album")
+
+# Set per message by the driver so handler exceptions can be attributed to their command
+failed_var = contextvars.ContextVar("failed")
+
+class CountingExceptionHandler:
+    """Marks the current message as failed instead of letting telebot only log the exception."""
+
+    def handle(self, exception):
+        failed_var.get()[0] = True
+        logging.getLogger("loadtest").debug(f"Handler raised {exception!r}")
+        return True
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=3, help="messages per user")
+    parser.add_argument("--ramp", type=float, default=10.0, help="seconds over which users start")
+    parser.add_argument("--think", type=float, default=1.0, help="mean think time between a user's messages (seconds)")
+    parser.add_argument("--mix", default="gemini=4,private=4,draw=1,edit=1,clear=1", help="relative command weights")
+    parser.add_argument("--album-size", type=int, default=4, help="photos per album for the album command")
+    parser.add_argument("--first-chunk", type=float, default=0.3, help="fake Gemini time to first chunk (seconds)")
+    parser.add_argument("--chunks", type=int, default=20, help="fake Gemini chunks per stream")
+    parser.add_argument("--chunk-interval", type=float, default=0.05, help="fake Gemini seconds between chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of Gemini requests answered with 429")
+    parser.add_argument("--image-side", type=int, default=256, help="side of the PNGs the fake Gemini returns")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="fake Bot API latency (seconds)")
+    parser.add_argument("--telegram-rate", type=float, default=None, help="override telegram_global_rate")
+    parser.add_argument("--keys", type=int, default=4, help="fake Gemini API keys")
+    parser.add_argument("--key-rpm", type=int, default=100000, help="per-key requests per minute budget")
+    parser.add_argument("--database-url", default=None, help="use a real Postgres instead of the in-memory fake")
+    parser.add_argument("--prompt-pool", type=int, default=None, help="draw prompts from this many distinct ones (repeats hit the response cache)")
+    parser.add_argument("--response-cache", action="store_true", help="enable the response cache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against results saved with --save")
+    return parser.parse_args()
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+class LoopLag:
+    """Samples how late a periodic sleep wakes up."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+def make_update(update_id, user_id, command, rng, prompt_pool=None):
+    from telebot import types
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+    }
+    pool = prompt_pool or 10 ** 6
+    prompt = f"question {rng.randrange(pool)} about something"
+    if command == "gemini":
+        message["text"] = f"/gemini {prompt}"
+    elif command == "private":
+        message["text"] = prompt
+    elif command == "draw":
+        message["text"] = f"/draw a cat number {rng.randrange(pool)}"
+    elif command == "clear":
+        message["text"] = "/clear"
+    elif command == "edit":
+        message["caption"] = "/edit make it blue"
+        message["photo"] = [
+            {"file_id": f"in-{user_id}-{update_id}-s", "file_unique_id": f"u-{user_id}-{update_id}-s", "width": 90, "height": 90},
+            {"file_id": f"in-{user_id}-{update_id}", "file_unique_id": f"u-{user_id}-{update_id}", "width": 512, "height": 512},
+        ]
+    return types.Update.de_json({"update_id": update_id, "message": message})
+
+def make_album(next_update, user_id, size, rng):
+    """The updates of one album: size photos sharing a media_group_id, the first with the caption."""
+    updates = [make_update(next(next_update), user_id, "edit", rng) for _ in range(size)]
+    for update in updates:
+        update.message.media_group_id = f"album-{updates[0].update_id}"
+    for update in updates[1:]:
+        update.message.caption = None
+    return updates
+
+async def run(args):
+    mix = {}
+    for item in args.mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in COMMANDS:
+            raise SystemExit(f"unknown command in --mix: {name}")
+        mix[name] = float(weight or 1)
+
+    from fakes import FakeTelegram, FakeGemini, FakeStore, FakeConnection
+    telegram = FakeTelegram(latency=args.telegram_latency)
+    fake_gemini = FakeGemini(
+        first_chunk_latency=args.first_chunk,
+        chunks=args.chunks,
+        chunk_interval=args.chunk_interval,
+        error_rate=args.error_rate,
+        image_side=args.image_side,
+        seed=args.seed,
+    )
+    telegram_url = await telegram.start()
+    gemini_url = await fake_gemini.start()
+
+    # Configuration has to be in place before gemini.py builds its key pool
+    from config import conf
+    conf["gemini_base_url"] = gemini_url
+    conf["gemini_key_rpm"] = args.key_rpm
+    conf["metrics_port"] = None
+    conf["file_cache_dir"] = tempfile.mkdtemp(prefix="gemini-bot-loadtest-")
+    if args.telegram_rate:
+        conf["telegram_global_rate"] = args.telegram_rate
+    conf["response_cache"] = args.response_cache
+
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+    asyncio_helper.API_URL = telegram_url + "/bot{0}/{1}"
+    asyncio_helper.FILE_URL = telegram_url + "/file/bot{0}/{1}"
+
+    import db
+    import main
+    import history
+    import metrics
+    from admission import admission
+    from gemini import key_pool
+    from response_cache import cache as response_cache
+    from edit_scheduler import scheduler as edit_scheduler
+
+    store = FakeStore()
+    connect = (lambda dsn: FakeConnection(store)) if not args.database_url else db.psycopg2.connect
+    if not await db.init_pool(connect=connect):
+        raise SystemExit("database pool failed to start")
+    await history.store.start()
+    metrics.instrument_telegram()
+
+    bot = AsyncTeleBot(os.environ["BOT_TOKEN"], exception_handler=CountingExceptionHandler())
+    main.register_handlers(bot)
+    # The bot imports these in the background after startup; load them up front so they don't show up as loop lag
+    for name in main.WARM_IMPORTS:
+        importlib.import_module(name)
+
+    latencies = {command: [] for command in COMMANDS}
+    failures = {command: 0 for command in COMMANDS}
+    next_update = iter(range(1, 10 ** 9))
+    commands, weights = list(mix), list(mix.values())
+
+    async def user(user_id):
+        user_rng = random.Random(args.seed * 1000003 + user_id)
+        await asyncio.sleep(user_rng.uniform(0, args.ramp))
+        for _ in range(args.messages):
+            command = user_rng.choices(commands, weights)[0]
+            if command == "album":
+                updates = make_album(next_update, user_id, args.album_size, user_rng)
+            else:
+                updates = [make_update(next(next_update), user_id, command, user_rng, args.prompt_pool)]
+            failed = [False]
+            failed_var.set(failed)
+            started = time.perf_counter()
+            try:
+                await bot.process_new_updates(updates)
+            except Exception:
+                failed[0] = True
+            if failed[0]:
+                failures[command] += 1
+            latencies[command].append(time.perf_counter() - started)
+            await asyncio.sleep(user_rng.expovariate(1 / args.think) if args.think else 0)
+
+    lag = LoopLag()
+    rss_start = rss_mb()
+    lag.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(user(100000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    lag.stop()
+    await edit_scheduler.stop()
+    await history.store.stop()
+    rss_end = rss_mb()
+
+    sent = sum(len(v) for v in latencies.values())
+    results = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("save", "baseline")},
+        "elapsed": elapsed,
+        "messages": sent,
+        "messages_per_second": sent / elapsed if elapsed else 0.0,
+        "commands": {
+            command: {
+                "count": len(values),
+                "failures": failures[command],
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "mean": statistics.fmean(values) if values else 0.0,
+            }
+            for command, values in latencies.items() if values
+        },
+        "loop_lag": {
+            "p50": percentile(lag.samples, 50),
+            "p99": percentile(lag.samples, 99),
+            "max": max(lag.samples, default=0.0),
+        },
+        "rss_mb": {"start": rss_start, "end": rss_end, "growth": rss_end - rss_start},
+        "telegram_calls": dict(telegram.calls),
+        "gemini_calls": dict(fake_gemini.calls),
+        "gemini_429s": fake_gemini.errors,
+        "shed": admission.stats()["rejected"],
+        "edit_scheduler": edit_scheduler.stats(),
+        "key_pool": key_pool.stats(),
+        "response_cache": response_cache.stats(),
+        "db_statements": dict(store.statements),
+    }
+
+    await db.close_pool()
+    if asyncio_helper.session_manager.session:
+        await asyncio_helper.session_manager.session.close()
+    await telegram.stop()
+    await fake_gemini.stop()
+    return results
+
+def headline(results):
+    """Flat name -> (value, lower is better) view used for printing and baseline comparison."""
+    out = {"messages/s": (results["messages_per_second"], False)}
+    for command, stats in results["commands"].items():
+        for q in ("p50", "p95", "p99"):
+            out[f"{command} {q} (s)"] = (stats[q], True)
+    out["loop lag p99 (s)"] = (results["loop_lag"]["p99"], True)
+    out["loop lag max (s)"] = (results["loop_lag"]["max"], True)
+    out["rss growth (MB)"] = (results["rss_mb"]["growth"], True)
+    out["telegram calls"] = (sum(results["telegram_calls"].values()), True)
+    out["shed"] = (results["shed"], True)
+    return out
+
+def report(results, baseline=None):
+    current = headline(results)
+    previous = headline(baseline) if baseline else {}
+    print(f"{results['messages']} messages in {results['elapsed']:.1f}s")
+    if baseline and baseline["config"] != results["config"]:
+        changed = sorted(k for k in results["config"] if baseline["config"].get(k) != results["config"][k])
+        print(f"note: baseline ran with different settings ({', '.join(changed)})")
+    print(f"{'metric':<28}{'value':>12}" + (f"{'baseline':>12}{'change':>10}" if baseline else ""))
+    for name, (value, lower_is_better) in current.items():
+        line = f"{name:<28}{value:>12.4f}"
+        if name in previous:
+            old = previous[name][0]
+            if old:
+                change = (value - old) / old * 100
+                better = change < 0 if lower_is_better else change > 0
+                line += f"{old:>12.4f}{change:>+9.1f}%" + (" ✓" if better and abs(change) >= 5 else " ✗" if abs(change) >= 5 else "")
+            else:
+                line += f"{old:>12.4f}{'':>10}"
+        print(line)
+    print("failures:", {c: s["failures"] for c, s in results["commands"].items() if s["failures"]} or "none")
+    print("telegram calls:", results["telegram_calls"])
+    print("gemini calls:", results["gemini_calls"], "429s:", results["gemini_429s"])
+    cache = results.get("response_cache")
+    if cache and (cache["hits"] or cache["misses"]):
+        print(f"response cache: hit rate {cache['hit_rate']:.1%}, {cache['hits']} hits, "
+              f"{cache['saved_seconds']:.1f}s of generation saved")
+
+def main():
+    args = parse_args()
+    # gemini.py reads API keys from argv[2] when present, so hide our own arguments from it
+    sys.argv = [sys.argv[0]]
+    os.environ.setdefault("BOT_TOKEN", "123456:loadtest")
+    os.environ["GEMINI_API_KEYS"] = ",".join(f"fake-key-{i}" for i in range(args.keys))
+    os.environ["DATABASE_URL"] = args.database_url or "fake://loadtest"
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = asyncio.run(run(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import logging
+import db
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bot_state (
+    key         TEXT PRIMARY KEY,
+    value       TEXT NOT NULL,
+    updated_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+db.prepare("bot_state_get", "SELECT value FROM bot_state WHERE key = $1")
+db.prepare("bot_state_set", "INSERT INTO bot_state (key, value) VALUES ($1, $2) "
+                            "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = now()")
+
+_schema_ready = False
+
+async def _ensure_schema():
+    global _schema_ready
+    if not _schema_ready:
+        await db.execute(SCHEMA)
+        _schema_ready = True
+
+async def load(key):
+    """Small key/value state that should survive restarts, e.g. what was last registered with Telegram."""
+    await _ensure_schema()
+    rows = await db.execute_prepared("bot_state_get", key, fetch=True)
+    return rows[0][0] if rows else None
+
+async def save(key, value):
+    await _ensure_schema()
+    await db.execute_prepared("bot_state_set", key, value)
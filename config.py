@@ -1,4 +1,3 @@
-from google.genai import types
 conf = {
     "error_info":           "⚠️⚠️⚠️\nSomething went wrong !\nplease try to change your prompt or contact the admin !",
     "before_generate_info": "🤖Generating🤖",
@@ -6,32 +5,104 @@ conf = {
     "model_1":              "gemini-2.0-flash-exp",
     "model_2":              "gemini-1.5-pro-latest",
     "streaming_update_interval": 0.5,  # Streaming answer update interval (seconds)
+    "telegram_max_message_length": 4096,
+    "db_pool_min_size":     2,      # Connections opened at startup and kept warm
+    "db_pool_max_size":     10,
+    "db_acquire_timeout":   10.0,   # Seconds to wait for a free connection before failing
+    "db_health_check_after": 30.0,  # Ping connections idle longer than this (seconds) before reuse
+    "db_max_idle":          300.0,  # Close connections above min size idle longer than this (seconds)
+    "db_max_lifetime":      3600.0, # Recycle connections older than this (seconds)
+    "history_flush_interval": 2.0,  # Chat history write-behind flush interval (seconds)
+    "history_max_batch":    500,    # Max rows per history INSERT
+    "history_load_limit":   200,    # Newest history rows loaded when a session is rehydrated
+    "usage_flush_interval": 10.0,   # Per-user usage counters write-behind flush interval (seconds)
+    "usage_max_batch":      500,    # Max rows per usage upsert
+    "quota_daily_requests": None,   # Model calls per user per UTC day, None for no limit
+    "quota_daily_tokens":   None,   # Prompt + response tokens per user per UTC day
+    "quota_daily_images":   None,   # Images generated (/draw, /edit) per user per UTC day
+    "quota_info":           "🚫 You have reached your daily limit. Please try again tomorrow.",
+    "admin_id":             None,   # Telegram user id allowed to run /usage, None uses CONSTANTS.ADMIN_ID
+    "session_max_entries":  5000,   # Per session cache (chat, pro, draw)
+    "session_max_bytes":    256 * 1024 * 1024,  # History bytes (text + inline images) per session cache
+    "session_idle_ttl":     3600,   # Evict sessions idle longer than this (seconds)
+    "session_spill_on_evict": True, # Flush pending history to Postgres when a session is evicted
+    "context_max_tokens":   32000,  # Estimated history tokens sent with each turn; older exchanges are dropped
+    "context_min_turns":    2,      # Newest exchanges always kept, even over budget
+    "context_keep_images":  1,      # Exchanges whose inline images stay in history; older ones get a placeholder
+    "context_image_tokens": 258,    # Estimated tokens per inline image
+    "context_summary_model": None,  # Model folding dropped exchanges into a rolling summary, None to just drop them
+    "model_fallbacks":      {},     # Model choice -> other models (Gemini or CONSTANTS.MODEL_CONFIGS names) that may serve it
+    "router_window":        50,     # TTFT/outcome samples kept per backend
+    "router_error_threshold": 0.5,  # Error rate that takes a backend out of rotation
+    "router_cooldown":      30.0,   # Seconds an unhealthy backend is skipped before it is probed again
+    "router_fallback_penalty": 1.0, # Each step down a fallback list must be this much faster (relative TTFT) to win
+    "hedge_requests":       False,  # Send a second request when the first chunk is late, stream whichever answers first
+    "hedge_percentile":     90,     # Hedge once a turn waits longer than this percentile of the backend's TTFT
+    "hedge_min_delay":      0.5,    # Lower bound of the hedge deadline (seconds)
+    "hedge_default_delay":  5.0,    # Deadline until a backend has enough TTFT samples (seconds)
+    "hedge_max_rate":       0.1,    # Max fraction of recent turns that may be hedged
+    "hedge_model":          None,   # Model for hedge requests (e.g. model_2); None retries the same model on another key (if there is one)
+    "response_cache":       False,  # Answer repeated first-turn prompts (no history) from a cache of earlier answers
+    "response_cache_entries": 1000, # In-memory LRU size
+    "response_cache_ttl":   86400.0,  # Seconds a cached answer stays valid
+    "response_cache_persist": False,  # Also keep cached answers in Postgres (shared across restarts and workers)
+    "response_cache_max_chars": 20000,  # Longer answers aren't cached
+    "gemini_base_url":      None,   # Override the Gemini API endpoint (proxies, local fakes)
+    "gemini_key_rpm":       15,     # Per-key requests per minute budget
+    "gemini_key_tpm":       1000000,  # Per-key tokens per minute budget
+    "gemini_max_retries":   3,      # Retries on another key after 429/503
+    "gemini_retry_backoff": 1.0,    # Base of the jittered exponential backoff (seconds)
+    "telegram_global_rate": 30.0,   # Max Telegram edits per second across all chats
+    "telegram_chat_interval": 1.0,  # Min seconds between edits in one private chat
+    "telegram_group_interval": 3.0, # Min seconds between edits in one group chat
+    "telegram_max_edit_interval": 10.0,  # Upper bound for the load-adapted per-chat interval
+    "busy_info":            "⏳ Too many requests right now, please try again in a moment.",
+    "default_model_concurrency": 16,  # Max in-flight calls per model
+    "model_concurrency":    {"gemini-1.5-pro-latest": 4},  # Per-model overrides of the above
+    "session_queue_depth":  3,      # Max queued + running requests per user session
+    "admission_queue_depth": 200,   # Max requests waiting for a slot across all users
+    "ingress_mode":         "polling",  # "polling" or "webhook" (needs WEBHOOK_SECRET, optional WEBHOOK_URL)
+    "webhook_host":         "0.0.0.0",
+    "webhook_port":         8080,
+    "webhook_path":         "/telegram",
+    "webhook_queue_size":   1000,   # Updates buffered before answering Telegram with 503
+    "webhook_workers":      64,     # Updates processed concurrently
+    "shutdown_grace":       30.0,   # Seconds to drain in-flight updates on shutdown
+    "shard_workers":        0,      # >0: supervisor process forwarding updates to this many workers, hashed by user id
+    "shard_base_port":      8100,   # Worker i listens on 127.0.0.1:shard_base_port+i
+    "shard_health_interval": 5.0,   # Seconds between worker health checks
+    "shard_health_failures": 3,     # Failed checks in a row before a worker is restarted
+    "shard_retry_timeout":  30.0,   # Seconds to retry forwarding an update to a busy or restarting worker
+    "image_target_side":    1024,   # Download the smallest Telegram photo size at least this large
+    "image_max_side":       1024,   # Downscale images sent to the model to this longer side
+    "image_format":         "JPEG", # Re-encode format, "JPEG" or "WEBP"
+    "image_quality":        85,
+    "album_window":         1.0,    # Seconds to wait for more photos of an album before sending it as one request
+    "album_max_photos":     10,     # Telegram's album limit; a full album is sent right away
+    "image_workers":        2,      # Threads for image decode/resize/encode
+    "file_cache_dir":       "/tmp/gemini-bot-cache",
+    "file_cache_memory_bytes": 64 * 1024 * 1024,  # In-memory LRU for downloaded Telegram files
+    "file_cache_disk_bytes": 512 * 1024 * 1024,   # On-disk cap for downloaded Telegram files
+    "metrics_host":         "0.0.0.0",
+    "metrics_port":         9090,   # Prometheus /metrics endpoint, None to disable
+    "trace_requests":       False,  # Log a JSON timeline per request to the "trace" logger
+    "log_level":            "INFO",
+    "log_format":           "json", # "json" (one object per line with request context) or "text"
+    "log_queue_size":       10000,  # Records buffered for the writer thread; more are dropped, never waited on
+    "log_rate_window":      60.0,   # Seconds over which repeated warnings/errors are counted
+    "log_rate_burst":       5,      # Similar warnings/errors let through per window, the rest are counted and suppressed
 }
 
+# Plain dicts (accepted wherever genai takes a config), so importing config doesn't load google.genai
 safety_settings = [
-    types.SafetySetting(
-        category="HARM_CATEGORY_HARASSMENT",
-        threshold="BLOCK_NONE",
-    ),
-    types.SafetySetting(
-        category="HARM_CATEGORY_HATE_SPEECH",
-        threshold="BLOCK_NONE",
-    ),
-    types.SafetySetting(
-        category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-        threshold="BLOCK_NONE",
-    ),
-    types.SafetySetting(
-        category="HARM_CATEGORY_DANGEROUS_CONTENT",
-        threshold="BLOCK_NONE",
-    ),
-    types.SafetySetting(
-        category="HARM_CATEGORY_CIVIC_INTEGRITY",
-        threshold="BLOCK_NONE",
-    )
+    {"category": "HARM_CATEGORY_HARASSMENT",        "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH",       "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_CIVIC_INTEGRITY",   "threshold": "BLOCK_NONE"},
 ]
 
-generation_config = types.GenerateContentConfig(
-    response_modalities=['Text', 'Image'],
-    safety_settings=safety_settings,
-)
\ No newline at end of file
+generation_config = {
+    "response_modalities": ['Text', 'Image'],
+    "safety_settings": safety_settings,
+}
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import weakref
+from lazy import lazy_module
+from session_cache import SessionCache
+
+logger = logging.getLogger(__name__)
+
+types = lazy_module("google.genai.types")
+
+SUMMARY_PREFIX = "Summary of our earlier conversation:\n"
+SUMMARY_ACK = "Understood, I'll keep that in mind."
+IMAGE_PLACEHOLDER = "[image omitted]"
+
+def estimate_text_tokens(text):
+    return len(text) // 4 + 1
+
+def split_exchanges(history):
+    """Groups a history into exchanges: a user turn followed by its model turns."""
+    exchanges = []
+    for content in history:
+        if content.role == "user" or not exchanges:
+            exchanges.append([content])
+        else:
+            exchanges[-1].append(content)
+    return exchanges
+
+def transcript(contents):
+    lines = []
+    for content in contents:
+        text = " ".join(part.text for part in content.parts or () if part.text)
+        if text:
+            lines.append(f"{'User' if content.role == 'user' else 'Model'}: {text}")
+    return "\n".join(lines)
+
+class ContextWindow:
+    """Keeps the history sent with each turn under a token budget.
+
+    fit() runs once per turn on the session history: inline images older than
+    the last keep_images exchanges are replaced by a placeholder, then the
+    oldest exchanges are dropped until the rest fits max_tokens (the newest
+    min_turns are always kept). Token counts are estimates (chars / 4, a fixed
+    cost per image) cached per Content object, so a turn only counts what is new.
+
+    With a summarizer (async transcript -> text), dropped exchanges are folded
+    into a rolling summary in the background; it is prepended as an exchange on
+    the session's next turn, and later dropped and re-folded like any other.
+    """
+
+    def __init__(self, max_tokens=32000, min_turns=2, keep_images=1, image_tokens=258,
+                 summarizer=None, max_sessions=5000, idle_ttl=3600):
+        self.max_tokens = max_tokens
+        self.min_turns = min_turns
+        self.keep_images = keep_images
+        self.image_tokens = image_tokens
+        self.summarizer = summarizer
+        self._tokens = {}  # id(content) -> estimated tokens, dropped when the content is collected
+        self._summaries = SessionCache("summaries", max_entries=max_sessions, idle_ttl=idle_ttl)
+        self._backlog = SessionCache("summary_backlog", max_entries=max_sessions, idle_ttl=idle_ttl)
+        self._summarizing = set()
+        self.metrics = {
+            "turns": 0, "count_hits": 0, "count_misses": 0, "exchanges_dropped": 0, "tokens_dropped": 0,
+            "images_stripped": 0, "summaries": 0, "summary_errors": 0,
+        }
+
+    def tokens(self, content):
+        key = id(content)
+        count = self._tokens.get(key)
+        if count is not None:
+            self.metrics["count_hits"] += 1
+            return count
+        self.metrics["count_misses"] += 1
+        count = 0
+        for part in content.parts or ():
+            if part.text:
+                count += estimate_text_tokens(part.text)
+            if part.inline_data is not None:
+                count += self.image_tokens
+        self._tokens[key] = count
+        weakref.finalize(content, self._tokens.pop, key, None)
+        return count
+
+    def _strip_images(self, exchanges):
+        for exchange in exchanges[:max(0, len(exchanges) - self.keep_images)]:
+            for i, content in enumerate(exchange):
+                if not any(part.inline_data is not None for part in content.parts or ()):
+                    continue
+                parts = []
+                for part in content.parts:
+                    if part.inline_data is not None:
+                        self.metrics["images_stripped"] += 1
+                        part = types.Part.from_text(text=IMAGE_PLACEHOLDER)
+                    parts.append(part)
+                exchange[i] = types.Content(role=content.role, parts=parts)
+
+    def fit(self, session, history):
+        """Returns the history to send for session's next turn, within the token budget."""
+        self.metrics["turns"] += 1
+        exchanges = split_exchanges(history)
+        self._strip_images(exchanges)
+        sizes = [sum(self.tokens(c) for c in exchange) for exchange in exchanges]
+        total = sum(sizes)
+        dropped = []
+        while total > self.max_tokens and len(exchanges) > self.min_turns:
+            dropped.extend(exchanges.pop(0))
+            total -= sizes.pop(0)
+            self.metrics["exchanges_dropped"] += 1
+        if dropped:
+            self.metrics["tokens_dropped"] += sum(self.tokens(c) for c in dropped)
+            if self.summarizer:
+                self._backlog[session] = (self._backlog.get(session) or []) + dropped
+                self._start_summary(session)
+        summary = self._summaries.pop(session, None)
+        if summary:
+            exchanges.insert(0, [
+                types.UserContent(parts=[types.Part.from_text(text=SUMMARY_PREFIX + summary)]),
+                types.ModelContent(parts=[types.Part.from_text(text=SUMMARY_ACK)]),
+            ])
+        return [content for exchange in exchanges for content in exchange]
+
+    def _start_summary(self, session):
+        if session not in self._summarizing:
+            self._summarizing.add(session)
+            asyncio.create_task(self._summarize(session))
+
+    async def _summarize(self, session):
+        try:
+            while session in self._backlog:
+                contents = self._backlog.pop(session)
+                previous = self._summaries.pop(session, None)
+                text = transcript(contents)
+                if previous:
+                    text = f"{SUMMARY_PREFIX}{previous}\n{text}"
+                try:
+                    summary = await self.summarizer(text)
+                except Exception as e:
+                    self.metrics["summary_errors"] += 1
+                    logger.warning(f"Summarizing context of {session} failed: {e}")
+                    if previous:
+                        self._summaries[session] = previous
+                    return
+                self.metrics["summaries"] += 1
+                if summary:
+                    self._summaries[session] = summary.strip()
+        finally:
+            self._summarizing.discard(session)
+
+    def forget(self, session):
+        """Drops summary state of a session, e.g. on /clear."""
+        self._summaries.pop(session, None)
+        self._backlog.pop(session, None)
+
+    def stats(self):
+        m = dict(self.metrics)
+        m["cached_counts"] = len(self._tokens)
+        m["pending_summaries"] = len(self._summaries)
+        m["summarizing"] = len(self._summarizing)
+        return m
@@ -1,9 +1,14 @@
 import os
-import psycopg2
+import time
+import asyncio
+import collections
+import contextlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from config import conf
+import metrics
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Database constants - Using direct access as requested
@@ -16,47 +21,361 @@ except KeyError:
     # Optionally raise it again to ensure the app stops if this module is imported
     raise ValueError("DATABASE_URL is mandatory and was not found in environment variables.")
 
-# Create database connection
-def create_connection():
-    """Creates and returns a database connection and cursor."""
-    # DATABASE_URL existence is checked at module load time now
+# Hot queries, prepared once per connection on first use: name -> SQL with $n placeholders
+prepared_statements = {}
+
+def prepare(name, sql):
+    """Registers a statement to be PREPAREd on every pooled connection."""
+    prepared_statements[name] = sql
+
+@contextlib.contextmanager
+def _timed(query):
+    started = time.perf_counter()
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        # Removed the redundant info log from here, it's noisy on every call
-        # logger.info("Database connection established successfully.")
-        return conn, cursor
-    except psycopg2.OperationalError as e:
-        logger.error(f"Database connection failed: {e}")
-        return None, None
-    except Exception as e:
-        logger.error(f"An unexpected error occurred during DB connection: {e}")
-        return None, None
-
-def close_connection(conn, cursor):
-    """Closes the database cursor and connection."""
-    if cursor:
-        cursor.close()
-    if conn:
-        conn.close()
-    # logger.info("Database connection closed.") # Can be noisy
-
-def test_db_connection():
-    """Tests the database connection by executing a simple query."""
-    logger.info("Attempting database connection test...")
-    conn, cursor = create_connection()
-    if conn and cursor:
+        yield
+    finally:
+        metrics.db_latency.observe(time.perf_counter() - started, query=query)
+
+def _verb(sql):
+    return sql.split(None, 1)[0].lower() if sql.strip() else "empty"
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the acquire timeout."""
+
+class _PooledConnection:
+    """A psycopg2 connection plus the bookkeeping the pool needs."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.prepared = set()
+        self.broken = False
+        self.query = None  # executor future of a query whose caller was cancelled while it ran
+
+class Pool:
+    """Bounded asyncio pool of psycopg2 connections.
+
+    psycopg2 is blocking, so every connect and query runs on a dedicated
+    thread pool sized to the connection limit; the event loop only waits.
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10, acquire_timeout=10.0,
+                 health_check_after=30.0, max_idle=300.0, max_lifetime=3600.0,
+                 connect=psycopg2.connect):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_after = health_check_after
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self._connect = connect
+        self._idle = collections.deque()
+        self._size = 0  # open connections, idle or checked out, plus ones being opened
+        self._in_use = 0
+        self._waiting = 0
+        self._cond = None
+        self._reaper = None
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=max_size, thread_name_prefix="db")
+        self.metrics = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "connects": 0,
+            "connect_errors": 0,
+            "recycled": 0,
+            "health_check_failures": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "checkout_latency_total": 0.0,
+            "checkout_latency_max": 0.0,
+        }
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _open_blocking(self):
+        raw = self._connect(self.dsn)
+        raw.autocommit = False
+        return _PooledConnection(raw)
+
+    async def _open(self):
+        try:
+            conn = await self._run(self._open_blocking)
+        except Exception:
+            self.metrics["connect_errors"] += 1
+            raise
+        self.metrics["connects"] += 1
+        return conn
+
+    def _close_blocking(self, conn):
         try:
-            cursor.execute("SELECT 1;") # Simple query to test
-            logger.info("Database test query executed successfully.")
-            close_connection(conn, cursor) # Close connection after successful test
-            return True
+            conn.raw.close()
         except Exception as e:
-            logger.error(f"Database test query failed: {e}")
-            close_connection(conn, cursor) # Still close connection on failure
-            return False
-    else:
-        # create_connection already logged the error
-        logger.error("Database test connection failed: Could not establish connection.")
+            logger.warning(f"Error closing database connection: {e}")
+
+    @staticmethod
+    def _ping_blocking(conn):
+        with conn.raw.cursor() as cursor:
+            cursor.execute("SELECT 1;")
+        conn.raw.rollback()
+
+    async def start(self):
+        """Opens min_size connections concurrently so the first requests don't pay for connects."""
+        self._cond = asyncio.Condition()
+        self._size = self.min_size
+        results = await asyncio.gather(*(self._open() for _ in range(self.min_size)), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        self._size -= len(errors)
+        self._idle.extend(r for r in results if not isinstance(r, BaseException))
+        if errors:
+            raise errors[0]
+        self._reaper = asyncio.create_task(self._reap())
+
+    async def close(self):
+        """Closes idle connections and stops handing out new ones."""
+        self._closed = True
+        if self._reaper:
+            self._reaper.cancel()
+        while self._idle:
+            await self._run(self._close_blocking, self._idle.pop())
+            self._size -= 1
+        self._executor.shutdown(wait=False)
+
+    async def _discard(self, conn):
+        await self._run(self._close_blocking, conn)
+        async with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    async def _check(self, conn):
+        """Recycles connections that are too old and pings ones idle for a while."""
+        now = time.monotonic()
+        if now - conn.created_at > self.max_lifetime:
+            self.metrics["recycled"] += 1
+            await self._run(self._close_blocking, conn)
+            return await self._open()
+        if now - conn.last_used > self.health_check_after:
+            try:
+                await self._run(self._ping_blocking, conn)
+            except Exception as e:
+                logger.warning(f"Stale database connection replaced: {e}")
+                self.metrics["health_check_failures"] += 1
+                await self._run(self._close_blocking, conn)
+                return await self._open()
+        return conn
+
+    async def acquire(self):
+        if self._closed:
+            raise RuntimeError("Database pool is closed")
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + self.acquire_timeout
+        conn = None
+        async with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    self.metrics["timeouts"] += 1
+                    raise PoolTimeout(f"No database connection available after {self.acquire_timeout}s")
+                self._waiting += 1
+                try:
+                    await asyncio.wait_for(self._cond.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self._waiting -= 1
+            self._in_use += 1
+        waited = loop.time() - started
+        try:
+            conn = await self._open() if conn is None else await self._check(conn)
+        except BaseException:
+            async with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        latency = loop.time() - started
+        m = self.metrics
+        m["checkouts"] += 1
+        m["wait_time_total"] += waited
+        m["wait_time_max"] = max(m["wait_time_max"], waited)
+        m["checkout_latency_total"] += latency
+        m["checkout_latency_max"] = max(m["checkout_latency_max"], latency)
+        return conn
+
+    def _release_later(self, conn):
+        def done(future):
+            if not future.cancelled():
+                future.exception()  # retrieved so it isn't reported as unhandled; the caller is gone
+            asyncio.ensure_future(self.release(conn))
+        conn.query.add_done_callback(done)
+
+    async def release(self, conn):
+        if conn.query is not None:
+            if not conn.query.done():
+                # The thread is still using the connection: return it once the query is over
+                self._release_later(conn)
+                return
+            conn.query = None
+        if self._closed:
+            self._in_use -= 1
+            self._size -= 1
+            self._close_blocking(conn)
+            return
+        if conn.broken:
+            async with self._cond:
+                self._in_use -= 1
+            await self._discard(conn)
+            return
+        conn.last_used = time.monotonic()
+        async with self._cond:
+            self._in_use -= 1
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        conn = await self.acquire()
+        try:
+            yield conn
+        finally:
+            await self.release(conn)
+
+    async def _reap(self):
+        """Closes connections idle longer than max_idle, keeping min_size warm."""
+        while True:
+            await asyncio.sleep(max(self.max_idle / 4, 1))
+            now = time.monotonic()
+            async with self._cond:
+                stale = []
+                while (self._idle and self._size - len(stale) > self.min_size
+                       and now - self._idle[0].last_used > self.max_idle):
+                    stale.append(self._idle.popleft())
+                self._size -= len(stale)
+            for conn in stale:
+                await self._run(self._close_blocking, conn)
+
+    async def _query(self, conn, fn, *args):
+        """Runs fn(conn, *args) on the executor. A cancelled caller leaves the query to finish on its thread."""
+        future = asyncio.get_running_loop().run_in_executor(self._executor, fn, conn, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            conn.query = future
+            raise
+
+    def _prepared_blocking(self, conn, name, args, fetch):
+        if name not in conn.prepared:
+            self._query_blocking(conn, f"PREPARE {name} AS {prepared_statements[name]}", (), False)
+            conn.prepared.add(name)
+        sql = f"EXECUTE {name}" + (" (" + ", ".join(["%s"] * len(args)) + ")" if args else "")
+        return self._query_blocking(conn, sql, args, fetch)
+
+    def _query_blocking(self, conn, sql, args, fetch, many=False):
+        try:
+            with conn.raw.cursor() as cursor:
+                if many:
+                    cursor.executemany(sql, args)
+                else:
+                    cursor.execute(sql, args or None)
+                rows = cursor.fetchall() if fetch and cursor.description else None
+                rowcount = cursor.rowcount
+            conn.raw.commit()
+            return rows if fetch else rowcount
+        except psycopg2.Error:
+            if conn.raw.closed:
+                conn.broken = True
+            else:
+                try:
+                    conn.raw.rollback()
+                except psycopg2.Error:
+                    conn.broken = True
+            raise
+
+
+    async def execute(self, sql, *args):
+        with _timed(_verb(sql)):
+            async with self.connection() as conn:
+                return await self._query(conn, self._query_blocking, sql, args, False)
+
+    async def executemany(self, sql, rows):
+        with _timed(_verb(sql)):
+            async with self.connection() as conn:
+                return await self._query(conn, self._query_blocking, sql, rows, False, True)
+
+    async def fetch(self, sql, *args):
+        with _timed(_verb(sql)):
+            async with self.connection() as conn:
+                return await self._query(conn, self._query_blocking, sql, args, True)
+
+    async def fetchval(self, sql, *args):
+        rows = await self.fetch(sql, *args)
+        return rows[0][0] if rows else None
+
+    async def execute_prepared(self, name, *args, fetch=False):
+        """Runs a statement registered with prepare(), PREPAREing it on this connection first if needed."""
+        with _timed(name):
+            async with self.connection() as conn:
+                # PREPARE and EXECUTE in one trip to the thread, so conn.prepared stays right if the caller is cancelled
+                return await self._query(conn, self._prepared_blocking, name, args, fetch)
+
+    def stats(self):
+        m = dict(self.metrics)
+        m["size"] = self._size
+        m["idle"] = len(self._idle)
+        m["in_use"] = self._in_use
+        m["waiting"] = self._waiting
+        return m
+
+pool = None
+
+metrics.stats_gauge("db_pool", "Database pool state and totals", lambda: pool.stats() if pool else {})
+
+async def init_pool(connect=psycopg2.connect):
+    """Creates the global pool and warms it up. Returns False if the database is unreachable."""
+    global pool
+    logger.info("Warming up database pool...")
+    pool = Pool(
+        DATABASE_URL,
+        min_size=conf["db_pool_min_size"],
+        max_size=conf["db_pool_max_size"],
+        acquire_timeout=conf["db_acquire_timeout"],
+        health_check_after=conf["db_health_check_after"],
+        max_idle=conf["db_max_idle"],
+        max_lifetime=conf["db_max_lifetime"],
+        connect=connect,
+    )
+    try:
+        await pool.start()
+    except Exception as e:
+        logger.error(f"Database pool warm-up failed: {e}")
         return False
-        
\ No newline at end of file
+    logger.info(f"Database pool ready ({pool.min_size}-{pool.max_size} connections).")
+    return True
+
+async def close_pool():
+    if pool:
+        await pool.close()
+
+async def execute(sql, *args):
+    return await pool.execute(sql, *args)
+
+async def executemany(sql, rows):
+    return await pool.executemany(sql, rows)
+
+async def fetch(sql, *args):
+    return await pool.fetch(sql, *args)
+
+async def fetchval(sql, *args):
+    return await pool.fetchval(sql, *args)
+
+async def execute_prepared(name, *args, fetch=False):
+    return await pool.execute_prepared(name, *args, fetch=fetch)
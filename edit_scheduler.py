@@ -0,0 +1,207 @@
+import time
+import asyncio
+import logging
+from telebot.asyncio_helper import ApiTelegramException
+from config import conf
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class _Edit:
+    __slots__ = ("bot", "chat_id", "message_id", "text", "parse_mode", "fallback_text", "final", "waiters")
+
+    def __init__(self, bot, chat_id, message_id, text, parse_mode, fallback_text, final):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.parse_mode = parse_mode
+        self.fallback_text = fallback_text
+        self.final = final
+        self.waiters = []
+
+    def resolve(self):
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters = []
+
+class EditScheduler:
+    """Central dispatcher for edit_message_text calls of streaming replies.
+
+    Only the newest pending text per message is kept, so a slow chat simply
+    skips intermediate states. Edits are paced by a global token bucket
+    (Telegram allows ~30 requests/s per bot) and a per-chat interval that grows
+    with the number of active messages, and a 429 pauses the chat for its
+    retry_after. Final edits jump the queue and can be awaited with flush().
+    """
+
+    def __init__(self, global_rate=30.0, chat_interval=1.0, group_interval=3.0, max_interval=10.0, max_pending=5000):
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.max_interval = max_interval
+        self.max_pending = max_pending
+        self._pending = {}     # (chat_id, message_id) -> _Edit, oldest first
+        self._in_flight = set()
+        self._chat_ready = {}  # chat_id -> monotonic time the chat may be edited again
+        self._tokens = global_rate
+        self._refilled = time.monotonic()
+        self._wakeup = None
+        self._task = None
+        self.metrics = {
+            "submitted": 0, "coalesced": 0, "dropped": 0, "sent": 0,
+            "not_modified": 0, "fallbacks": 0, "rate_limited": 0, "failed": 0,
+        }
+
+    def interval_for(self, chat_id):
+        """Per-chat spacing: Telegram's per-chat limits, stretched so all active messages share the global budget."""
+        base = self.group_interval if chat_id < 0 else self.chat_interval
+        return min(max(base, (len(self._pending) + len(self._in_flight)) / self.global_rate), self.max_interval)
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def submit(self, bot, chat_id, message_id, text, parse_mode=None, fallback_text=None, final=False):
+        """Queues text as the next content of the message, replacing any edit still pending for it."""
+        self._ensure_started()
+        self.metrics["submitted"] += 1
+        key = (chat_id, message_id)
+        job = self._pending.get(key)
+        if job is not None:
+            self.metrics["coalesced"] += 1
+            job.bot, job.text, job.parse_mode, job.fallback_text = bot, text, parse_mode, fallback_text
+            job.final = job.final or final
+        else:
+            job = self._pending[key] = _Edit(bot, chat_id, message_id, text, parse_mode, fallback_text, final)
+            if len(self._pending) > self.max_pending:
+                self._drop_oldest()
+        self._wakeup.set()
+        return job
+
+    async def flush(self, bot, chat_id, message_id, text, parse_mode=None, fallback_text=None):
+        """Submits the final text for a message and waits until it has been sent (or given up on)."""
+        job = self.submit(bot, chat_id, message_id, text, parse_mode, fallback_text, final=True)
+        waiter = asyncio.get_running_loop().create_future()
+        job.waiters.append(waiter)
+        await waiter
+
+    def _drop_oldest(self):
+        for key, job in self._pending.items():
+            if not job.final:
+                del self._pending[key]
+                self.metrics["dropped"] += 1
+                return
+
+    def _refill(self, now):
+        self._tokens = min(self.global_rate, self._tokens + (now - self._refilled) * self.global_rate)
+        self._refilled = now
+
+    def _next_job(self, now):
+        """Oldest final edit whose chat is ready, else the oldest ready edit; plus the earliest ready time."""
+        best, next_ready = None, None
+        for key, job in self._pending.items():
+            if key in self._in_flight:
+                continue
+            ready = self._chat_ready.get(job.chat_id, 0.0)
+            if ready > now:
+                next_ready = ready if next_ready is None else min(next_ready, ready)
+                continue
+            if job.final:
+                return job, None
+            if best is None:
+                best = job
+        return best, next_ready
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            job, next_ready = self._next_job(now)
+            if job is not None and self._tokens >= 1:
+                key = (job.chat_id, job.message_id)
+                del self._pending[key]
+                self._tokens -= 1
+                self._chat_ready[job.chat_id] = now + self.interval_for(job.chat_id)
+                self._in_flight.add(key)
+                asyncio.create_task(self._send(key, job))
+                continue
+            if job is not None:
+                timeout = (1 - self._tokens) / self.global_rate
+            elif next_ready is not None:
+                timeout = next_ready - now
+            else:
+                timeout = None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _requeue(self, key, job):
+        newer = self._pending.get(key)
+        if newer is None:
+            self._pending[key] = job
+        else:
+            newer.waiters.extend(job.waiters)
+            newer.final = newer.final or job.final
+
+    async def _send(self, key, job):
+        try:
+            try:
+                await job.bot.edit_message_text(job.text, chat_id=job.chat_id, message_id=job.message_id, parse_mode=job.parse_mode)
+                self.metrics["sent"] += 1
+            except ApiTelegramException as e:
+                description = (e.description or "").lower()
+                if e.error_code == 429:
+                    retry_after = (e.result_json.get("parameters") or {}).get("retry_after", self.chat_interval)
+                    self.metrics["rate_limited"] += 1
+                    self._chat_ready[job.chat_id] = time.monotonic() + retry_after
+                    self._requeue(key, job)
+                    return
+                if "message is not modified" in description:
+                    self.metrics["not_modified"] += 1
+                elif "parse" in description and job.fallback_text is not None:
+                    self.metrics["fallbacks"] += 1
+                    await job.bot.edit_message_text(job.fallback_text, chat_id=job.chat_id, message_id=job.message_id)
+                    self.metrics["sent"] += 1
+                else:
+                    raise
+        except Exception as e:
+            self.metrics["failed"] += 1
+            logger.error(f"Error updating message {job.chat_id}/{job.message_id}: {e}")
+        finally:
+            self._in_flight.discard(key)
+            if key not in self._pending:
+                job.resolve()
+            self._wakeup.set()
+
+    async def stop(self):
+        """Sends pending final edits, drops the rest and stops the dispatcher."""
+        if self._task is None:
+            return
+        while any(job.final for job in self._pending.values()) or self._in_flight:
+            await asyncio.sleep(0.05)
+        self.metrics["dropped"] += len(self._pending)
+        for job in self._pending.values():
+            job.resolve()
+        self._pending.clear()
+        self._task.cancel()
+
+    def stats(self):
+        m = dict(self.metrics)
+        m["pending"] = len(self._pending)
+        m["in_flight"] = len(self._in_flight)
+        m["tokens"] = self._tokens
+        return m
+
+scheduler = EditScheduler(
+    global_rate=conf["telegram_global_rate"],
+    chat_interval=conf["telegram_chat_interval"],
+    group_interval=conf["telegram_group_interval"],
+    max_interval=conf["telegram_max_edit_interval"],
+)
+
+metrics.stats_gauge("telegram_edit_scheduler", "Streaming edit scheduler state and totals", scheduler.stats)
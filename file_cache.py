@@ -0,0 +1,192 @@
+import os
+import re
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from telebot.asyncio_helper import ApiTelegramException
+from config import conf
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class TieredCache:
+    """Bounded two-tier bytes cache: an in-memory LRU in front of a size-capped directory.
+
+    Disk reads and writes run in a thread. The disk index is rebuilt from the
+    directory on first use, so cached files survive restarts of the process.
+    """
+
+    def __init__(self, name, directory, memory_bytes, disk_bytes):
+        self.name = name
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()  # key -> bytes
+        self._memory_size = 0
+        self._disk = None             # key -> size, least recently used first
+        self._disk_size = 0
+        self._loading = None
+        self.metrics = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def _path(self, key):
+        return os.path.join(self.directory, re.sub(r"[^A-Za-z0-9_-]", "_", key))
+
+    def _load_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                # Left by a write that was interrupted; never a cache entry (keys have no dots)
+                self._remove([entry.path])
+            elif entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_atime, entry.name, stat.st_size))
+        self._disk = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self._disk_size = sum(self._disk.values())
+
+    async def _disk_index(self):
+        if self._disk is None:
+            # One scan for all first callers: a second one could remove the .tmp of a write already under way
+            if self._loading is None:
+                self._loading = asyncio.ensure_future(asyncio.to_thread(self._load_index))
+            try:
+                await asyncio.shield(self._loading)
+            except OSError:
+                self._loading = None
+                raise
+        return self._disk
+
+    def _remember(self, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= len(old)
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    @staticmethod
+    def _read(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def _write(path, data):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _remove(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def get(self, key):
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.metrics["memory_hits"] += 1
+            return data
+        disk = await self._disk_index()
+        name = os.path.basename(self._path(key))
+        if name in disk:
+            try:
+                data = await asyncio.to_thread(self._read, self._path(key))
+            except OSError:
+                self._disk_size -= disk.pop(name)
+            else:
+                disk.move_to_end(name)
+                self.metrics["disk_hits"] += 1
+                self._remember(key, data)
+                return data
+        self.metrics["misses"] += 1
+        return None
+
+    async def put(self, key, data):
+        self._remember(key, data)
+        if len(data) > self.disk_bytes:
+            return
+        disk = await self._disk_index()
+        name = os.path.basename(self._path(key))
+        try:
+            await asyncio.to_thread(self._write, self._path(key), data)
+        except OSError as e:
+            logger.warning(f"{self.name} cache: could not write {name}: {e}")
+            return
+        self._disk_size += len(data) - disk.pop(name, 0)
+        disk[name] = len(data)
+        evicted = []
+        while self._disk_size > self.disk_bytes:
+            evicted_name, size = disk.popitem(last=False)
+            self._disk_size -= size
+            evicted.append(os.path.join(self.directory, evicted_name))
+        if evicted:
+            await asyncio.to_thread(self._remove, evicted)
+
+    async def delete(self, key):
+        data = self._memory.pop(key, None)
+        if data is not None:
+            self._memory_size -= len(data)
+        disk = await self._disk_index()
+        name = os.path.basename(self._path(key))
+        if name in disk:
+            self._disk_size -= disk.pop(name)
+            await asyncio.to_thread(self._remove, [self._path(key)])
+
+    def stats(self):
+        m = dict(self.metrics)
+        lookups = m["memory_hits"] + m["disk_hits"] + m["misses"]
+        m["hit_ratio"] = (m["memory_hits"] + m["disk_hits"]) / lookups if lookups else 0.0
+        m["memory_bytes"] = self._memory_size
+        m["disk_bytes"] = self._disk_size
+        return m
+
+# Telegram downloads keyed by file_unique_id
+downloads = TieredCache(
+    "downloads",
+    os.path.join(conf["file_cache_dir"], "downloads"),
+    conf["file_cache_memory_bytes"],
+    conf["file_cache_disk_bytes"],
+)
+# sha256 of sent media -> Telegram file_id, so repeat sends are references instead of uploads
+sent_media = TieredCache(
+    "sent_media",
+    os.path.join(conf["file_cache_dir"], "sent"),
+    1024 * 1024,
+    16 * 1024 * 1024,
+)
+
+metrics.stats_gauge("file_cache", "Telegram file cache state and hit ratios",
+                    lambda: {c.name: c.stats() for c in (downloads, sent_media)}, label="cache")
+
+async def download(bot, photo):
+    """Downloads a Telegram PhotoSize (or any file object with file_id/file_unique_id) through the cache."""
+    data = await downloads.get(photo.file_unique_id)
+    if data is None:
+        file_path = await bot.get_file(photo.file_id)
+        data = await bot.download_file(file_path.file_path)
+        await downloads.put(photo.file_unique_id, data)
+    return data
+
+async def send_photo(bot, chat_id, data, **kwargs):
+    """send_photo that reuses the file_id Telegram returned the last time these exact bytes were sent."""
+    digest = hashlib.sha256(data).hexdigest()
+    file_id = await sent_media.get(digest)
+    if file_id is not None:
+        try:
+            return await bot.send_photo(chat_id, file_id.decode(), **kwargs)
+        except ApiTelegramException as e:
+            logger.warning(f"Cached file_id rejected, uploading again: {e}")
+            await sent_media.delete(digest)
+    sent = await bot.send_photo(chat_id, data, **kwargs)
+    if sent.photo:
+        await sent_media.put(digest, sent.photo[-1].file_id.encode())
+    return sent
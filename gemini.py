@@ -1,18 +1,49 @@
-import io
+import os
 import time
-import traceback
+import asyncio
+import logging
 import sys
-from PIL import Image
+import contextlib
 from telebot.types import Message
-from md2tgmd import escape
 from telebot import TeleBot
+from telebot.asyncio_helper import ApiTelegramException
 from config import conf, generation_config
-from google import genai
+from lazy import lazy_module
+import history
+import images
+import file_cache
+from session_cache import SessionCache, history_bytes
+from key_pool import KeyPool, parse_keys
+from edit_scheduler import scheduler as edit_scheduler
+from renderer import StreamRenderer
+from context import ContextWindow, IMAGE_PLACEHOLDER
+from providers import build_backends
+from router import Router
+import metrics
+import usage
+import response_cache
 
-gemini_draw_dict = {}
-gemini_chat_dict = {}
-gemini_pro_chat_dict = {}
-default_model_dict = {}
+logger = logging.getLogger(__name__)
+
+# Loaded on first use (or by lazy.warm after startup), not at import
+genai = lazy_module("google.genai")
+types = lazy_module("google.genai.types")
+
+def _spill(user_id, chat, reason):
+    # Turns are already queued in the history store; make sure they reach Postgres promptly
+    history.store.request_flush()
+
+_session_options = dict(
+    max_entries=conf["session_max_entries"],
+    max_bytes=conf["session_max_bytes"],
+    idle_ttl=conf["session_idle_ttl"],
+    sizer=history_bytes,
+    on_evict=_spill if conf["session_spill_on_evict"] else None,
+)
+gemini_draw_dict = SessionCache("draw", **_session_options)
+gemini_chat_dict = SessionCache("chat", **_session_options)
+gemini_pro_chat_dict = SessionCache("pro", **_session_options)
+default_model_dict = SessionCache("default_model", max_entries=conf["session_max_entries"])
 
 model_1                 =       conf["model_1"]
 model_2                 =       conf["model_2"]
@@ -22,125 +53,373 @@ download_pic_notify     =       conf["download_pic_notify"]
 
 search_tool = {'google_search': {}}
 
-client = genai.Client(api_key=sys.argv[2])
+key_pool = KeyPool(
+    parse_keys(sys.argv[2] if len(sys.argv) > 2 else os.environ['GEMINI_API_KEYS']),
+    rpm=conf["gemini_key_rpm"],
+    tpm=conf["gemini_key_tpm"],
+    max_retries=conf["gemini_max_retries"],
+    backoff=conf["gemini_retry_backoff"],
+    client_factory=lambda api_key: genai.Client(
+        api_key=api_key,
+        http_options={"base_url": conf["gemini_base_url"]} if conf["gemini_base_url"] else None,
+    ),
+    on_usage=usage.meter.record_response,
+)
 
-async def gemini_stream(bot:TeleBot, message:Message, m:str, model_type:str):
-    sent_message = None
+async def summarize(transcript:str) -> str:
+    """Condenses dropped turns for the context window's rolling summary."""
+    prompt = ("Summarize this conversation in under 200 words. Keep facts, names, decisions and open questions "
+              "the assistant will need later.\n\n" + transcript)
+    with metrics.timed_call(conf["context_summary_model"]):
+        response = await key_pool.call(lambda c: c.aio.models.generate_content(
+            model=conf["context_summary_model"],
+            contents=prompt,
+        ), estimate_tokens(prompt), model=conf["context_summary_model"])
+    return response.text
+
+context_window = ContextWindow(
+    max_tokens=conf["context_max_tokens"],
+    min_turns=conf["context_min_turns"],
+    keep_images=conf["context_keep_images"],
+    image_tokens=conf["context_image_tokens"],
+    summarizer=summarize if conf["context_summary_model"] else None,
+    max_sessions=conf["session_max_entries"],
+    idle_ttl=conf["session_idle_ttl"],
+)
+
+router = Router(
+    build_backends(dict.fromkeys(
+        [model_1, model_2]
+        + [m for ms in conf["model_fallbacks"].values() for m in ms]
+        + ([conf["hedge_model"]] if conf["hedge_model"] else [])
+    ), key_pool),
+    routes=conf["model_fallbacks"],
+    window=conf["router_window"],
+    error_threshold=conf["router_error_threshold"],
+    cooldown=conf["router_cooldown"],
+    fallback_penalty=conf["router_fallback_penalty"],
+    hedge=conf["hedge_requests"],
+    hedge_percentile=conf["hedge_percentile"],
+    hedge_min_delay=conf["hedge_min_delay"],
+    hedge_default_delay=conf["hedge_default_delay"],
+    hedge_max_rate=conf["hedge_max_rate"],
+    hedge_model=conf["hedge_model"],
+)
+
+metrics.stats_gauge("session_cache", "Session cache size and hit/miss/eviction totals",
+                    lambda: {c.name: c.stats() for c in (gemini_chat_dict, gemini_pro_chat_dict, gemini_draw_dict, default_model_dict)},
+                    label="cache")
+metrics.stats_gauge("gemini_key", "Per API key usage in the current minute and totals",
+                    lambda: {k["key"]: k for k in key_pool.stats()}, label="key")
+metrics.stats_gauge("model_backend", "Per backend TTFT, error rate, health and failovers", router.stats, label="backend")
+metrics.stats_gauge("model_hedging", "Hedged turns and which request won", router.hedge_stats)
+metrics.stats_gauge("context_window", "History trimming, image stripping and summary totals", context_window.stats)
+
+async def get_chat(chat_dict, kind:str, user_id:str, model:str, config):
+    """Returns the user's chat session, rehydrating it from the history store after a restart."""
+    chat = chat_dict.get(user_id)
+    if chat is None:
+        chat = key_pool.client.aio.chats.create(
+            model=model,
+            config=config,
+            history=await history.store.load(user_id, kind),
+        )
+        chat_dict[user_id] = chat
+    return chat
+
+class _Running:
+    """A turn in progress; cleared is set when /clear runs before it finishes."""
+    cleared = False
+
+running_turns = {}  # user_id -> turns in progress
+
+@contextlib.contextmanager
+def running(user_id:str):
+    """Tracks a turn of user_id from before its session is loaded until it is written back."""
+    turn = _Running()
+    turns = running_turns.setdefault(user_id, set())
+    turns.add(turn)
     try:
-        sent_message = await bot.reply_to(message, "🤖 Generating answers...")
+        yield turn
+    finally:
+        turns.discard(turn)
+        if not turns:
+            running_turns.pop(user_id, None)
 
-        chat = None
-        if model_type == model_1:
-            chat_dict = gemini_chat_dict
-        else:
-            chat_dict = gemini_pro_chat_dict
+def mark_cleared(user_id:str):
+    """Tells user_id's turns in progress that /clear ran, so they don't write the old session back."""
+    for turn in running_turns.get(user_id, ()):
+        turn.cleared = True
 
-        if str(message.from_user.id) not in chat_dict:
-            chat = client.aio.chats.create(model=model_1, config={'tools': [search_tool]})
-            chat_dict[str(message.from_user.id)] = chat
-        else:
-            chat = chat_dict[str(message.from_user.id)]
+def write_back(chat_dict, kind:str, user_id:str, state:_Running, session, contents:list):
+    """Keeps a finished turn's session and stores its contents, unless /clear ran meanwhile."""
+    if state.cleared:
+        # get_chat may have cached the history loaded before the clear
+        chat_dict.pop(user_id)
+        context_window.forget(f"{kind}:{user_id}")
+        return
+    if session is not None:
+        chat_dict[user_id] = session
+        history.store.append(user_id, kind, contents)
+    chat_dict.refresh(user_id)
 
-        response = await chat.send_message_stream(m)
+def estimate_tokens(text:str) -> int:
+    return len(text) // 4 + 1
 
-        full_response = ""
-        last_update = time.time()
-        update_interval = conf["streaming_update_interval"]
+class ChatTurn:
+    """One request against a session, run on whichever API key the pool picks.
 
-        async for chunk in response:
-            if hasattr(chunk, 'text') and chunk.text:
-                full_response += chunk.text
-                current_time = time.time()
-
-                if current_time - last_update >= update_interval:
-
-                    try:
-                        await bot.edit_message_text(
-                            escape(full_response),
-                            chat_id=sent_message.chat.id,
-                            message_id=sent_message.message_id,
-                            parse_mode="MarkdownV2"
-                            )
-                    except Exception as e:
-                        if "parse markdown" in str(e).lower():
-                            await bot.edit_message_text(
-                                full_response,
-                                chat_id=sent_message.chat.id,
-                                message_id=sent_message.message_id
-                                )
-                        else:
-                            if "message is not modified" not in str(e).lower():
-                                print(f"Error updating message: {e}")
-                    last_update = current_time
+    Sessions are only history holders; each attempt forks a chat bound to the
+    chosen key's client, and the session is replaced by the fork once the turn
+    succeeds, so failed or retried attempts never touch the stored history.
+    The history sent is trimmed to the context window's budget first.
+    """
 
-        try:
-            await bot.edit_message_text(
-                escape(full_response),
-                chat_id=sent_message.chat.id,
-                message_id=sent_message.message_id,
-                parse_mode="MarkdownV2"
-            )
-        except Exception as e:
-            try:
-                if "parse markdown" in str(e).lower():
-                    await bot.edit_message_text(
-                        full_response,
-                        chat_id=sent_message.chat.id,
-                        message_id=sent_message.message_id
-                    )
-            except Exception:
-                traceback.print_exc()
+    def __init__(self, chat, model:str, config, session:str):
+        self.history = context_window.fit(session, chat.get_history())
+        self.model = model
+        self.config = config
+        self.chat = None
+        self.backend = None
+        self.keys = []  # API keys this turn's attempts went to; shared with the router's copies, so a hedge avoids them
+        self.lost = False  # set by the router on the copy of an attempt it cancelled for another one
 
+    def fork(self, client, model:str=None):
+        self.chat = client.aio.chats.create(model=model or self.model, config=self.config, history=self.history)
+        return self.chat
 
-    except Exception as e:
-        traceback.print_exc()
-        if sent_message:
-            await bot.edit_message_text(
-                f"{error_info}\nError details: {str(e)}",
-                chat_id=sent_message.chat.id,
-                message_id=sent_message.message_id
+    def complete(self, m:str, text:str, parts:list=None):
+        """The session to keep: the Gemini fork, or one rebuilt from the answer when another provider or the cache answered."""
+        if self.chat is not None:
+            return self.chat
+        return key_pool.client.aio.chats.create(model=self.model, config=self.config, history=self.history + [
+            types.UserContent(parts=[types.Part.from_text(text=m)]),
+            types.ModelContent(parts=parts or [types.Part.from_text(text=text)]),
+        ])
+
+def cache_key(turn:ChatTurn, m:str):
+    """Response cache key of a first turn (nothing in the history), None if the turn can't be cached."""
+    if not conf["response_cache"] or turn.history:
+        return None
+    return response_cache.cache.key(m, turn.model, turn.config)
+
+async def send_pages(bot:TeleBot, sent_message:Message, renderer:StreamRenderer, pages_sent:int):
+    """Finalizes pages the renderer closed since pages_sent, each followed by a fresh message to stream into."""
+    while pages_sent < len(renderer.pages):
+        escaped, raw = renderer.pages[pages_sent]
+        await edit_scheduler.flush(
+            bot,
+            sent_message.chat.id,
+            sent_message.message_id,
+            escaped,
+            parse_mode="MarkdownV2",
+            fallback_text=raw,
+        )
+        sent_message = await bot.send_message(sent_message.chat.id, "🤖 Generating answers...")
+        pages_sent += 1
+    return sent_message, pages_sent
+
+class StreamReply:
+    """Streams text into a placeholder message through the edit scheduler, paging into new messages on overflow."""
+
+    def __init__(self, bot:TeleBot, sent_message:Message):
+        self.bot = bot
+        self.sent_message = sent_message
+        self.renderer = StreamRenderer()
+        self.pages_sent = 0
+        self.text = ""
+        self.photo_ids = []  # Telegram file_ids of the photos sent with the answer
+        self.last_update = time.time()
+
+    async def feed(self, text:str):
+        self.text += text
+        if self.renderer.feed(text):
+            self.sent_message, self.pages_sent = await send_pages(self.bot, self.sent_message, self.renderer, self.pages_sent)
+        current_time = time.time()
+        if current_time - self.last_update >= conf["streaming_update_interval"]:
+            escaped, raw = self.renderer.render()
+            edit_scheduler.submit(
+                self.bot,
+                self.sent_message.chat.id,
+                self.sent_message.message_id,
+                escaped,
+                parse_mode="MarkdownV2",
+                fallback_text=raw,
             )
+            self.last_update = current_time
+
+    async def finish(self):
+        """Sends the final text. Without text the placeholder is deleted if images went out, else shows error_info."""
+        if not self.text:
+            if self.photo_ids:
+                await self.bot.delete_message(self.sent_message.chat.id, self.sent_message.message_id)
+            else:
+                # Nothing came back (e.g. a safety block): don't leave the user without an answer
+                await edit_scheduler.flush(self.bot, self.sent_message.chat.id, self.sent_message.message_id, error_info)
+            return
+        escaped, raw = self.renderer.render()
+        await edit_scheduler.flush(
+            self.bot,
+            self.sent_message.chat.id,
+            self.sent_message.message_id,
+            escaped,
+            parse_mode="MarkdownV2",
+            fallback_text=raw,
+        )
+
+    async def fail(self, message:Message, e:Exception):
+        text = f"{error_info}\nError details: {str(e)}"
+        if self.sent_message:
+            # A final edit replaces any partial text still queued for the message, and goes out after one in flight
+            await edit_scheduler.flush(self.bot, self.sent_message.chat.id, self.sent_message.message_id, text)
         else:
-            await bot.reply_to(message, f"{error_info}\nError details: {str(e)}")
+            await self.bot.reply_to(message, text)
 
-async def gemini_edit(bot: TeleBot, message: Message, m: str, photo_file: bytes):
+async def replay_cached(bot:TeleBot, message:Message, reply:StreamReply, key:str) -> bool:
+    """Answers from the response cache: photos by their file_id, then the text into reply. False on a miss."""
+    started = time.perf_counter()
+    entry = await response_cache.cache.get(key)
+    if entry is None:
+        return False
+    for file_id in entry["photos"]:
+        try:
+            await bot.send_photo(message.chat.id, file_id)
+        except ApiTelegramException as e:
+            logger.warning(f"Cached photo rejected, generating the answer again: {e}")
+            response_cache.cache.invalidate(key)
+            return False
+        reply.photo_ids.append(file_id)
+    if entry["text"]:
+        await reply.feed(entry["text"])
+    metrics.mark("cache_hit")
+    response_cache.cache.hit_served(entry, time.perf_counter() - started)
+    return True
 
-    image = Image.open(io.BytesIO(photo_file))
+async def gemini_stream(bot:TeleBot, message:Message, m:str, model_type:str):
+    reply = StreamReply(bot, None)
+    timer = metrics.StreamTimer(model_type)
     try:
-        response = await client.aio.models.generate_content(
-        model=model_1,
-        contents=[m, image],
-        config=generation_config
-    )
+        reply.sent_message = await bot.reply_to(message, "🤖 Generating answers...")
+
+        if model_type == model_1:
+            chat_dict, kind = gemini_chat_dict, "chat"
+        else:
+            chat_dict, kind = gemini_pro_chat_dict, "pro"
+
+        user_id = str(message.from_user.id)
+        config = {'tools': [search_tool]}
+        with running(user_id) as state:
+            turn = ChatTurn(await get_chat(chat_dict, kind, user_id, model_type, config), model_type, config, f"{kind}:{user_id}")
+            key = cache_key(turn, m)
+            if not (key and await replay_cached(bot, message, reply, key)):
+                response = router.stream(model_type, turn, m, estimate_tokens(m))
+
+                async for text in response:
+                    timer.chunk()
+                    if text:
+                        await reply.feed(text)
+                timer.finish()
+                if not turn.backend.provider.reports_usage:
+                    # No usage metadata from other providers: count the call with estimated tokens
+                    prompt_tokens = estimate_tokens(m) + sum(context_window.tokens(c) for c in turn.history)
+                    usage.meter.record(turn.backend.model, prompt_tokens=prompt_tokens, response_tokens=estimate_tokens(reply.text))
+                if key:
+                    response_cache.cache.put(key, model_type, reply.text, latency=time.perf_counter() - timer.started)
+
+            write_back(chat_dict, kind, user_id, state, turn.complete(m, reply.text) if reply.text else None, [
+                types.UserContent(parts=[types.Part.from_text(text=m)]),
+                types.ModelContent(parts=[types.Part.from_text(text=reply.text)]),
+            ])
+        await reply.finish()
+
     except Exception as e:
-        await bot.send_message(message.chat.id, e.str())
-    for part in response.candidates[0].content.parts:
-        if part.text is not None:
-            await bot.send_message(message.chat.id, escape(part.text), parse_mode="MarkdownV2")
-        elif part.inline_data is not None:
-            photo = part.inline_data.data
-            await bot.send_photo(message.chat.id, photo)
+        timer.error()
+        logger.exception(f"Streaming {model_type} answer failed")
+        await reply.fail(message, e)
 
-async def gemini_draw(bot:TeleBot, message:Message, m:str):
-    chat_dict = gemini_draw_dict
-    if str(message.from_user.id) not in chat_dict:
-        chat = client.aio.chats.create(
+async def _send_image_after(previous, bot:TeleBot, chat_id, data:bytes, photo_ids:list):
+    """Sends data once the previous image went out, so images arrive in generation order without blocking the stream."""
+    if previous is not None:
+        await asyncio.gather(previous, return_exceptions=True)
+    sent = await file_cache.send_photo(bot, chat_id, data)
+    if sent.photo:
+        photo_ids.append(sent.photo[-1].file_id)
+
+async def stream_multimodal(bot:TeleBot, message:Message, reply:StreamReply, response, timer):
+    """Streams text parts into reply and sends each image part as soon as it has arrived. Returns the model's parts."""
+    parts = []
+    image_task = None
+    try:
+        async for chunk in response:
+            timer.chunk()
+            if not chunk.candidates or not chunk.candidates[0].content:
+                continue
+            for part in chunk.candidates[0].content.parts or ():
+                if part.text:
+                    await reply.feed(part.text)
+                    if parts and parts[-1].text is not None:
+                        parts[-1] = types.Part.from_text(text=parts[-1].text + part.text)
+                    else:
+                        parts.append(types.Part.from_text(text=part.text))
+                elif part.inline_data is not None and part.inline_data.data:
+                    metrics.mark("first_image" if image_task is None else "image")
+                    image_task = asyncio.create_task(_send_image_after(image_task, bot, message.chat.id, part.inline_data.data, reply.photo_ids))
+                    parts.append(part)
+        timer.finish()
+    finally:
+        if image_task is not None:
+            await image_task
+    return parts
+
+def count_images(parts) -> int:
+    return sum(1 for part in parts if part.inline_data is not None)
+
+async def gemini_edit(bot: TeleBot, message: Message, m: str, photo_files: list):
+    """One multimodal request with the prompt and every photo (several for an album)."""
+    reply = StreamReply(bot, None)
+    timer = metrics.StreamTimer(model_1)
+    try:
+        reply.sent_message = await bot.reply_to(message, "🤖 Generating answers...")
+        processed = await asyncio.gather(*(images.preprocess(photo_file) for photo_file in photo_files))
+        contents = [m] + [types.Part.from_bytes(data=image, mime_type=mime_type) for image, mime_type in processed]
+        response = key_pool.stream(lambda c: c.aio.models.generate_content_stream(
             model=model_1,
-            config=generation_config,
-        )
-        chat_dict[str(message.from_user.id)] = chat
-    else:
-        chat = chat_dict[str(message.from_user.id)]
-
-    response = await chat.send_message(m)
-    for part in response.candidates[0].content.parts:
-        if part.text is not None:
-            text = part.text
-            while len(text) > 4000:
-                await bot.send_message(message.chat.id, escape(text[:4000]), parse_mode="MarkdownV2")
-                text = text[4000:]
-            if text:
-                await bot.send_message(message.chat.id, escape(text), parse_mode="MarkdownV2")
-        elif part.inline_data is not None:
-            photo = part.inline_data.data
-            await bot.send_photo(message.chat.id, photo)
\ No newline at end of file
+            contents=contents,
+            config=generation_config
+        ), estimate_tokens(m) + len(processed) * conf["context_image_tokens"], model=model_1)
+        parts = await stream_multimodal(bot, message, reply, response, timer)
+        usage.meter.record(model_1, images=count_images(parts), requests=0)
+        await reply.finish()
+    except Exception as e:
+        timer.error()
+        logger.exception("Photo edit failed")
+        await reply.fail(message, e)
+
+async def gemini_draw(bot:TeleBot, message:Message, m:str):
+    reply = StreamReply(bot, None)
+    timer = metrics.StreamTimer(model_1)
+    try:
+        reply.sent_message = await bot.reply_to(message, "Drawing...")
+        user_id = str(message.from_user.id)
+        with running(user_id) as state:
+            turn = ChatTurn(await get_chat(gemini_draw_dict, "draw", user_id, model_1, generation_config), model_1, generation_config, f"draw:{user_id}")
+            key = cache_key(turn, m)
+            if key and await replay_cached(bot, message, reply, key):
+                # The history keeps a placeholder for images served by file_id
+                parts = ([types.Part.from_text(text=reply.text)] if reply.text else [])
+                parts += [types.Part.from_text(text=IMAGE_PLACEHOLDER) for _ in reply.photo_ids]
+            else:
+                response = key_pool.stream(lambda c: turn.fork(c).send_message_stream(m), estimate_tokens(m), model=model_1)
+                parts = await stream_multimodal(bot, message, reply, response, timer)
+                usage.meter.record(model_1, images=count_images(parts), requests=0)
+                if key and len(reply.photo_ids) == count_images(parts):
+                    response_cache.cache.put(key, model_1, reply.text, reply.photo_ids, latency=time.perf_counter() - timer.started)
+            write_back(gemini_draw_dict, "draw", user_id, state, turn.complete(m, reply.text, parts) if parts else None, [
+                types.UserContent(parts=[types.Part.from_text(text=m)]),
+                types.ModelContent(parts=parts),
+            ])
+        await reply.finish()
+    except Exception as e:
+        timer.error()
+        logger.exception("Drawing failed")
+        await reply.fail(message, e)
@@ -1,21 +1,112 @@
+import time
+import asyncio
+import logging
+import datetime
 from telebot import TeleBot
 from telebot.types import Message
-from md2tgmd import escape
-import traceback
+from renderer import escape
 from config import conf
 import gemini
+import history
+import images
+import file_cache
+import albums
+from admission import admission, QueueFull
+import metrics
+import usage
+import logs
+
+logger = logging.getLogger(__name__)
 
 error_info              =       conf["error_info"]
 before_generate_info    =       conf["before_generate_info"]
 download_pic_notify     =       conf["download_pic_notify"]
 model_1                 =       conf["model_1"]
 model_2                 =       conf["model_2"]
+busy_info               =       conf["busy_info"]
+quota_info              =       conf["quota_info"]
 
 gemini_chat_dict        = gemini.gemini_chat_dict
 gemini_pro_chat_dict    = gemini.gemini_pro_chat_dict
 default_model_dict      = gemini.default_model_dict
 gemini_draw_dict        = gemini.gemini_draw_dict
 
+COMMANDS = {"start", "gemini", "gemini_pro", "draw", "edit", "clear", "switch", "usage"}
+
+_admin_id = None
+
+def admin_id() -> str:
+    """conf["admin_id"], else CONSTANTS.ADMIN_ID."""
+    global _admin_id
+    if _admin_id is None:
+        _admin_id = conf["admin_id"]
+        if _admin_id is None:
+            try:
+                # CONSTANTS reads every provider key from the environment on import
+                from CONSTANTS import ADMIN_ID
+                _admin_id = ADMIN_ID
+            except KeyError as e:
+                logger.warning(f"CONSTANTS.py can't be imported ({e!r} not set), set conf['admin_id'] for /usage")
+                _admin_id = ""
+    return str(_admin_id)
+
+async def over_quota(user_id: str, kind: str):
+    """The daily quota the user has used up, or None. Fails open if usage can't be read."""
+    if user_id == admin_id():
+        return None
+    try:
+        return await usage.meter.exceeded(user_id, images=kind in ("draw", "edit"))
+    except Exception as e:
+        logger.warning(f"Quota check for {user_id} failed, allowing the request: {e}")
+        return None
+
+def command_of(message: Message) -> str:
+    """Metrics label for the command a message invokes."""
+    text = message.text or message.caption or ""
+    if text.startswith("/"):
+        command = text.split(maxsplit=1)[0][1:].split("@")[0]
+        return command if command in COMMANDS else "other"
+    return "photo" if message.photo else "private"
+
+async def admitted(message: Message, bot: TeleBot, kind: str, model: str, call) -> None:
+    """Runs call() once the user's session and the model have a free slot, or sheds it with busy_info."""
+    command = command_of(message)
+    metrics.command_var.set(command)
+    trace = metrics.Trace(command, model) if conf["trace_requests"] else None
+    metrics.trace_var.set(trace)
+    started = time.perf_counter()
+    outcome = "ok"
+    user_id = str(message.from_user.id)
+    usage.user_var.set(user_id)
+    logs.bind(request_id=f"{message.chat.id}-{message.message_id}", user=user_id, chat=message.chat.id, command=command, model=model)
+    try:
+        if await over_quota(user_id, kind):
+            outcome = "quota"
+            await bot.reply_to(message, quota_info)
+            return
+        async with admission.admit(f"{kind}:{message.from_user.id}", model) as waited:
+            metrics.queue_wait.observe(waited, command=command, model=model)
+            metrics.mark("admitted")
+            await call()
+    except QueueFull:
+        outcome = "shed"
+        metrics.requests_shed.inc(command=command, model=model)
+        await bot.reply_to(message, busy_info)
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        metrics.request_duration.observe(time.perf_counter() - started, command=command, model=model, outcome=outcome)
+        if trace:
+            trace.finish(outcome)
+
+async def download_photo(message: Message, bot: TeleBot) -> bytes:
+    return await file_cache.download(bot, images.pick_photo(message.photo))
+
+async def download_photos(messages: list, bot: TeleBot) -> list:
+    """Downloads the photos of several messages (an album) concurrently."""
+    return list(await asyncio.gather(*(download_photo(msg, bot) for msg in messages)))
+
 async def start(message: Message, bot: TeleBot) -> None:
     try:
         await bot.reply_to(message , escape("Welcome, you can ask me questions now. \nFor example: `Who is john lennon?`"), parse_mode="MarkdownV2")
@@ -28,7 +119,7 @@ async def gemini_stream_handler(message: Message, bot: TeleBot) -> None:
     except IndexError:
         await bot.reply_to(message, escape("Please add what you want to say after /gemini. \nFor example: `/gemini Who is john lennon?`"), parse_mode="MarkdownV2")
         return
-    await gemini.gemini_stream(bot, message, m, model_1)
+    await admitted(message, bot, "chat", model_1, lambda: gemini.gemini_stream(bot, message, m, model_1))
 
 async def gemini_pro_stream_handler(message: Message, bot: TeleBot) -> None:
     try:
@@ -36,9 +127,11 @@ async def gemini_pro_stream_handler(message: Message, bot: TeleBot) -> None:
     except IndexError:
         await bot.reply_to(message, escape("Please add what you want to say after /gemini_pro. \nFor example: `/gemini_pro Who is john lennon?`"), parse_mode="MarkdownV2")
         return
-    await gemini.gemini_stream(bot, message, m, model_2)
+    await admitted(message, bot, "pro", model_2, lambda: gemini.gemini_stream(bot, message, m, model_2))
 
 async def clear(message: Message, bot: TeleBot) -> None:
+    # Turns still running must not write the old sessions back once they finish
+    gemini.mark_cleared(str(message.from_user.id))
     # Check if the chat is already in gemini_chat_dict.
     if (str(message.from_user.id) in gemini_chat_dict):
         del gemini_chat_dict[str(message.from_user.id)]
@@ -46,8 +139,25 @@ async def clear(message: Message, bot: TeleBot) -> None:
         del gemini_pro_chat_dict[str(message.from_user.id)]
     if (str(message.from_user.id) in gemini_draw_dict):
         del gemini_draw_dict[str(message.from_user.id)]
+    for kind in ("chat", "pro", "draw"):
+        gemini.context_window.forget(f"{kind}:{message.from_user.id}")
+    await history.store.clear(str(message.from_user.id))
+    # Turns that started during the DELETE may have loaded the old history
+    gemini.mark_cleared(str(message.from_user.id))
     await bot.reply_to(message, "Your history has been cleared")
 
+async def usage_report(message: Message, bot: TeleBot) -> None:
+    """/usage [YYYY-MM-DD]: per model totals and top users of a day, for the admin only."""
+    if str(message.from_user.id) != admin_id():
+        return
+    args = message.text.strip().split(maxsplit=1)
+    try:
+        day = datetime.date.fromisoformat(args[1].strip()) if len(args) > 1 else None
+    except ValueError:
+        await bot.reply_to(message, "Usage: /usage [YYYY-MM-DD]")
+        return
+    await bot.reply_to(message, await usage.meter.report(day))
+
 async def switch(message: Message, bot: TeleBot) -> None:
     if message.chat.type != "private":
         await bot.reply_to( message , "This command is only for private chat !")
@@ -68,38 +178,44 @@ async def gemini_private_handler(message: Message, bot: TeleBot) -> None:
     m = message.text.strip()
     if str(message.from_user.id) not in default_model_dict:
         default_model_dict[str(message.from_user.id)] = True
-        await gemini.gemini_stream(bot,message,m,model_1)
+        await admitted(message, bot, "chat", model_1, lambda: gemini.gemini_stream(bot,message,m,model_1))
     else:
         if default_model_dict[str(message.from_user.id)]:
-            await gemini.gemini_stream(bot,message,m,model_1)
+            await admitted(message, bot, "chat", model_1, lambda: gemini.gemini_stream(bot,message,m,model_1))
         else:
-            await gemini.gemini_stream(bot,message,m,model_2)
+            await admitted(message, bot, "pro", model_2, lambda: gemini.gemini_stream(bot,message,m,model_2))
 
 async def gemini_photo_handler(message: Message, bot: TeleBot) -> None:
+    messages = [message]
+    if message.media_group_id:
+        messages = await albums.collector.collect(message)
+        if messages is None:
+            # Another photo of the album collects it and sends one request for all of them
+            return
+        # Only one photo of an album carries the caption
+        message = next((msg for msg in messages if msg.caption), messages[0])
     if message.chat.type != "private":
         s = message.caption or ""
         if not s or not (s.startswith("/gemini")):
             return
         try:
             m = s.strip().split(maxsplit=1)[1].strip() if len(s.strip().split(maxsplit=1)) > 1 else ""
-            file_path = await bot.get_file(message.photo[-1].file_id)
-            photo_file = await bot.download_file(file_path.file_path)
+            photo_files = await download_photos(messages, bot)
         except Exception:
-            traceback.print_exc()
+            logger.exception("Downloading photo failed")
             await bot.reply_to(message, error_info)
             return
-        await gemini.gemini_edit(bot, message, m, photo_file)
+        await admitted(message, bot, "edit", model_1, lambda: gemini.gemini_edit(bot, message, m, photo_files))
     else:
         s = message.caption or ""
         try:
             m = s.strip().split(maxsplit=1)[1].strip() if len(s.strip().split(maxsplit=1)) > 1 else ""
-            file_path = await bot.get_file(message.photo[-1].file_id)
-            photo_file = await bot.download_file(file_path.file_path)
+            photo_files = await download_photos(messages, bot)
         except Exception:
-            traceback.print_exc()
+            logger.exception("Downloading photo failed")
             await bot.reply_to(message, error_info)
             return
-        await gemini.gemini_edit(bot, message, m, photo_file)
+        await admitted(message, bot, "edit", model_1, lambda: gemini.gemini_edit(bot, message, m, photo_files))
 
 async def gemini_edit_handler(message: Message, bot: TeleBot) -> None:
     if not message.photo:
@@ -108,13 +224,12 @@ async def gemini_edit_handler(message: Message, bot: TeleBot) -> None:
     s = message.caption or ""
     try:
         m = s.strip().split(maxsplit=1)[1].strip() if len(s.strip().split(maxsplit=1)) > 1 else ""
-        file_path = await bot.get_file(message.photo[-1].file_id)
-        photo_file = await bot.download_file(file_path.file_path)
+        photo_file = await download_photo(message, bot)
     except Exception as e:
-        traceback.print_exc()
-        await bot.reply_to(message, e.str())
+        logger.exception("Downloading photo failed")
+        await bot.reply_to(message, str(e))
         return
-    await gemini.gemini_edit(bot, message, m, photo_file)
+    await admitted(message, bot, "edit", model_1, lambda: gemini.gemini_edit(bot, message, m, [photo_file]))
 
 async def draw_handler(message: Message, bot: TeleBot) -> None:
     try:
@@ -122,10 +237,5 @@ async def draw_handler(message: Message, bot: TeleBot) -> None:
     except IndexError:
         await bot.reply_to(message, escape("Please add what you want to draw after /draw. \nFor example: `/draw draw me a cat.`"), parse_mode="MarkdownV2")
         return
-    
-    # reply to the message first, then delete the "drawing..." message
-    drawing_msg = await bot.reply_to(message, "Drawing...")
-    try:
-        await gemini.gemini_draw(bot, message, m)
-    finally:
-        await bot.delete_message(chat_id=message.chat.id, message_id=drawing_msg.message_id)
+    # gemini_draw owns the "Drawing..." placeholder: streamed text replaces it, and it is deleted if only images come back
+    await admitted(message, bot, "draw", model_1, lambda: gemini.gemini_draw(bot, message, m))
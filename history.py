@@ -0,0 +1,136 @@
+import json
+import asyncio
+import logging
+from lazy import lazy_module
+from config import conf
+from context import IMAGE_PLACEHOLDER
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+types = lazy_module("google.genai.types")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_history (
+    id          BIGSERIAL PRIMARY KEY,
+    user_id     TEXT NOT NULL,
+    kind        TEXT NOT NULL,
+    content     JSONB NOT NULL,
+    created_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS chat_history_user_kind_id_idx ON chat_history (user_id, kind, id);
+"""
+
+db.prepare("history_load", "SELECT content FROM (SELECT id, content FROM chat_history WHERE user_id = $1 AND kind = $2 "
+                           "ORDER BY id DESC LIMIT $3) newest ORDER BY id")
+db.prepare("history_clear", "DELETE FROM chat_history WHERE user_id = $1")
+
+class HistoryStore:
+    """Write-behind store for chat turns.
+
+    append() only queues rows in memory; a background task writes them in a
+    single multi-row INSERT every flush_interval, so the streaming path never
+    waits on the database.
+    """
+
+    def __init__(self, flush_interval=2.0, max_batch=500, max_pending=20000, load_limit=200):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.load_limit = load_limit
+        self.max_pending = max_pending
+        self._pending = []  # (user_id, kind, content json)
+        self._flush_lock = asyncio.Lock()
+        self._flush_soon = asyncio.Event()
+        self._task = None
+        self.metrics = {"rows_written": 0, "flushes": 0, "flush_errors": 0, "rows_dropped": 0, "loads": 0}
+
+    async def start(self):
+        await db.execute(SCHEMA)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        await self.flush()
+
+    def append(self, user_id, kind, contents):
+        """Queues turns for user_id; never blocks. Inline images are stored as a placeholder, not their bytes."""
+        for content in contents:
+            if any(part.inline_data is not None for part in content.parts or ()):
+                content = types.Content(role=content.role, parts=[
+                    types.Part.from_text(text=IMAGE_PLACEHOLDER) if part.inline_data is not None else part
+                    for part in content.parts
+                ])
+            self._pending.append((user_id, kind, json.dumps(content.model_dump(mode="json", exclude_none=True))))
+        if len(self._pending) > self.max_pending:
+            dropped = len(self._pending) - self.max_pending
+            del self._pending[:dropped]
+            self.metrics["rows_dropped"] += dropped
+            logger.error(f"History write-behind buffer full, dropped {dropped} oldest rows")
+        if len(self._pending) >= self.max_batch:
+            self._flush_soon.set()
+
+    def request_flush(self):
+        self._flush_soon.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_soon.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_soon.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Writes every queued row; False if a batch failed and rows are still queued."""
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[:self.max_batch]
+                del self._pending[:len(batch)]
+                values = ", ".join(["(%s, %s, %s::jsonb)"] * len(batch))
+                args = [v for row in batch for v in row]
+                try:
+                    await db.execute(f"INSERT INTO chat_history (user_id, kind, content) VALUES {values}", *args)
+                except Exception as e:
+                    # Put the batch back in front and retry on the next tick
+                    self._pending[:0] = batch
+                    self.metrics["flush_errors"] += 1
+                    logger.error(f"History flush of {len(batch)} rows failed: {e}")
+                    return False
+                self.metrics["rows_written"] += len(batch)
+                self.metrics["flushes"] += 1
+            return True
+
+    async def load(self, user_id, kind):
+        """Returns the newest load_limit stored turns for user_id/kind, including ones not flushed yet."""
+        self.metrics["loads"] += 1
+        # Under the flush lock: a batch being flushed is out of _pending but maybe not committed yet
+        async with self._flush_lock:
+            rows = await db.execute_prepared("history_load", user_id, kind, self.load_limit, fetch=True) or []
+            pending = [c for u, k, c in self._pending if u == user_id and k == kind]
+        contents = [types.Content.model_validate(row[0]) for row in rows]
+        contents += [types.Content.model_validate_json(c) for c in pending]
+        contents = contents[-self.load_limit:]
+        # Start at a user turn, not at the model half of an exchange the limit cut through
+        while contents and contents[0].role != "user":
+            contents.pop(0)
+        return contents
+
+    async def clear(self, user_id):
+        """Deletes every stored turn for user_id with one indexed DELETE."""
+        async with self._flush_lock:
+            self._pending = [row for row in self._pending if row[0] != user_id]
+            await db.execute_prepared("history_clear", user_id)
+
+    def stats(self):
+        return dict(self.metrics, pending=len(self._pending))
+
+store = HistoryStore(
+    flush_interval=conf["history_flush_interval"],
+    max_batch=conf["history_max_batch"],
+    load_limit=conf["history_load_limit"],
+)
+
+metrics.stats_gauge("history_store", "Chat history write-behind state and totals", store.stats)
@@ -0,0 +1,62 @@
+import io
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from lazy import lazy_module
+from config import conf
+import metrics
+
+logger = logging.getLogger(__name__)
+
+Image = lazy_module("PIL.Image")
+ImageOps = lazy_module("PIL.ImageOps")
+
+# Pillow releases the GIL while decoding, resampling and encoding, so threads are enough
+_executor = ThreadPoolExecutor(max_workers=conf["image_workers"], thread_name_prefix="image")
+
+totals = {"images": 0, "bytes_in": 0, "bytes_out": 0, "process_time_total": 0.0, "passthrough": 0, "download_bytes_saved": 0}
+
+metrics.stats_gauge("image_preprocessing", "Image preprocessing totals", lambda: totals)
+
+def pick_photo(photos, target_side=None):
+    """Smallest Telegram PhotoSize whose longer side reaches target_side, else the largest one."""
+    target_side = target_side or conf["image_target_side"]
+    largest = max(photos, key=lambda p: p.width * p.height)
+    for photo in sorted(photos, key=lambda p: p.width * p.height):
+        if max(photo.width, photo.height) >= target_side:
+            totals["download_bytes_saved"] += (largest.file_size or 0) - (photo.file_size or 0)
+            return photo
+    return largest
+
+def _process(data, max_side, fmt, quality):
+    image = Image.open(io.BytesIO(data))
+    source_mime = Image.MIME.get(image.format, "image/jpeg")
+    image = ImageOps.exif_transpose(image)
+    resized = max(image.size) > max_side
+    if resized:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if fmt == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    out = io.BytesIO()
+    image.save(out, format=fmt, quality=quality)
+    encoded = out.getvalue()
+    if not resized and len(encoded) >= len(data):
+        # Already small: re-encoding would only cost quality
+        return data, source_mime, False
+    return encoded, Image.MIME[fmt], True
+
+async def preprocess(data):
+    """Downscales and re-encodes an image off the event loop. Returns (bytes, mime_type)."""
+    started = time.perf_counter()
+    processed, mime_type, changed = await asyncio.get_running_loop().run_in_executor(
+        _executor, _process, data, conf["image_max_side"], conf["image_format"], conf["image_quality"])
+    elapsed = time.perf_counter() - started
+    totals["images"] += 1
+    totals["bytes_in"] += len(data)
+    totals["bytes_out"] += len(processed)
+    totals["process_time_total"] += elapsed
+    if not changed:
+        totals["passthrough"] += 1
+    logger.info(f"Image preprocessed: {len(data)} -> {len(processed)} bytes in {elapsed * 1000:.1f} ms")
+    return processed, mime_type
@@ -0,0 +1,220 @@
+import re
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from lazy import lazy_module
+
+logger = logging.getLogger(__name__)
+
+genai = lazy_module("google.genai")
+errors = lazy_module("google.genai.errors")
+
+WINDOW = 60.0  # RPM/TPM budgets are per rolling minute
+
+def parse_keys(raw):
+    """Splits GEMINI_API_KEYS on commas or whitespace, dropping duplicates."""
+    keys = []
+    for key in re.split(r"[,\s]+", raw or ""):
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+class _Key:
+    def __init__(self, api_key, client_factory):
+        self.api_key = api_key
+        self._client_factory = client_factory
+        self._client = None
+        self.requests = deque()  # request timestamps in the current window
+        self.tokens = deque()    # (timestamp, tokens) in the current window
+        self.cooldown_until = 0.0
+        self.metrics = {"requests": 0, "tokens": 0, "rate_limited": 0, "unavailable": 0, "errors": 0}
+
+    @property
+    def client(self):
+        """Created on first use: building clients for every key at import slows down startup."""
+        if self._client is None:
+            self._client = self._client_factory(self.api_key)
+        return self._client
+
+    @property
+    def name(self):
+        return "..." + self.api_key[-4:]
+
+    def trim(self, now):
+        while self.requests and now - self.requests[0] > WINDOW:
+            self.requests.popleft()
+        while self.tokens and now - self.tokens[0][0] > WINDOW:
+            self.tokens.popleft()
+
+    def used_tokens(self):
+        return max(sum(n for _, n in self.tokens), 0)
+
+class KeyPool:
+    """Routes Gemini calls across several API keys.
+
+    Each key has a rolling one-minute request and token budget. A call goes to
+    the key with the most headroom; keys that answer 429/503 are cooled down
+    and the call is retried on another key with jittered exponential backoff.
+    Streams are only retried before their first chunk, so nothing the user has
+    already seen is repeated.
+    """
+
+    RETRYABLE = (429, 503)
+
+    def __init__(self, api_keys, rpm=15, tpm=1_000_000, max_retries=3, backoff=1.0,
+                 cooldown_429=30.0, cooldown_503=5.0, max_wait=20.0, client_factory=None, on_usage=None):
+        if not api_keys:
+            raise ValueError("At least one Gemini API key is required")
+        client_factory = client_factory or (lambda api_key: genai.Client(api_key=api_key))
+        self.keys = [_Key(k, client_factory) for k in api_keys]
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cooldown_429 = cooldown_429
+        self.cooldown_503 = cooldown_503
+        self.max_wait = max_wait
+        self.on_usage = on_usage  # on_usage(model, usage_metadata, estimated_tokens, requests) after every call that names its model, finished or not
+
+    @property
+    def client(self):
+        """Any client, for calls that don't count against the budgets."""
+        return self.keys[0].client
+
+    def _headroom(self, key, estimated_tokens):
+        return min(
+            (self.rpm - len(key.requests)) / self.rpm,
+            (self.tpm - key.used_tokens() - estimated_tokens) / self.tpm,
+        )
+
+    def _ready_in(self, key, now):
+        """Seconds until key may take another request."""
+        wait = key.cooldown_until - now
+        if len(key.requests) >= self.rpm:
+            wait = max(wait, key.requests[0] + WINDOW - now)
+        return max(wait, 0.0)
+
+    async def acquire(self, estimated_tokens=0, exclude=()):
+        """Picks the key with the most headroom, waiting (bounded) if all are exhausted."""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            now = time.monotonic()
+            candidates = [k for k in self.keys if k not in exclude] or self.keys
+            for key in candidates:
+                key.trim(now)
+            ready = [k for k in candidates if self._ready_in(k, now) == 0]
+            if ready:
+                key = max(ready, key=lambda k: self._headroom(k, estimated_tokens))
+                break
+            key = min(candidates, key=lambda k: self._ready_in(k, now))
+            wait = self._ready_in(key, now)
+            if now + wait > deadline:
+                # Out of budget everywhere: let the API decide rather than stall forever
+                break
+            await asyncio.sleep(wait)
+        key.requests.append(now)
+        key.tokens.append((now, estimated_tokens))
+        key.metrics["requests"] += 1
+        return key
+
+    def record_usage(self, key, usage_metadata, estimated_tokens=0, model=None, requests=1):
+        """Replaces the up-front token estimate with the real count from the response."""
+        if self.on_usage and model:
+            self.on_usage(model, usage_metadata, estimated_tokens, requests)
+        total = getattr(usage_metadata, "total_token_count", None) if usage_metadata else None
+        if total is None:
+            return
+        key.tokens.append((time.monotonic(), total - estimated_tokens))
+        key.metrics["tokens"] += total
+
+    def _on_error(self, key, e):
+        """Cools key down for retryable errors. Returns True if the call may be retried."""
+        code = getattr(e, "code", None) if isinstance(e, errors.APIError) else None
+        if code == 429:
+            key.metrics["rate_limited"] += 1
+            key.cooldown_until = time.monotonic() + self.cooldown_429
+        elif code == 503:
+            key.metrics["unavailable"] += 1
+            key.cooldown_until = time.monotonic() + self.cooldown_503
+        else:
+            key.metrics["errors"] += 1
+        if code in self.RETRYABLE:
+            logger.warning(f"Gemini key {key.name} returned {code}, cooling down")
+            return True
+        return False
+
+    async def _sleep_before_retry(self, attempt):
+        await asyncio.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    async def call(self, fn, estimated_tokens=0, model=None):
+        """Awaits fn(client) on the best key, retrying on another key after 429/503."""
+        tried = []
+        for attempt in range(self.max_retries + 1):
+            key = await self.acquire(estimated_tokens, exclude=tried)
+            try:
+                response = await fn(key.client)
+            except Exception as e:
+                if not self._on_error(key, e) or attempt == self.max_retries:
+                    raise
+                tried.append(key)
+                await self._sleep_before_retry(attempt)
+                continue
+            except BaseException:
+                # Cancelled while waiting: the request went out all the same
+                self.record_usage(key, None, estimated_tokens, model)
+                raise
+            self.record_usage(key, getattr(response, "usage_metadata", None), estimated_tokens, model)
+            return response
+
+    async def stream(self, fn, estimated_tokens=0, model=None, tried=None, requests=None):
+        """Async generator over the chunks of await fn(client), retried only before the first chunk.
+
+        tried lists the keys to avoid and gets every key used appended, so a
+        hedge of the same turn sharing the list goes to another key. requests,
+        if given, is called when the call ends for the requests to meter it as.
+        """
+        tried = [] if tried is None else tried
+        for attempt in range(self.max_retries + 1):
+            key = await self.acquire(estimated_tokens, exclude=tried)
+            tried.append(key)
+            try:
+                response = await fn(key.client)
+                first = await response.__anext__()
+            except StopAsyncIteration:
+                self.record_usage(key, None, estimated_tokens, model, requests() if requests else 1)
+                return
+            except Exception as e:
+                if not self._on_error(key, e) or attempt == self.max_retries:
+                    raise
+                await self._sleep_before_retry(attempt)
+                continue
+            except BaseException:
+                # Cancelled before the first chunk (e.g. the hedge lost): the request went out all the same
+                self.record_usage(key, None, estimated_tokens, model, requests() if requests else 1)
+                raise
+            break
+        usage = first.usage_metadata
+        try:
+            yield first
+            async for chunk in response:
+                usage = chunk.usage_metadata or usage
+                yield chunk
+        finally:
+            # Also when the consumer closes the stream early, with the usage of the last chunk read
+            self.record_usage(key, usage, estimated_tokens, model, requests() if requests else 1)
+
+    def stats(self):
+        now = time.monotonic()
+        result = []
+        for key in self.keys:
+            key.trim(now)
+            result.append(dict(
+                key.metrics,
+                key=key.name,
+                window_requests=len(key.requests),
+                window_tokens=key.used_tokens(),
+                cooling_down=key.cooldown_until > now,
+            ))
+        return result
@@ -0,0 +1,52 @@
+import sys
+import time
+import logging
+import importlib
+import threading
+
+logger = logging.getLogger(__name__)
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access.
+
+    `types = lazy_module("google.genai.types")` keeps call sites like
+    `types.Part.from_text(...)` unchanged while moving the import cost from
+    process start to the first request that needs it.
+    """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            module = self.__dict__["_module"] = importlib.import_module(self._name)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_module"] is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+def lazy_module(name):
+    """The module itself if it is already imported, else a LazyModule for it."""
+    return sys.modules.get(name) or LazyModule(name)
+
+def _warm(names):
+    for name in names:
+        started = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            logger.warning(f"Background import of {name} failed: {e!r}")
+            continue
+        logger.info(f"Imported {name} in the background in {time.perf_counter() - started:.2f}s")
+
+def warm(*names):
+    """Imports modules on a daemon thread, so they are ready before the first request without delaying startup."""
+    names = [n for n in names if n not in sys.modules]
+    if names:
+        threading.Thread(target=_warm, args=(names,), name="warm-imports", daemon=True).start()
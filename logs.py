@@ -0,0 +1,163 @@
+import re
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import contextvars
+import logging.handlers
+from config import conf
+
+# Fields of the request being handled (request_id, user, chat, command, model), added to every record logged under it
+context_var = contextvars.ContextVar("log_context", default={})
+
+# LogRecord attributes that aren't user-supplied extras
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "context", "suppressed"}
+
+def bind(**fields):
+    """Adds fields to the log context of the current task (and the tasks it starts)."""
+    context_var.set({**context_var.get(), **fields})
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, request context, extras and traceback."""
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "context", None) or {})
+        entry.update({k: v for k, v in vars(record).items() if k not in _RESERVED})
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class TextFormatter(logging.Formatter):
+    """The classic format, with the request context appended."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(levelname)s - %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = dict(getattr(record, "context", None) or {})
+        if getattr(record, "suppressed", 0):
+            fields["suppressed"] = record.suppressed
+        if fields:
+            head, sep, rest = line.partition("\n")
+            line = head + " [" + " ".join(f"{k}={v}" for k, v in fields.items()) + "]" + sep + rest
+        return line
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most `burst` similar warnings/errors through per `window` seconds.
+
+    Records are similar when logger, level and message match once numbers are
+    masked, so "message is not modified" for a thousand different chats counts
+    as one kind. The first record let through after a quiet spell carries the
+    number of suppressed ones.
+    """
+
+    _NUMBERS = re.compile(r"\d+")
+
+    def __init__(self, window=60.0, burst=5, level=logging.WARNING, max_keys=10000):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.level = level
+        self.max_keys = max_keys
+        self._seen = {}  # key -> [window start, count in window, suppressed since last emitted]
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.name, record.levelno, self._NUMBERS.sub("#", str(record.msg))[:200])
+        now = time.monotonic()
+        entry = self._seen.get(key)
+        if entry is None or now - entry[0] >= self.window:
+            if entry is None and len(self._seen) >= self.max_keys:
+                self._seen.clear()
+            suppressed = entry[2] if entry else 0
+            self._seen[key] = entry = [now, 0, 0]
+            if suppressed:
+                record.suppressed = suppressed
+        entry[1] += 1
+        if entry[1] > self.burst:
+            entry[2] += 1
+            self.suppressed += 1
+            return False
+        return True
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on a bounded in-process queue without ever blocking the caller.
+
+    The request context is captured here, in the task that logs; formatting,
+    tracebacks and the write itself happen on the listener thread. When the
+    queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.context = context_var.get()
+        # Render lazy %-args now, their values may change once the caller moves on
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_queue = None
+_handler = None
+_listener = None
+_rate_limit = None
+
+def setup(level=None, fmt=None, stream=None, queue_size=None, window=None, burst=None):
+    """Routes all logging through a queue to a writer thread. Safe to call again (e.g. from tests)."""
+    global _queue, _handler, _listener, _rate_limit
+    stop()
+    level = level or conf["log_level"]
+    fmt = fmt or conf["log_format"]
+    _queue = queue.Queue(queue_size or conf["log_queue_size"])
+    _handler = ContextQueueHandler(_queue)
+    _rate_limit = RateLimitFilter(window=window or conf["log_rate_window"], burst=burst or conf["log_rate_burst"])
+    _handler.addFilter(_rate_limit)
+    writer = logging.StreamHandler(stream or sys.stderr)
+    writer.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    logging.captureWarnings(True)
+    _listener = logging.handlers.QueueListener(_queue, writer, respect_handler_level=False)
+    _listener.start()
+
+def stop():
+    """Writes out what is still queued and stops the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(stop)
+
+def stats():
+    return {
+        "queued": _queue.qsize() if _queue else 0,
+        "dropped": _handler.dropped if _handler else 0,
+        "suppressed": _rate_limit.suppressed if _rate_limit else 0,
+    }
@@ -1,4 +1,12 @@
 import asyncio
+import logs
+
+if __name__ == '__main__':
+    # Before the imports below, some of which log on import. Not when imported (benchmarks/ keep their own setup)
+    logs.setup()
+
+import hashlib
+import json
 import telebot
 from telebot.async_telebot import AsyncTeleBot
 import handlers
@@ -6,11 +14,21 @@ from config import conf, generation_config, safety_settings
 import logging
 import os
 import db
+import history
+import signal
+import webhook
+import metrics
+import shards
+import bot_state
+import usage
+import response_cache
+import lazy
+from edit_scheduler import scheduler as edit_scheduler
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+metrics.stats_gauge("logging", "Log records queued for the writer thread, dropped and rate-limited", logs.stats)
+
 try:
     # Fetching railway env - DO NOT MODIFY! THIS IS THE ONLY FORMAT THAT WORKS: `os.environ['VARIABLE_NAME']`
     telegram_token = os.environ['BOT_TOKEN']
@@ -22,35 +40,72 @@ except KeyError as e:
     raise ValueError(f"Critical environment variable {e} missing.") from e
 # --- END ---
 
-async def main():
-    # --- Test DB Connection ---
-    logger.info("Attempting database connection test...")
-    if not db.test_db_connection():
-        logger.critical("Database connection test failed. Exiting.")
-        # Decide if you want to exit if DB fails. Probably yes for persistence.
-        exit(1) # Uncomment this to make the bot stop if DB fails
-        # logger.warning("Proceeding without database functionality (if applicable).") # Or just warn and continue
-    else:
-        logger.info("Database connection test successful.")
-    # --- END ---
+# Set by the supervisor on the worker processes it spawns in sharded mode
+shard_index = os.environ.get('SHARD_INDEX')
 
-    # Init bot
-    bot = AsyncTeleBot(telegram_token)
-    await bot.delete_my_commands(scope=None, language_code=None)
-    await bot.set_my_commands(
-        commands=[
-            telebot.types.BotCommand("start", "Start"),
-            telebot.types.BotCommand("gemini", "using gemini-2.0-flash-exp"),
-            telebot.types.BotCommand("gemini_pro", "using gemini-1.5-pro"),
-            telebot.types.BotCommand("draw", "draw picture"),
-            telebot.types.BotCommand("edit", "edit photo"),
-            telebot.types.BotCommand("clear", "Clear history (DB if implemented)"), # Prep help text
-            telebot.types.BotCommand("switch","switch default model")
-        ],
-    )
+BOT_COMMANDS = [
+    telebot.types.BotCommand("start", "Start"),
+    telebot.types.BotCommand("gemini", "using gemini-2.0-flash-exp"),
+    telebot.types.BotCommand("gemini_pro", "using gemini-1.5-pro"),
+    telebot.types.BotCommand("draw", "draw picture"),
+    telebot.types.BotCommand("edit", "edit photo"),
+    telebot.types.BotCommand("clear", "Clear history"),
+    telebot.types.BotCommand("switch","switch default model")
+]
+
+def commands_hash(commands):
+    return hashlib.sha256(json.dumps([c.to_dict() for c in commands], sort_keys=True).encode()).hexdigest()
+
+async def sync_commands(bot: AsyncTeleBot, use_state=True):
+    """Registers BOT_COMMANDS, skipping the round-trip when the hash stored after the last registration matches.
+
+    set_my_commands replaces the whole list, so the menu is never empty in between.
+    """
+    key = f"commands:{telegram_token.split(':')[0]}"
+    digest = commands_hash(BOT_COMMANDS)
+    if use_state:
+        try:
+            if await bot_state.load(key) == digest:
+                logger.info("Bot commands unchanged, skipping registration.")
+                return
+        except Exception as e:
+            logger.warning(f"Could not read stored bot commands hash: {e}")
+    await bot.set_my_commands(commands=BOT_COMMANDS)
     logger.info("Bot commands set.")
+    if use_state:
+        try:
+            await bot_state.save(key, digest)
+        except Exception as e:
+            logger.warning(f"Could not store bot commands hash: {e}")
 
-    # Init commands
+async def start_storage():
+    """DB pool warm-up and history store. Returns False if the database is unreachable."""
+    if not await db.init_pool():
+        return False
+    await history.store.start()
+    await usage.meter.start()
+    await response_cache.cache.start()
+    return True
+
+async def setup_telegram(bot: AsyncTeleBot, storage_ready, register_commands):
+    """Telegram-side startup, overlapping the database warm-up where it doesn't need it."""
+    steps = []
+    if conf["ingress_mode"] != "webhook":
+        steps.append(bot.delete_webhook())
+    if register_commands:
+        async def commands():
+            # The stored hash lives in Postgres; register anyway if it is unavailable
+            await sync_commands(bot, use_state=await asyncio.shield(storage_ready))
+        steps.append(commands())
+    await asyncio.gather(*steps)
+
+# Imported lazily by gemini/images/renderer; loaded in the background once the bot is up
+WARM_IMPORTS = ("google.genai", "google.genai.types", "PIL.Image", "md2tgmd")
+
+def warm_imports():
+    lazy.warm(*WARM_IMPORTS)
+
+def register_handlers(bot: AsyncTeleBot):
     logger.info("Registering handlers...")
     bot.register_message_handler(handlers.start,                         commands=['start'],         pass_bot=True)
     bot.register_message_handler(handlers.gemini_stream_handler,         commands=['gemini'],        pass_bot=True)
@@ -59,6 +114,7 @@ async def main():
     bot.register_message_handler(handlers.gemini_edit_handler,           commands=['edit'],          pass_bot=True)
     bot.register_message_handler(handlers.clear,                         commands=['clear'],         pass_bot=True)
     bot.register_message_handler(handlers.switch,                        commands=['switch'],        pass_bot=True)
+    bot.register_message_handler(handlers.usage_report,                  commands=['usage'],         pass_bot=True)
     bot.register_message_handler(handlers.gemini_photo_handler,          content_types=["photo"],    pass_bot=True)
     bot.register_message_handler(
         handlers.gemini_private_handler,
@@ -67,9 +123,139 @@ async def main():
         pass_bot=True)
     logger.info("Handlers registered.")
 
+async def supervise():
+    """Sharded mode: receive updates here and forward them to conf["shard_workers"] worker processes."""
+    metrics.instrument_telegram()
+    metrics_runner = None
+    if conf["metrics_port"]:
+        metrics_runner = await metrics.start_server(conf["metrics_host"], conf["metrics_port"])
+
+    supervisor = shards.Supervisor(
+        telegram_token,
+        conf["shard_workers"],
+        base_port=conf["shard_base_port"],
+        path=conf["webhook_path"],
+        health_interval=conf["shard_health_interval"],
+        health_failures=conf["shard_health_failures"],
+        retry_timeout=conf["shard_retry_timeout"],
+    )
+    metrics.stats_gauge("shard_supervisor", "Sharded mode workers, forwarding and resizes", supervisor.stats)
+
+    # The supervisor has no database, so it can't compare against a stored hash; one set_my_commands overlaps worker startup
+    await asyncio.gather(sync_commands(supervisor, use_state=False), supervisor.start_workers())
+    supervisor.install_resize_signals()
+    try:
+        if conf["ingress_mode"] == "webhook":
+            logger.info(f"Starting supervisor webhook server for {supervisor.count} workers.")
+            server = webhook.WebhookServer(
+                supervisor,
+                secret=os.environ['WEBHOOK_SECRET'],
+                url=os.environ.get('WEBHOOK_URL', ""),
+                host=conf["webhook_host"],
+                port=conf["webhook_port"],
+                path=conf["webhook_path"],
+                queue_size=conf["webhook_queue_size"],
+                workers=conf["webhook_workers"],
+                shutdown_grace=conf["shutdown_grace"],
+            )
+            await server.run()
+        else:
+            logger.info(f"Starting supervisor polling for {supervisor.count} workers.")
+            await supervisor.delete_webhook()
+            # AsyncTeleBot has no stop_polling; cancelling the polling task ends it cleanly and closes the session
+            polling = asyncio.ensure_future(supervisor.polling(none_stop=True))
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, polling.cancel)
+            await polling
+    finally:
+        await supervisor.stop_workers()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+
+async def main():
+    if conf["shard_workers"] and shard_index is None:
+        await supervise()
+        return
+    if shard_index is not None:
+        # Worker of a sharded deployment: the supervisor forwards this shard's updates over local HTTP
+        conf["ingress_mode"] = "webhook"
+        conf["webhook_host"] = "127.0.0.1"
+        conf["webhook_port"] = int(os.environ['SHARD_PORT'])
+        if conf["metrics_port"]:
+            conf["metrics_port"] += 1 + int(shard_index)
+
+    # Init bot
+    metrics.instrument_telegram()
+    bot = AsyncTeleBot(telegram_token)
+
+    # --- Warm up DB pool, concurrently with Telegram setup ---
+    storage_ready = asyncio.ensure_future(start_storage())
+    telegram_ready = asyncio.ensure_future(setup_telegram(bot, storage_ready, register_commands=shard_index is None))
+    if not await storage_ready:
+        logger.critical("Database pool warm-up failed. Exiting.")
+        telegram_ready.cancel()
+        # Decide if you want to exit if DB fails. Probably yes for persistence.
+        exit(1) # Uncomment this to make the bot stop if DB fails
+        # logger.warning("Proceeding without database functionality (if applicable).") # Or just warn and continue
+    await telegram_ready
+    # --- END ---
+
+    # Metrics
+    metrics_runner = None
+    if conf["metrics_port"]:
+        metrics_runner = await metrics.start_server(conf["metrics_host"], conf["metrics_port"])
+
+    # Init commands
+    register_handlers(bot)
+
     # Start bot
-    logger.info("Starting Gemini_Telegram_Bot polling.")
-    await bot.polling(none_stop=True)
+    try:
+        if conf["ingress_mode"] == "webhook":
+            logger.info("Starting Gemini_Telegram_Bot webhook server.")
+            warm_imports()
+            server = webhook.WebhookServer(
+                bot,
+                secret=os.environ['WEBHOOK_SECRET'],
+                url=os.environ.get('WEBHOOK_URL', "") if shard_index is None else "",
+                host=conf["webhook_host"],
+                port=conf["webhook_port"],
+                path=conf["webhook_path"],
+                queue_size=conf["webhook_queue_size"],
+                workers=conf["webhook_workers"],
+                shutdown_grace=conf["shutdown_grace"],
+            )
+            metrics.stats_gauge("webhook", "Webhook ingress queue state and totals", server.stats)
+            if shard_index is not None:
+                shards.add_worker_routes(
+                    server,
+                    int(shard_index),
+                    [handlers.gemini_chat_dict, handlers.gemini_pro_chat_dict, handlers.gemini_draw_dict, handlers.default_model_dict,
+                     usage.meter.today],
+                    lambda user_id: [handlers.gemini.context_window.forget(f"{kind}:{user_id}") for kind in ("chat", "pro", "draw")],
+                )
+            await server.run()
+        else:
+            logger.info("Starting Gemini_Telegram_Bot polling.")
+            warm_imports()
+            # Cancelled on SIGINT/SIGTERM so the finally below flushes the write-behind buffers
+            polling = asyncio.ensure_future(bot.polling(none_stop=True))
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, polling.cancel)
+            await polling
+            logger.info("Polling stopped, finishing updates in progress...")
+            pending = getattr(bot, "_pending_tasks", None)
+            if pending:
+                await asyncio.wait(list(pending), timeout=conf["shutdown_grace"])
+    finally:
+        await edit_scheduler.stop()
+        await history.store.stop()
+        await usage.meter.stop()
+        await response_cache.cache.stop()
+        await db.close_pool()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,239 @@
+import json
+import time
+import logging
+import contextlib
+import contextvars
+from aiohttp import web
+from telebot import asyncio_helper
+
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger("trace")
+
+# Labels of the request being handled, set once per update in handlers.admitted()
+command_var = contextvars.ContextVar("command", default="none")
+trace_var = contextvars.ContextVar("trace", default=None)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)) + "}"
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(n, "") for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        for key, (counts, total, count) in sorted(self._values.items()):
+            for bound, n in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_format_labels(names, key + (bound,))} {n}")
+            lines.append(f"{self.name}_bucket{_format_labels(names, key + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+registry = []
+collectors = []  # callables refreshing gauges from component stats() right before a scrape
+
+def collector(fn):
+    collectors.append(fn)
+    return fn
+
+def stats_gauge(name, help, stats, label=None):
+    """Exports the numeric fields of a component's stats() dict as one gauge labelled by field.
+
+    With label set, stats() returns {label value: stats dict} for components
+    that have several instances (caches, API keys).
+    """
+    gauge = Gauge(name, help, (label, "stat") if label else ("stat",))
+
+    def export(values, **labels):
+        for field, value in values.items():
+            if isinstance(value, dict):
+                for sub, v in value.items():
+                    gauge.set(float(v), stat=f"{field}.{sub}", **labels)
+            elif isinstance(value, (int, float)):
+                gauge.set(float(value), stat=field, **labels)
+
+    @collector
+    def collect():
+        if label:
+            for instance, values in (stats() or {}).items():
+                export(values, **{label: instance})
+        else:
+            export(stats() or {})
+
+    return gauge
+
+def render():
+    for fn in collectors:
+        try:
+            fn()
+        except Exception as e:
+            logger.error(f"Metrics collector {fn.__name__} failed: {e}")
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# --- Hot path metrics ---
+request_duration = Histogram("bot_request_duration_seconds", "Handler time from admission to reply", ("command", "model", "outcome"))
+queue_wait = Histogram("bot_queue_wait_seconds", "Time waiting for admission", ("command", "model"))
+requests_shed = Counter("bot_requests_shed_total", "Requests rejected because a queue was full", ("command", "model"))
+first_chunk = Histogram("gemini_time_to_first_chunk_seconds", "Time from request to first streamed chunk", ("command", "model"))
+stream_duration = Histogram("gemini_stream_duration_seconds", "Time from request to last streamed chunk", ("command", "model"))
+stream_chunks = Counter("gemini_stream_chunks_total", "Streamed chunks received", ("command", "model"))
+stream_chunk_rate = Histogram("gemini_stream_chunks_per_second", "Chunks per second of each stream", ("command", "model"),
+                              buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+gemini_call_duration = Histogram("gemini_call_duration_seconds", "Time of non-streaming Gemini calls (context summaries)", ("command", "model"))
+gemini_errors = Counter("gemini_errors_total", "Failed Gemini calls", ("command", "model"))
+telegram_latency = Histogram("telegram_request_duration_seconds", "Telegram Bot API call latency", ("method",))
+telegram_failures = Counter("telegram_request_failures_total", "Failed Telegram Bot API calls", ("method", "code"))
+db_latency = Histogram("db_query_duration_seconds", "Database query time including pool checkout", ("query",))
+
+class StreamTimer:
+    """Time to first chunk, duration and chunk rate of one model stream."""
+
+    def __init__(self, model):
+        self.labels = {"command": command_var.get(), "model": model}
+        self.started = time.perf_counter()
+        self.first = None
+        self.chunks = 0
+
+    def chunk(self):
+        if self.first is None:
+            self.first = time.perf_counter()
+            first_chunk.observe(self.first - self.started, **self.labels)
+            mark("first_chunk")
+        self.chunks += 1
+
+    def finish(self):
+        duration = time.perf_counter() - self.started
+        stream_duration.observe(duration, **self.labels)
+        stream_chunks.inc(self.chunks, **self.labels)
+        if self.first is not None and duration > self.first - self.started:
+            stream_chunk_rate.observe(self.chunks / (duration - (self.first - self.started)), **self.labels)
+        mark("stream_done")
+
+    def error(self):
+        gemini_errors.inc(**self.labels)
+
+@contextlib.contextmanager
+def timed_call(model):
+    """Duration and errors of a non-streaming model call."""
+    labels = {"command": command_var.get(), "model": model}
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        gemini_errors.inc(**labels)
+        raise
+    finally:
+        gemini_call_duration.observe(time.perf_counter() - started, **labels)
+        mark("model_done")
+
+class Trace:
+    """Per-request timeline written to the "trace" logger as one JSON line when trace_requests is on."""
+
+    def __init__(self, command, model):
+        self.started = time.perf_counter()
+        self.record = {"command": command, "model": model, "marks": {}}
+
+    def mark(self, name):
+        self.record["marks"][name] = round(time.perf_counter() - self.started, 4)
+
+    def finish(self, outcome):
+        self.record["outcome"] = outcome
+        self.record["total"] = round(time.perf_counter() - self.started, 4)
+        trace_logger.info(json.dumps(self.record))
+
+def mark(name):
+    trace = trace_var.get()
+    if trace is not None:
+        trace.mark(name)
+
+def instrument_telegram():
+    """Times every Bot API call by wrapping telebot's single request function."""
+    process_request = asyncio_helper._process_request
+    if getattr(process_request, "instrumented", False):
+        return
+
+    async def timed(token, url, method='get', params=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await process_request(token, url, method, params, files, **kwargs)
+        except asyncio_helper.ApiTelegramException as e:
+            telegram_failures.inc(method=url, code=e.error_code)
+            raise
+        except Exception:
+            telegram_failures.inc(method=url, code="network")
+            raise
+        finally:
+            telegram_latency.observe(time.perf_counter() - started, method=url)
+
+    timed.instrumented = True
+    asyncio_helper._process_request = timed
+
+async def handle(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+async def start_server(host, port):
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics endpoint listening on {host}:{port}/metrics")
+    return runner
@@ -0,0 +1,166 @@
+import random
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ProviderError(Exception):
+    """A backend failed before or while streaming."""
+
+def text_messages(history):
+    """Converts Gemini Contents to role/content dicts for OpenAI-style chat APIs (text parts only)."""
+    messages = []
+    for content in history:
+        text = "".join(part.text for part in content.parts or () if part.text)
+        if text:
+            messages.append({"role": "user" if content.role == "user" else "assistant", "content": text})
+    return messages
+
+class Provider:
+    """Common streaming interface of a model backend.
+
+    stream() is an async generator of text pieces for one turn: turn.history is
+    the (already trimmed) conversation, message the new user text. Providers
+    with native_history keep their own chat (ChatTurn.fork), the others get
+    the session rebuilt from the text once the turn completes.
+    """
+
+    name = "provider"
+    native_history = False
+    reports_usage = False  # counts its own calls in usage.meter
+
+    async def stream(self, model, turn, message, estimated_tokens=0):
+        raise NotImplementedError
+        yield
+
+class GeminiProvider(Provider):
+    name = "gemini"
+    native_history = True
+    reports_usage = True
+
+    def __init__(self, key_pool):
+        self.key_pool = key_pool
+
+    async def stream(self, model, turn, message, estimated_tokens=0):
+        response = self.key_pool.stream(lambda c: turn.fork(c, model).send_message_stream(message), estimated_tokens,
+                                        model=model, tried=turn.keys, requests=lambda: 0 if turn.lost else 1)
+        async for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+class OpenAIProvider(Provider):
+    """OpenAI and OpenAI-compatible APIs (DeepSeek). Needs the optional openai package."""
+
+    name = "openai"
+
+    def __init__(self, api_key, base_url=None):
+        try:
+            from openai import AsyncOpenAI
+        except ImportError as e:
+            raise ProviderError("pip install openai to route to OpenAI-compatible models") from e
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+
+    async def stream(self, model, turn, message, estimated_tokens=0):
+        messages = text_messages(turn.history) + [{"role": "user", "content": message}]
+        response = await self.client.chat.completions.create(model=model, messages=messages, stream=True)
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+class AnthropicProvider(Provider):
+    """Claude models. Needs the optional anthropic package."""
+
+    name = "anthropic"
+
+    def __init__(self, api_key, max_tokens=4096):
+        try:
+            from anthropic import AsyncAnthropic
+        except ImportError as e:
+            raise ProviderError("pip install anthropic to route to Claude models") from e
+        self.client = AsyncAnthropic(api_key=api_key)
+        self.max_tokens = max_tokens
+
+    async def stream(self, model, turn, message, estimated_tokens=0):
+        messages = text_messages(turn.history) + [{"role": "user", "content": message}]
+        async with self.client.messages.stream(model=model, messages=messages, max_tokens=self.max_tokens) as response:
+            async for text in response.text_stream:
+                if text:
+                    yield text
+
+class MistralProvider(Provider):
+    """Mistral models. Needs the optional mistralai package."""
+
+    name = "mistral"
+
+    def __init__(self, api_key):
+        try:
+            from mistralai import Mistral
+        except ImportError as e:
+            raise ProviderError("pip install mistralai to route to Mistral models") from e
+        self.client = Mistral(api_key=api_key)
+
+    async def stream(self, model, turn, message, estimated_tokens=0):
+        messages = text_messages(turn.history) + [{"role": "user", "content": message}]
+        response = await self.client.chat.stream_async(model=model, messages=messages)
+        async for event in response:
+            delta = event.data.choices[0].delta.content if event.data.choices else None
+            if delta:
+                yield delta
+
+class StubProvider(Provider):
+    """Local fake backend for benchmarks: configurable first-token latency (with a slow tail), cadence and failures."""
+
+    def __init__(self, name="stub", first_token=0.1, chunks=5, interval=0.01, error_rate=0.0,
+                 slow_rate=0.0, slow_first_token=2.0, seed=None):
+        self.name = name
+        self.first_token = first_token
+        self.slow_rate = slow_rate
+        self.slow_first_token = slow_first_token
+        self.chunks = chunks
+        self.interval = interval
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    async def stream(self, model, turn, message, estimated_tokens=0):
+        self.calls += 1
+        slow = self.rng.random() < self.slow_rate
+        await asyncio.sleep(self.slow_first_token if slow else self.first_token)
+        if self.rng.random() < self.error_rate:
+            raise ProviderError(f"{self.name} is down")
+        for i in range(self.chunks):
+            if i:
+                await asyncio.sleep(self.interval)
+            yield f"{self.name}:{model}:{i} "
+
+CLIENT_TYPES = {
+    "openai": lambda config: OpenAIProvider(config["api_key"], config.get("base_url")),
+    "anthropic": lambda config: AnthropicProvider(config["api_key"]),
+    "mistral": lambda config: MistralProvider(config["api_key"]),
+}
+
+def build_backends(models, key_pool):
+    """Resolves model names to (provider, model id) pairs.
+
+    Gemini models go through the key pool; anything else is looked up in
+    CONSTANTS.MODEL_CONFIGS. Models whose provider can't be set up (missing
+    keys or SDK) are skipped with a warning.
+    """
+    gemini = GeminiProvider(key_pool)
+    backends = {}
+    providers = {}
+    for model in models:
+        if model.startswith("gemini"):
+            backends[model] = (gemini, model)
+            continue
+        try:
+            # CONSTANTS reads every provider key from the environment on import
+            from CONSTANTS import MODEL_CONFIGS
+            config = MODEL_CONFIGS[model]
+            key = (config["client_type"], config.get("base_url"))
+            if key not in providers:
+                providers[key] = CLIENT_TYPES[config["client_type"]](config)
+            backends[model] = (providers[key], config["model"])
+        except (KeyError, ProviderError) as e:
+            logger.warning(f"Model {model} can't be routed to: {e!r}")
+    return backends
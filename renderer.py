@@ -0,0 +1,111 @@
+import re
+from config import conf
+from lazy import lazy_module
+
+md2tgmd = lazy_module("md2tgmd")
+
+def escape(text):
+    """md2tgmd's MarkdownV2 escaping; md2tgmd is imported on first use."""
+    return md2tgmd.escape(text)
+
+_TOKENS = re.compile(r"```|\n{2,}")
+_FENCE_OPEN = re.compile(r"```[^\n`]*")
+
+class StreamRenderer:
+    """Incremental MarkdownV2 rendering of a growing response.
+
+    The raw text is cut into segments after blank lines outside code fences.
+    Once a segment is complete it is escaped once and cached; each render only
+    escapes the unfinished tail, so a tick costs O(tail) instead of O(response).
+    Segments after the first are escaped behind a synthetic blank line, which
+    is what md2tgmd's line-start rules (lists, quotes, numbering) look at.
+
+    When the current message would exceed the Telegram limit it is closed at
+    the last segment boundary (or, for a single oversized paragraph or code
+    block, at a line break, re-opening the code fence in the next message)
+    and appended to pages; the caller sends subsequent renders as a new
+    message.
+    """
+
+    def __init__(self, limit=None, escape_fn=escape):
+        self.limit = limit or conf["telegram_max_message_length"]
+        self.escape = escape_fn
+        self.pages = []          # finished messages as (escaped, raw)
+        self._raw = ""           # raw text of the current message
+        self._stable = 0         # raw offset in _raw up to which segments are cached
+        self._escaped = ""       # escaped text of _raw[:_stable]
+
+    def feed(self, text):
+        """Appends streamed text; returns the number of pages finished by it."""
+        pages = len(self.pages)
+        self._raw += text
+        self._advance()
+        while self._overflows():
+            self._roll()
+        return len(self.pages) - pages
+
+    def _escape(self, raw, start):
+        if start == 0:
+            return self.escape(raw)
+        escaped = self.escape("\n\n" + raw)
+        return escaped[2:] if escaped.startswith("\n\n") else escaped
+
+    def _overflows(self):
+        tail = self._raw[self._stable:]
+        # Escaping at most doubles plain text, so only escape the tail when it might not fit
+        if len(self._escaped) + 2 * len(tail) + 16 <= self.limit:
+            return False
+        return len(self._escaped) + len(self._escape(tail, self._stable)) > self.limit
+
+    def render(self):
+        """Returns (escaped, raw) for the current message."""
+        return self._escaped + self._escape(self._raw[self._stable:], self._stable), self._raw
+
+    def _advance(self):
+        """Caches every segment of the tail that ended at a blank line outside a code fence."""
+        in_fence = False
+        boundary = None
+        for match in _TOKENS.finditer(self._raw, self._stable):
+            if match.group() == "```":
+                in_fence = not in_fence
+            elif not in_fence and match.end() < len(self._raw):
+                boundary = match.end()
+        if boundary is not None:
+            self._escaped += self._escape(self._raw[self._stable:boundary], self._stable)
+            self._stable = boundary
+
+    def _roll(self):
+        if self._stable > 0 and len(self._escaped) <= self.limit:
+            # Close the page at the last cached boundary
+            self.pages.append((self._escaped.rstrip("\n"), self._raw[:self._stable].rstrip("\n")))
+            self._raw = self._raw[self._stable:]
+        else:
+            self._split_oversized()
+        self._stable = 0
+        self._escaped = ""
+        self._advance()
+
+    def _split_oversized(self):
+        """Cuts a single paragraph or code block that doesn't fit in one message at a line break."""
+        raw = self._raw
+        cut = len(raw)
+        while True:
+            head, tail = self._cut(raw, cut)
+            escaped = self.escape(head)
+            if len(escaped) <= self.limit or cut <= 1:
+                break
+            cut = max(1, min(cut - 1, int(cut * self.limit / len(escaped) * 0.95)))
+        self.pages.append((escaped, head))
+        self._raw = tail
+
+    def _cut(self, raw, cut):
+        """Splits raw near cut at a newline (or space), closing and re-opening an open code fence."""
+        newline = raw.rfind("\n", 0, cut)
+        space = raw.rfind(" ", 0, cut)
+        at = newline if newline > cut // 2 else space if space > cut // 2 else cut
+        head, tail = raw[:at], raw[at:].lstrip("\n ")
+        fences = list(_FENCE_OPEN.finditer(head))
+        if len(fences) % 2:
+            opening = fences[-1].group()
+            return head + "\n```", opening + "\n" + tail
+        return head, tail
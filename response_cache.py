@@ -0,0 +1,150 @@
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from config import conf
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS response_cache (
+    key         TEXT PRIMARY KEY,
+    model       TEXT NOT NULL,
+    text        TEXT NOT NULL,
+    photos      JSONB NOT NULL,
+    latency     DOUBLE PRECISION NOT NULL,
+    created_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+db.prepare("response_cache_get", "SELECT text, photos, latency, extract(epoch FROM created_at) FROM response_cache "
+                                 "WHERE key = $1 AND created_at > now() - make_interval(secs => $2)")
+db.prepare("response_cache_put", "INSERT INTO response_cache (key, model, text, photos, latency) VALUES ($1, $2, $3, $4, $5) "
+                                 "ON CONFLICT (key) DO UPDATE SET text = EXCLUDED.text, photos = EXCLUDED.photos, "
+                                 "latency = EXCLUDED.latency, created_at = now()")
+db.prepare("response_cache_delete", "DELETE FROM response_cache WHERE key = $1")
+
+def normalize(prompt):
+    """Case and whitespace differences don't make a different question."""
+    return " ".join(prompt.split()).casefold()
+
+class ResponseCache:
+    """Exact-match cache of complete answers to first-turn prompts.
+
+    Keys hash the normalized prompt, the model and its config, so the cache
+    only ever answers the same question asked with no history. Entries hold
+    the answer text, the Telegram file_ids of its photos (resending a file_id
+    needs no upload) and how long generating it took, for the saved-latency
+    metric. The in-memory LRU is bounded by max_entries and every entry
+    expires after ttl seconds. With persist, entries are also written to
+    Postgres in the background and looked up there on a memory miss, so they
+    survive restarts and are shared between workers.
+    """
+
+    def __init__(self, max_entries=1000, ttl=86400.0, persist=False):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist = persist
+        self._entries = OrderedDict()  # key -> entry dict, least recently used first
+        self._writes = set()
+        self.metrics = {"hits": 0, "db_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expirations": 0,
+                        "invalidations": 0, "db_errors": 0, "saved_seconds": 0.0}
+
+    @staticmethod
+    def key(prompt, model, config):
+        raw = json.dumps([normalize(prompt), model, config], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    async def start(self):
+        if self.persist:
+            await db.execute(SCHEMA)
+
+    async def stop(self):
+        """Waits for the background writes still in flight, so they run before the pool closes."""
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.metrics["evictions"] += 1
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry["created"] > self.ttl:
+            del self._entries[key]
+            self.metrics["expirations"] += 1
+            entry = None
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.metrics["hits"] += 1
+            return entry
+        if self.persist:
+            try:
+                rows = await db.execute_prepared("response_cache_get", key, self.ttl, fetch=True)
+            except Exception as e:
+                self.metrics["db_errors"] += 1
+                logger.warning(f"Response cache lookup failed: {e}")
+                rows = None
+            if rows:
+                text, photos, latency, created = rows[0]
+                entry = {"text": text, "photos": photos if isinstance(photos, list) else json.loads(photos),
+                         "latency": latency, "created": float(created)}
+                self._remember(key, entry)
+                self.metrics["hits"] += 1
+                self.metrics["db_hits"] += 1
+                return entry
+        self.metrics["misses"] += 1
+        return None
+
+    def put(self, key, model, text, photos=(), latency=0.0):
+        """Caches a complete answer; written to Postgres in the background when persisting."""
+        if (not text and not photos) or len(text) > conf["response_cache_max_chars"]:
+            return
+        self._remember(key, {"text": text, "photos": list(photos), "latency": latency, "created": time.time()})
+        self.metrics["stores"] += 1
+        if self.persist:
+            self._background(db.execute_prepared("response_cache_put", key, model, text, json.dumps(list(photos)), latency))
+
+    def invalidate(self, key):
+        """Drops an entry whose photos Telegram no longer accepts."""
+        self.metrics["invalidations"] += 1
+        self._entries.pop(key, None)
+        if self.persist:
+            self._background(db.execute_prepared("response_cache_delete", key))
+
+    def hit_served(self, entry, duration):
+        self.metrics["saved_seconds"] += max(entry["latency"] - duration, 0.0)
+
+    def _background(self, coro):
+        async def run():
+            try:
+                await coro
+            except Exception as e:
+                self.metrics["db_errors"] += 1
+                logger.warning(f"Response cache write failed: {e}")
+
+        task = asyncio.create_task(run())
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    def stats(self):
+        m = dict(self.metrics)
+        lookups = m["hits"] + m["misses"]
+        m["hit_rate"] = m["hits"] / lookups if lookups else 0.0
+        m["entries"] = len(self._entries)
+        return m
+
+cache = ResponseCache(
+    max_entries=conf["response_cache_entries"],
+    ttl=conf["response_cache_ttl"],
+    persist=conf["response_cache_persist"],
+)
+
+metrics.stats_gauge("response_cache", "Response cache hits, misses, hit rate and generation time saved", cache.stats)
@@ -0,0 +1,241 @@
+import copy
+import time
+import asyncio
+import logging
+import statistics
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class Backend:
+    """Rolling time-to-first-token and outcome samples of one provider/model."""
+
+    def __init__(self, name, provider, model, window=50):
+        self.name = name
+        self.provider = provider
+        self.model = model
+        self.ttfts = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)  # True for success
+        self.open_until = 0.0  # circuit open (backend skipped) until this monotonic time
+        self.probing = False   # first request after the circuit closed again
+        self.metrics = {"requests": 0, "errors": 0, "failovers": 0, "circuit_opens": 0}
+
+    def ttft(self):
+        """Median TTFT, None until the backend has answered once."""
+        return statistics.median(self.ttfts) if self.ttfts else None
+
+    def ttft_percentile(self, q):
+        ttfts = sorted(self.ttfts)
+        return ttfts[min(len(ttfts) - 1, int(q / 100 * len(ttfts)))]
+
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def healthy(self, now):
+        return now >= self.open_until
+
+class _Attempt:
+    """One request of a turn. Each gets its own copy of the turn, so a loser's fork never becomes the session."""
+
+    def __init__(self, router, backend, turn, message, estimated_tokens, hedge):
+        self.backend = backend
+        self.hedge = hedge
+        self.turn = copy.copy(turn)
+        self.turn.chat = None
+        self.turn.backend = backend
+        self.started = time.monotonic()
+        self.response = backend.provider.stream(backend.model, self.turn, message, estimated_tokens)
+        self.task = asyncio.ensure_future(router._first_chunk(backend, self.response))
+
+    async def discard(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except BaseException:
+            pass
+        await self.response.aclose()
+
+class Router:
+    """Picks the backend for a model choice and fails over between them.
+
+    routes maps a user's model choice to its candidate backends in preference
+    order (the model itself first). Candidates whose circuit is open are
+    skipped; among the healthy ones the fastest median TTFT wins, with each
+    step down the preference list weighted by (1 + fallback_penalty), so a
+    fallback only takes over when it is clearly faster or the primary is down.
+    A failure before the first chunk moves on to the next candidate; an error
+    rate above error_threshold (over at least min_samples) opens the circuit
+    for cooldown seconds.
+
+    With hedging on, a turn whose first chunk hasn't arrived by the backend's
+    hedge_percentile TTFT gets a second request: to hedge_model if set, else
+    to the next candidate, else to the same backend again (Gemini sends it to
+    an API key the turn isn't using yet, when there is one). Whichever
+    produces first is streamed and the other is cancelled. At most
+    hedge_max_rate of recent turns are hedged.
+    """
+
+    def __init__(self, backends, routes=None, window=50, error_threshold=0.5, min_samples=5,
+                 cooldown=30.0, fallback_penalty=1.0, hedge=False, hedge_percentile=90, hedge_min_delay=0.5,
+                 hedge_default_delay=5.0, hedge_max_rate=0.1, hedge_model=None):
+        self.window = window
+        self.error_threshold = error_threshold
+        self.min_samples = min_samples
+        self.cooldown = cooldown
+        self.fallback_penalty = fallback_penalty
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_max_rate = hedge_max_rate
+        self.hedge_model = hedge_model
+        self._hedged = deque(maxlen=200)  # whether each recent turn was hedged
+        self.hedge_metrics = {"turns": 0, "hedges": 0, "hedge_wins": 0, "hedge_losses": 0, "over_budget": 0}
+        self.backends = {name: Backend(name, provider, model, window) for name, (provider, model) in backends.items()}
+        self.routes = {}
+        for choice, fallbacks in (routes or {}).items():
+            self.routes[choice] = [m for m in [choice] + list(fallbacks) if m in self.backends]
+
+    def candidates(self, choice):
+        """Backends for choice, best first."""
+        names = self.routes.get(choice) or [choice]
+        now = time.monotonic()
+        known = [t for t in (self.backends[name].ttft() for name in names) if t is not None]
+        # Untried backends rank as fast as the best known one, so preference order decides
+        unknown = min(known, default=0.0)
+        ranked = []
+        for position, name in enumerate(names):
+            backend = self.backends[name]
+            ttft = backend.ttft()
+            score = (unknown if ttft is None else ttft) * (1 + self.fallback_penalty * position)
+            ranked.append((not backend.healthy(now), score, position, backend))
+        ranked.sort(key=lambda r: r[:3])
+        return [r[3] for r in ranked]
+
+    def _success(self, backend, ttft):
+        backend.ttfts.append(ttft)
+        backend.outcomes.append(True)
+        backend.probing = False
+
+    def _failure(self, backend, e):
+        backend.metrics["errors"] += 1
+        backend.outcomes.append(False)
+        now = time.monotonic()
+        tripped = backend.probing or (
+            len(backend.outcomes) >= self.min_samples and backend.error_rate() >= self.error_threshold
+        )
+        if tripped and backend.healthy(now):
+            backend.open_until = now + self.cooldown
+            backend.probing = True
+            backend.outcomes.clear()
+            backend.metrics["circuit_opens"] += 1
+            logger.warning(f"Backend {backend.name} unhealthy ({e!r}), skipping it for {self.cooldown}s")
+
+    def hedge_delay(self, backend):
+        """Seconds to wait for a first chunk before hedging: a high percentile of the backend's TTFT."""
+        if len(backend.ttfts) < self.min_samples:
+            return self.hedge_default_delay
+        return max(self.hedge_min_delay, backend.ttft_percentile(self.hedge_percentile))
+
+    def _may_hedge(self):
+        if sum(self._hedged) < self.hedge_max_rate * max(len(self._hedged), 1):
+            return True
+        self.hedge_metrics["over_budget"] += 1
+        return False
+
+    def _hedge_target(self, backend, queue):
+        if self.hedge_model in self.backends and self.hedge_model != backend.name:
+            return self.backends[self.hedge_model]
+        if queue:
+            return queue.pop(0)
+        return backend
+
+    async def _first_chunk(self, backend, response):
+        started = time.perf_counter()
+        try:
+            first = await response.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._failure(backend, e)
+            raise
+        self._success(backend, time.perf_counter() - started)
+        return first
+
+    def _start(self, backend, turn, message, estimated_tokens, hedge=False):
+        backend.metrics["requests"] += 1
+        return _Attempt(self, backend, turn, message, estimated_tokens, hedge)
+
+    async def stream(self, choice, turn, message, estimated_tokens=0):
+        """Async generator of text for one turn; sets turn.backend to the backend that answered."""
+        queue = self.candidates(choice)
+        running = []
+        hedged = False       # deadline passed (hedge sent or skipped for budget)
+        hedge_sent = False
+        winner = None
+        last_error = None
+        self.hedge_metrics["turns"] += 1
+        try:
+            while winner is None:
+                if not running:
+                    if not queue:
+                        raise last_error
+                    running.append(self._start(queue.pop(0), turn, message, estimated_tokens))
+                timeout = None
+                if self.hedge and not hedged:
+                    timeout = max(0.0, running[0].started + self.hedge_delay(running[0].backend) - time.monotonic())
+                done, _ = await asyncio.wait([a.task for a in running], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    if self._may_hedge():
+                        self.hedge_metrics["hedges"] += 1
+                        hedge_sent = True
+                        target = self._hedge_target(running[0].backend, queue)
+                        logger.info(f"No first chunk from {running[0].backend.name} yet, hedging on {target.name}")
+                        running.append(self._start(target, turn, message, estimated_tokens, hedge=True))
+                    continue
+                for attempt in [a for a in running if a.task in done]:
+                    if attempt.task.exception() is None:
+                        if winner is None:
+                            winner = attempt
+                            running.remove(attempt)
+                        continue
+                    running.remove(attempt)
+                    last_error = attempt.task.exception()
+                    if running or queue:
+                        attempt.backend.metrics["failovers"] += 1
+                        logger.warning(f"Backend {attempt.backend.name} failed before its first chunk, failing over: {last_error!r}")
+        finally:
+            # Losers (and everything, if the caller went away) are cancelled and closed in the background.
+            # Marked lost, so providers that meter their own calls count the tokens but not another request
+            for attempt in running:
+                attempt.turn.lost = winner is not None or attempt.hedge
+                asyncio.ensure_future(attempt.discard())
+            self._hedged.append(hedge_sent)
+        if hedge_sent:
+            self.hedge_metrics["hedge_wins" if winner.hedge else "hedge_losses"] += 1
+        turn.backend = winner.backend
+        first = winner.task.result()
+        if first is not None:
+            yield first
+            try:
+                async for text in winner.response:
+                    yield text
+            except Exception as e:
+                # Too late to fail over without repeating what the user has seen
+                self._failure(winner.backend, e)
+                raise
+        turn.chat = winner.turn.chat
+
+    def hedge_stats(self):
+        m = dict(self.hedge_metrics)
+        m["hedge_rate"] = sum(self._hedged) / len(self._hedged) if self._hedged else 0.0
+        return m
+
+    def stats(self):
+        return {
+            name: dict(b.metrics, ttft_p50=b.ttft() or 0.0, error_rate=b.error_rate(), healthy=b.healthy(time.monotonic()))
+            for name, b in self.backends.items()
+        }
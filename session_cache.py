@@ -0,0 +1,128 @@
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+def history_bytes(chat):
+    """Approximate memory held by a chat's history: text plus inline image bytes."""
+    total = 0
+    for content in chat.get_history():
+        for part in content.parts or ():
+            if part.text:
+                total += len(part.text)
+            if part.inline_data is not None and part.inline_data.data:
+                total += len(part.inline_data.data)
+    return total
+
+class SessionCache:
+    """Dict-like LRU cache for per-user sessions with an idle TTL and a byte budget.
+
+    Entries live in least-recently-used order, so expired entries are always at
+    the front and eviction never has to scan the whole cache. sizer(value)
+    returns the bytes charged to an entry; call refresh(key) after mutating a
+    value in place so its size is re-measured. on_evict(key, value, reason) is
+    called for every entry dropped by the cache (not for explicit deletes).
+    """
+
+    def __init__(self, name, max_entries=5000, max_bytes=None, idle_ttl=None, sizer=None, on_evict=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.sizer = sizer
+        self.on_evict = on_evict
+        self._data = OrderedDict()  # key -> [value, size, last_access]
+        self.total_bytes = 0
+        self.metrics = {"hits": 0, "misses": 0, "evictions_lru": 0, "evictions_ttl": 0, "evictions_bytes": 0}
+
+    def _size(self, value):
+        return self.sizer(value) if self.sizer else 0
+
+    def _expired(self, entry, now):
+        return self.idle_ttl is not None and now - entry[2] > self.idle_ttl
+
+    def _evict_front(self, reason):
+        key, (value, size, _) = self._data.popitem(last=False)
+        self.total_bytes -= size
+        self.metrics["evictions_" + reason] += 1
+        if self.on_evict:
+            try:
+                self.on_evict(key, value, reason)
+            except Exception as e:
+                logger.error(f"{self.name}: on_evict failed for {key}: {e}")
+
+    def _enforce(self, now):
+        while self._data and self._expired(next(iter(self._data.values())), now):
+            self._evict_front("ttl")
+        while len(self._data) > self.max_entries:
+            self._evict_front("lru")
+        # Never evict the most recently used entry just for being large on its own
+        while self.max_bytes is not None and self.total_bytes > self.max_bytes and len(self._data) > 1:
+            self._evict_front("bytes")
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        self._enforce(now)
+        entry = self._data.get(key)
+        if entry is None:
+            self.metrics["misses"] += 1
+            return default
+        self.metrics["hits"] += 1
+        entry[2] = now
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        size = self._size(value)
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.total_bytes -= old[1]
+        self._data[key] = [value, size, time.monotonic()]
+        self.total_bytes += size
+        self._enforce(time.monotonic())
+
+    def __delitem__(self, key):
+        _, size, _ = self._data.pop(key)
+        self.total_bytes -= size
+
+    def pop(self, key, default=None):
+        if key not in self._data:
+            return default
+        value = self._data[key][0]
+        del self[key]
+        return value
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and not self._expired(entry, time.monotonic())
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return list(self._data)
+
+    def refresh(self, key):
+        """Re-measures key after its value grew and enforces the budgets."""
+        entry = self._data.get(key)
+        if entry is None:
+            return
+        size = self._size(entry[0])
+        self.total_bytes += size - entry[1]
+        entry[1] = size
+        self._enforce(time.monotonic())
+
+    def stats(self):
+        m = dict(self.metrics)
+        m["entries"] = len(self._data)
+        m["bytes"] = self.total_bytes
+        return m
+
+_missing = object()
@@ -0,0 +1,301 @@
+import os
+import sys
+import json
+import time
+import signal
+import bisect
+import asyncio
+import hashlib
+import logging
+import secrets
+import aiohttp
+from aiohttp import web
+from telebot.async_telebot import AsyncTeleBot
+from webhook import SECRET_HEADER
+
+logger = logging.getLogger(__name__)
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    """Consistent hash ring over shard indexes 0..count-1.
+
+    Each shard owns `replicas` points, so growing or shrinking by one shard
+    only moves about 1/count of the users.
+    """
+
+    def __init__(self, count, replicas=100):
+        self.count = count
+        points = sorted((_hash(f"shard-{shard}-{i}"), shard) for shard in range(count) for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._shards = [s for _, s in points]
+
+    def shard(self, key):
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[i]
+
+def routing_key(update):
+    """The user an update belongs to: from_user.id of whatever it carries, else the chat, else the update id."""
+    for value in vars(update).values():
+        user = getattr(value, "from_user", None)
+        if user is not None:
+            return user.id
+        chat = getattr(value, "chat", None)
+        if chat is not None:
+            return chat.id
+    return update.update_id
+
+def update_json(update):
+    """Rebuilds the raw update from the json telebot keeps on each contained object."""
+    payload = {"update_id": update.update_id}
+    for field, value in vars(update).items():
+        raw = getattr(value, "json", None)
+        if isinstance(raw, dict):
+            payload[field] = raw
+    return payload
+
+class Worker:
+    def __init__(self, index, port):
+        self.index = index
+        self.port = port
+        self.process = None
+        self.started = 0.0
+        self.health_failures = 0
+        self.metrics = {"forwarded": 0, "retries": 0, "dropped": 0, "restarts": 0}
+
+class Supervisor(AsyncTeleBot):
+    """Receives updates like a normal bot and forwards each one to a worker process.
+
+    Workers are `python main.py` processes started with SHARD_INDEX/SHARD_COUNT;
+    each serves its shard through a WebhookServer on 127.0.0.1:base_port+index.
+    Updates are routed by a consistent hash of from_user.id, so a user's
+    sessions live on exactly one worker. Workers that exit or stop answering
+    /healthz are restarted. SIGUSR1/SIGUSR2 add/remove a worker: routing
+    pauses, every worker drops the sessions it no longer owns after flushing
+    their history to Postgres, workers are started or stopped, and routing
+    resumes on the new ring, where moved users are rehydrated from the
+    database on their next message.
+    """
+
+    def __init__(self, token, workers, base_port=8100, path="/telegram", health_interval=5.0,
+                 health_failures=3, retry_timeout=30.0, startup_grace=60.0, worker_args=None):
+        super().__init__(token)
+        self.count = workers
+        self.base_port = base_port
+        self.path = path
+        self.health_interval = health_interval
+        self.health_failures = health_failures
+        self.retry_timeout = retry_timeout
+        self.startup_grace = startup_grace
+        self.worker_args = worker_args or [sys.executable, os.path.abspath(sys.argv[0])]
+        self.secret = secrets.token_hex(16)
+        self.ring = HashRing(workers)
+        self.workers = {}
+        self._routing = asyncio.Event()
+        self._routing.set()
+        self._resize_lock = asyncio.Lock()
+        self._session = None
+        self._monitor = None
+        self.metrics = {"resizes": 0, "paused_time": 0.0}
+
+    def _url(self, worker, path):
+        return f"http://127.0.0.1:{worker.port}{path}"
+
+    async def _spawn(self, worker):
+        env = dict(os.environ, SHARD_INDEX=str(worker.index), SHARD_COUNT=str(self.count),
+                   SHARD_PORT=str(worker.port), WEBHOOK_SECRET=self.secret)
+        env.pop("WEBHOOK_URL", None)
+        worker.process = await asyncio.create_subprocess_exec(*self.worker_args, env=env)
+        worker.started = time.monotonic()
+        worker.health_failures = 0
+        logger.info(f"Started worker {worker.index} (pid {worker.process.pid}) on port {worker.port}")
+
+    async def _healthy(self, worker):
+        try:
+            async with self._session.get(self._url(worker, "/healthz"), timeout=aiohttp.ClientTimeout(total=2)) as resp:
+                return resp.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def _wait_healthy(self, worker, timeout=None):
+        deadline = time.monotonic() + (timeout or self.startup_grace)
+        while time.monotonic() < deadline:
+            if worker.process.returncode is not None:
+                return False
+            if await self._healthy(worker):
+                return True
+            await asyncio.sleep(0.2)
+        return False
+
+    async def _stop_worker(self, worker, grace=60.0):
+        if worker.process and worker.process.returncode is None:
+            worker.process.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(worker.process.wait(), grace)
+            except asyncio.TimeoutError:
+                logger.warning(f"Worker {worker.index} did not stop in {grace}s, killing it")
+                worker.process.kill()
+                await worker.process.wait()
+
+    async def _monitor_workers(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for worker in list(self.workers.values()):
+                if self.workers.get(worker.index) is not worker:
+                    continue  # removed by a resize meanwhile
+                if worker.process.returncode is not None:
+                    logger.error(f"Worker {worker.index} exited with {worker.process.returncode}, restarting")
+                elif await self._healthy(worker):
+                    worker.health_failures = 0
+                    continue
+                elif time.monotonic() - worker.started < self.startup_grace:
+                    continue  # still importing and warming up
+                else:
+                    worker.health_failures += 1
+                    if worker.health_failures < self.health_failures:
+                        continue
+                    logger.error(f"Worker {worker.index} failed {worker.health_failures} health checks, restarting")
+                    worker.process.kill()
+                    await worker.process.wait()
+                worker.metrics["restarts"] += 1
+                await self._spawn(worker)
+
+    async def start_workers(self):
+        self._session = aiohttp.ClientSession()
+        for index in range(self.count):
+            worker = self.workers[index] = Worker(index, self.base_port + index)
+            await self._spawn(worker)
+        for worker in self.workers.values():
+            if not await self._wait_healthy(worker):
+                raise RuntimeError(f"Worker {worker.index} did not become healthy")
+        self._monitor = asyncio.create_task(self._monitor_workers())
+
+    async def stop_workers(self):
+        if self._monitor:
+            self._monitor.cancel()
+        await asyncio.gather(*(self._stop_worker(w) for w in self.workers.values()))
+        if self._session:
+            await self._session.close()
+
+    async def _forward(self, worker, payload):
+        """POSTs one update to the worker, retrying while it is busy (503) or restarting."""
+        deadline = time.monotonic() + self.retry_timeout
+        delay = 0.1
+        while True:
+            try:
+                async with self._session.post(self._url(worker, self.path), json=payload,
+                                              headers={SECRET_HEADER: self.secret}) as resp:
+                    if resp.status == 200:
+                        worker.metrics["forwarded"] += 1
+                        return
+                    if resp.status != 503:
+                        worker.metrics["dropped"] += 1
+                        logger.error(f"Worker {worker.index} rejected update {payload['update_id']} with {resp.status}")
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() + delay > deadline:
+                worker.metrics["dropped"] += 1
+                logger.error(f"Dropping update {payload['update_id']}: worker {worker.index} unavailable for {self.retry_timeout}s")
+                return
+            worker.metrics["retries"] += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 2.0)
+
+    async def process_new_updates(self, updates):
+        """Forwards updates in arrival order per worker, all workers in parallel."""
+        await self._routing.wait()
+        by_worker = {}
+        for update in updates:
+            by_worker.setdefault(self.ring.shard(routing_key(update)), []).append(update_json(update))
+
+        async def forward_all(worker, payloads):
+            for payload in payloads:
+                await self._forward(worker, payload)
+
+        await asyncio.gather(*(forward_all(self.workers[i], p) for i, p in by_worker.items()))
+
+    async def _reshard(self, worker, count):
+        try:
+            async with self._session.post(self._url(worker, "/reshard"), json={"count": count},
+                                          headers={SECRET_HEADER: self.secret},
+                                          timeout=aiohttp.ClientTimeout(total=120)) as resp:
+                if resp.status != 200:
+                    logger.error(f"Worker {worker.index} failed to reshard: {resp.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Worker {worker.index} failed to reshard: {e!r}")
+
+    async def resize(self, count):
+        """Moves to count workers, migrating sessions of users whose shard changes through Postgres."""
+        if count < 1 or count == self.count:
+            return
+        async with self._resize_lock:
+            paused = time.monotonic()
+            self._routing.clear()
+            logger.info(f"Resizing from {self.count} to {count} workers")
+            try:
+                # Remaining workers drain, flush history and drop sessions they no longer own
+                await asyncio.gather(*(self._reshard(w, count) for w in self.workers.values() if w.index < count))
+                for index in [i for i in self.workers if i >= count]:
+                    await self._stop_worker(self.workers.pop(index))
+                self.count = count
+                for index in range(count):
+                    if index not in self.workers:
+                        worker = self.workers[index] = Worker(index, self.base_port + index)
+                        await self._spawn(worker)
+                        await self._wait_healthy(worker)
+                self.ring = HashRing(count)
+                self.metrics["resizes"] += 1
+            finally:
+                self.metrics["paused_time"] += time.monotonic() - paused
+                self._routing.set()
+
+    def install_resize_signals(self):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, lambda: asyncio.ensure_future(self.resize(self.count + 1)))
+        loop.add_signal_handler(signal.SIGUSR2, lambda: asyncio.ensure_future(self.resize(self.count - 1)))
+
+    def stats(self):
+        m = dict(self.metrics, workers=self.count)
+        for worker in self.workers.values():
+            for field, value in worker.metrics.items():
+                m[f"worker_{worker.index}_{field}"] = value
+            m[f"worker_{worker.index}_alive"] = worker.process is not None and worker.process.returncode is None
+        return m
+
+def add_worker_routes(server, index, session_caches, forget):
+    """Health and reshard endpoints of a worker's WebhookServer.
+
+    /reshard waits for queued updates to finish, flushes pending history and
+    usage counters and drops the sessions of users that hash to another shard on the new ring.
+    If history could not be written, the sessions are kept (their turns exist nowhere else) and it answers 503.
+    """
+    import history
+    import usage
+
+    async def healthz(request):
+        return web.json_response(server.stats())
+
+    async def reshard(request):
+        if request.headers.get(SECRET_HEADER) != server.secret:
+            return web.Response(status=403)
+        count = (await request.json())["count"]
+        await server.queue.join()
+        await usage.meter.flush()
+        if not await history.store.flush():
+            logger.error(f"Worker {index}: history not flushed, keeping sessions")
+            return web.Response(status=503)
+        ring = HashRing(count)
+        dropped = 0
+        for cache in session_caches:
+            for key in cache.keys():
+                if ring.shard(int(key)) != index:
+                    cache.pop(key)
+                    forget(key)
+                    dropped += 1
+        logger.info(f"Worker {index}: resharded to {count} workers, dropped {dropped} sessions")
+        return web.Response(text=json.dumps({"dropped": dropped}), content_type="application/json")
+
+    server.app.router.add_get("/healthz", healthz)
+    server.app.router.add_post("/reshard", reshard)
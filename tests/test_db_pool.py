@@ -0,0 +1,163 @@
+"""db.Pool against benchmarks.fakes.FakeConnection: size bounds, timeouts, health checks and prepared statements."""
+import os
+import sys
+import time
+import asyncio
+
+import psycopg2
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
+os.environ.setdefault("DATABASE_URL", "fake://test")
+
+import db
+from fakes import FakeStore, FakeConnection
+
+db.prepare("test_select", "SELECT $1")
+
+class DroppedConnection(FakeConnection):
+    """A connection the server has closed: every query fails and marks it closed."""
+
+    def cursor(self):
+        self.closed = 1
+        raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+def make_pool(store=None, connect=None, **kwargs):
+    store = store if store is not None else FakeStore()
+    return db.Pool("fake://test", connect=connect or (lambda dsn: FakeConnection(store)), **kwargs)
+
+def test_min_size_opened_at_start_and_max_size_bound():
+    async def run():
+        pool = make_pool(min_size=2, max_size=3, acquire_timeout=0.05)
+        await pool.start()
+        assert (pool.stats()["size"], pool.stats()["idle"], pool.metrics["connects"]) == (2, 2, 2)
+        held = [await pool.acquire() for _ in range(3)]
+        assert pool.stats()["size"] == 3 and pool.stats()["in_use"] == 3
+        with pytest.raises(db.PoolTimeout):
+            await pool.acquire()
+        assert pool.metrics["timeouts"] == 1
+        for conn in held:
+            await pool.release(conn)
+        assert (pool.stats()["size"], pool.stats()["idle"], pool.stats()["in_use"]) == (3, 3, 0)
+        await pool.close()
+
+    asyncio.run(run())
+
+def test_acquire_waits_for_a_release():
+    async def run():
+        pool = make_pool(min_size=1, max_size=1, acquire_timeout=1.0)
+        await pool.start()
+        conn = await pool.acquire()
+        waiter = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0.05)
+        assert not waiter.done() and pool.stats()["waiting"] == 1
+        await pool.release(conn)
+        assert await asyncio.wait_for(waiter, 1.0) is conn
+        assert pool.metrics["wait_time_max"] >= 0.04
+        await pool.release(conn)
+        await pool.close()
+
+    asyncio.run(run())
+
+def test_broken_connection_is_discarded():
+    store = FakeStore()
+    opened = []
+
+    def connect(dsn):
+        opened.append(DroppedConnection(store) if not opened else FakeConnection(store))
+        return opened[-1]
+
+    async def run():
+        pool = make_pool(connect=connect, min_size=1, max_size=2)
+        await pool.start()
+        with pytest.raises(psycopg2.OperationalError):
+            await pool.execute("SELECT 1")
+        assert pool.stats()["size"] == 0 and pool.stats()["idle"] == 0
+        assert await pool.fetchval("SELECT 1") == 1
+        assert len(opened) == 2 and pool.stats()["size"] == 1
+        await pool.close()
+
+    asyncio.run(run())
+
+def test_idle_connection_is_pinged_and_replaced_when_stale():
+    async def run():
+        pool = make_pool(min_size=1, max_size=1, health_check_after=0.02)
+        await pool.start()
+        conn = await pool.acquire()
+        await pool.release(conn)
+        # Used recently: no ping, same connection
+        assert await pool.acquire() is conn
+        await pool.release(conn)
+
+        await asyncio.sleep(0.05)
+        store = conn.raw.store
+        pings = store.statements["SELECT"]
+        assert await pool.acquire() is conn
+        assert store.statements["SELECT"] == pings + 1
+        await pool.release(conn)
+
+        await asyncio.sleep(0.05)
+        conn.raw.cursor = DroppedConnection(store).cursor
+        replacement = await pool.acquire()
+        assert replacement is not conn
+        assert pool.metrics["health_check_failures"] == 1 and conn.raw.closed
+        await pool.release(replacement)
+        await pool.close()
+
+    asyncio.run(run())
+
+def test_connection_recycled_after_max_lifetime():
+    async def run():
+        pool = make_pool(min_size=1, max_size=1, max_lifetime=0.02)
+        await pool.start()
+        conn = await pool.acquire()
+        await pool.release(conn)
+        await asyncio.sleep(0.05)
+        fresh = await pool.acquire()
+        assert fresh is not conn and conn.raw.closed
+        assert pool.metrics["recycled"] == 1 and pool.metrics["connects"] == 2
+        await pool.release(fresh)
+        await pool.close()
+
+    asyncio.run(run())
+
+def test_prepared_statements_are_prepared_once_per_connection():
+    store = FakeStore()
+
+    async def run():
+        pool = make_pool(store, min_size=1, max_size=1, max_lifetime=0.05)
+        await pool.start()
+        await pool.execute_prepared("test_select", 1)
+        await pool.execute_prepared("test_select", 2)
+        assert store.statements["PREPARE"] == 1 and store.statements["EXECUTE"] == 2
+        await asyncio.sleep(0.1)
+        # Recycled: the new connection has to PREPARE again
+        await pool.execute_prepared("test_select", 3)
+        assert pool.metrics["recycled"] == 1
+        assert store.statements["PREPARE"] == 2 and store.statements["EXECUTE"] == 3
+        await pool.close()
+
+    asyncio.run(run())
+
+def test_cancelled_query_keeps_its_connection_until_the_thread_is_done():
+    store = FakeStore(latency=0.2)
+
+    async def run():
+        pool = make_pool(store, min_size=1, max_size=1, acquire_timeout=2.0)
+        await pool.start()
+        query = asyncio.ensure_future(pool.execute("SELECT 1"))
+        await asyncio.sleep(0.05)
+        query.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await query
+        # The query is still running on its thread: nobody else may get the connection yet
+        assert pool.stats()["idle"] == 0 and pool.stats()["in_use"] == 1
+        started = time.monotonic()
+        conn = await pool.acquire()
+        assert time.monotonic() - started >= 0.1
+        assert conn.query is None
+        await pool.release(conn)
+        await pool.close()
+
+    asyncio.run(run())
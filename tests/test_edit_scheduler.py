@@ -0,0 +1,107 @@
+"""edit_scheduler.EditScheduler against a fake bot: coalescing, 429 handling, flush, final edits and pacing."""
+import os
+import sys
+import time
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot.asyncio_helper import ApiTelegramException
+from edit_scheduler import EditScheduler
+
+class FakeBot:
+    """Records edit_message_text calls; answers each with the next queued error, if any."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.edits = []  # (monotonic time, chat_id, message_id, text)
+        self.errors = []
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, parse_mode=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.edits.append((time.monotonic(), chat_id, message_id, text))
+        if self.errors:
+            raise self.errors.pop(0)
+
+def too_many_requests(retry_after):
+    return ApiTelegramException("editMessageText", None, {
+        "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}",
+        "parameters": {"retry_after": retry_after},
+    })
+
+def test_pending_edits_coalesce_to_the_latest_text():
+    async def run():
+        bot, scheduler = FakeBot(), EditScheduler(global_rate=100, chat_interval=0.0)
+        for text in ("a", "ab", "abc"):
+            scheduler.submit(bot, 1, 10, text)
+        await asyncio.sleep(0.05)
+        assert [e[3] for e in bot.edits] == ["abc"]
+        assert scheduler.metrics["coalesced"] == 2 and scheduler.metrics["sent"] == 1
+        await scheduler.stop()
+
+    asyncio.run(run())
+
+def test_429_pauses_the_chat_and_requeues_the_newest_text():
+    async def run():
+        bot, scheduler = FakeBot(), EditScheduler(global_rate=100, chat_interval=0.0)
+        bot.errors.append(too_many_requests(0.2))
+        flushed = asyncio.ensure_future(scheduler.flush(bot, 1, 10, "first"))
+        await asyncio.sleep(0.05)
+        assert len(bot.edits) == 1 and not flushed.done()
+        scheduler.submit(bot, 1, 10, "newer")
+        await asyncio.wait_for(flushed, 1.0)
+        assert [e[3] for e in bot.edits] == ["first", "newer"]
+        assert bot.edits[1][0] - bot.edits[0][0] >= 0.19
+        assert scheduler.metrics["rate_limited"] == 1 and scheduler.metrics["sent"] == 1
+        await scheduler.stop()
+
+    asyncio.run(run())
+
+def test_flush_waits_until_the_edit_is_sent():
+    async def run():
+        bot, scheduler = FakeBot(latency=0.05), EditScheduler(global_rate=100, chat_interval=0.0)
+        scheduler.submit(bot, 1, 10, "partial")
+        await scheduler.flush(bot, 1, 10, "done")
+        assert bot.edits and bot.edits[-1][3] == "done"
+        # A second waiter on the same message resolves with the newest text
+        first = asyncio.ensure_future(scheduler.flush(bot, 2, 20, "one"))
+        second = asyncio.ensure_future(scheduler.flush(bot, 2, 20, "two"))
+        await asyncio.wait_for(asyncio.gather(first, second), 1.0)
+        assert [e[3] for e in bot.edits if e[1] == 2] == ["two"]
+        await scheduler.stop()
+
+    asyncio.run(run())
+
+def test_final_edits_jump_ahead_of_intermediate_ones():
+    async def run():
+        # One token to start with and one more per second: only the first pick goes out right away
+        bot, scheduler = FakeBot(), EditScheduler(global_rate=1, chat_interval=0.0)
+        for chat_id in (1, 2, 3):
+            scheduler.submit(bot, chat_id, 10, f"partial {chat_id}")
+        scheduler.submit(bot, 4, 10, "final", final=True)
+        await asyncio.sleep(0.2)
+        assert [(e[1], e[3]) for e in bot.edits] == [(4, "final")]
+        await scheduler.stop()
+
+    asyncio.run(run())
+
+def test_private_and_group_chats_are_paced_by_their_intervals():
+    async def gap(chat_id):
+        bot, scheduler = FakeBot(), EditScheduler(global_rate=100, chat_interval=0.1, group_interval=0.3)
+        scheduler.submit(bot, chat_id, 10, "one")
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(scheduler.flush(bot, chat_id, 10, "two"), 1.0)
+        await scheduler.stop()
+        assert [e[3] for e in bot.edits] == ["one", "two"]
+        return bot.edits[1][0] - bot.edits[0][0]
+
+    assert 0.09 <= asyncio.run(gap(5)) < 0.25
+    assert asyncio.run(gap(-5)) >= 0.29
+
+def test_interval_stretches_with_active_messages():
+    scheduler = EditScheduler(global_rate=10, chat_interval=1.0, max_interval=5.0)
+    scheduler._pending = {(i, 1): None for i in range(30)}
+    assert scheduler.interval_for(1) == 3.0
+    scheduler._pending = {(i, 1): None for i in range(100)}
+    assert scheduler.interval_for(1) == 5.0
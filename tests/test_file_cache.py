@@ -0,0 +1,22 @@
+"""file_cache.TieredCache: the disk index rebuilt from the directory."""
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_cache import TieredCache
+
+def test_index_survives_restart_and_drops_interrupted_writes(tmp_path):
+    async def run():
+        cache = TieredCache("test", str(tmp_path), memory_bytes=0, disk_bytes=1024)
+        await cache.put("photo-1", b"x" * 100)
+        # A write interrupted before its rename
+        (tmp_path / "photo-2.tmp").write_bytes(b"y" * 500)
+
+        restarted = TieredCache("test", str(tmp_path), memory_bytes=0, disk_bytes=1024)
+        assert await restarted.get("photo-1") == b"x" * 100
+        assert list(restarted._disk) == ["photo-1"] and restarted._disk_size == 100
+        assert sorted(os.listdir(tmp_path)) == ["photo-1"]
+
+    asyncio.run(run())
@@ -0,0 +1,217 @@
+"""router.Router against providers.StubProvider: failover, circuit breaker, ranking and hedging."""
+import os
+import sys
+import time
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from key_pool import KeyPool
+from providers import GeminiProvider, ProviderError, StubProvider
+from router import Router
+
+class MidStreamFailure(StubProvider):
+    """Sends its first chunk, then fails."""
+
+    async def stream(self, model, turn, message, estimated_tokens=0):
+        self.calls += 1
+        await asyncio.sleep(self.first_token)
+        yield f"{self.name}:{model}:0 "
+        raise ProviderError(f"{self.name} broke mid-stream")
+
+def new_turn():
+    return SimpleNamespace(history=[], chat=None, backend=None)
+
+async def answer(router, choice, turn=None):
+    turn = turn or new_turn()
+    chunks = [text async for text in router.stream(choice, turn, "hello")]
+    return turn, chunks
+
+def pair(primary, fallback, **kwargs):
+    return Router(
+        {"primary": (primary, "model-a"), "fallback": (fallback, "model-b")},
+        routes={"primary": ["fallback"]},
+        **kwargs,
+    )
+
+def test_failover_before_first_chunk():
+    primary = StubProvider("primary", first_token=0.01, error_rate=1.0)
+    fallback = StubProvider("fallback", first_token=0.01)
+    router = pair(primary, fallback)
+    turn, chunks = asyncio.run(answer(router, "primary"))
+    assert turn.backend.name == "fallback"
+    assert chunks and all(chunk.startswith("fallback:") for chunk in chunks)
+    assert router.backends["primary"].metrics["failovers"] == 1
+    assert router.backends["primary"].metrics["errors"] == 1
+
+def test_no_failover_after_first_chunk():
+    primary = MidStreamFailure("primary", first_token=0.01)
+    fallback = StubProvider("fallback", first_token=0.01)
+    router = pair(primary, fallback)
+    received = []
+
+    async def run():
+        async for text in router.stream("primary", new_turn(), "hello"):
+            received.append(text)
+
+    with pytest.raises(ProviderError):
+        asyncio.run(run())
+    assert received == ["primary:model-a:0 "]
+    assert fallback.calls == 0
+    assert router.backends["primary"].metrics["failovers"] == 0
+    assert router.backends["primary"].metrics["errors"] == 1
+
+def test_circuit_opens_at_threshold_and_recovers_after_cooldown():
+    primary = StubProvider("primary", first_token=0.01, error_rate=1.0)
+    fallback = StubProvider("fallback", first_token=0.01)
+    router = pair(primary, fallback, error_threshold=0.5, min_samples=4, cooldown=0.2)
+    backend = router.backends["primary"]
+
+    async def run(turns):
+        for _ in range(turns):
+            await answer(router, "primary")
+
+    asyncio.run(run(3))
+    assert backend.metrics["circuit_opens"] == 0
+    assert router.candidates("primary")[0] is backend
+    asyncio.run(run(1))
+    assert backend.metrics["circuit_opens"] == 1
+    assert not backend.healthy(time.monotonic())
+    assert router.candidates("primary")[0].name == "fallback"
+
+    # While open, turns go straight to the fallback without trying the primary
+    calls = primary.calls
+    asyncio.run(run(2))
+    assert primary.calls == calls
+
+    primary.error_rate = 0.0
+    time.sleep(0.2)
+    assert router.candidates("primary")[0] is backend
+    turn, _ = asyncio.run(answer(router, "primary"))
+    assert turn.backend is backend
+    assert not backend.probing
+
+def test_failed_probe_reopens_circuit():
+    primary = StubProvider("primary", first_token=0.01, error_rate=1.0)
+    fallback = StubProvider("fallback", first_token=0.01)
+    router = pair(primary, fallback, error_threshold=0.5, min_samples=2, cooldown=0.1)
+    asyncio.run(answer(router, "primary"))
+    asyncio.run(answer(router, "primary"))
+    assert router.backends["primary"].metrics["circuit_opens"] == 1
+    time.sleep(0.1)
+    # One failure is enough while probing
+    asyncio.run(answer(router, "primary"))
+    assert router.backends["primary"].metrics["circuit_opens"] == 2
+
+@pytest.mark.parametrize("primary_ttft, fallback_ttft, penalty, expected", [
+    (0.3, 0.2, 1.0, "primary"),   # fallback scores 0.2 * 2 = 0.4
+    (0.5, 0.2, 1.0, "fallback"),  # clearly faster fallback takes over
+    (0.3, 0.2, 0.0, "fallback"),  # no penalty: plain fastest median
+    (0.3, 0.2, 0.6, "primary"),   # 0.2 * 1.6 = 0.32 loses to 0.3
+])
+def test_fallback_ranking(primary_ttft, fallback_ttft, penalty, expected):
+    router = pair(StubProvider("primary"), StubProvider("fallback"), fallback_penalty=penalty)
+    router.backends["primary"].ttfts.append(primary_ttft)
+    router.backends["fallback"].ttfts.append(fallback_ttft)
+    assert router.candidates("primary")[0].name == expected
+
+def test_untried_fallback_ranks_behind_known_primary():
+    router = pair(StubProvider("primary"), StubProvider("fallback"))
+    router.backends["primary"].ttfts.append(1.0)
+    assert [b.name for b in router.candidates("primary")] == ["primary", "fallback"]
+
+def hedged(primary_first_token, hedge_first_token, **kwargs):
+    primary = StubProvider("primary", first_token=primary_first_token)
+    spare = StubProvider("spare", first_token=hedge_first_token)
+    router = Router(
+        {"primary": (primary, "model-a"), "spare": (spare, "model-b")},
+        hedge=True, hedge_model="spare", hedge_default_delay=0.02, **kwargs,
+    )
+    return router, primary, spare
+
+def test_hedge_win():
+    router, primary, spare = hedged(0.5, 0.01, hedge_max_rate=1.0)
+    turn, chunks = asyncio.run(answer(router, "primary"))
+    assert turn.backend.name == "spare"
+    assert all(chunk.startswith("spare:") for chunk in chunks)
+    stats = router.hedge_stats()
+    assert (stats["hedges"], stats["hedge_wins"], stats["hedge_losses"]) == (1, 1, 0)
+
+def test_hedge_loss():
+    router, primary, spare = hedged(0.05, 0.5, hedge_max_rate=1.0)
+    turn, chunks = asyncio.run(answer(router, "primary"))
+    assert turn.backend.name == "primary"
+    assert all(chunk.startswith("primary:") for chunk in chunks)
+    stats = router.hedge_stats()
+    assert (stats["hedges"], stats["hedge_wins"], stats["hedge_losses"]) == (1, 0, 1)
+
+def test_no_hedge_when_first_chunk_is_on_time():
+    router, primary, spare = hedged(0.005, 0.005, hedge_max_rate=1.0)
+    asyncio.run(answer(router, "primary"))
+    assert router.hedge_stats()["hedges"] == 0
+    assert spare.calls == 0
+
+def test_hedge_max_rate_caps_hedged_turns():
+    # min_samples above the turn count keeps every turn on hedge_default_delay
+    router, primary, spare = hedged(0.05, 0.01, hedge_max_rate=0.25, min_samples=100)
+
+    async def run():
+        for _ in range(8):
+            await answer(router, "primary")
+
+    asyncio.run(run())
+    stats = router.hedge_stats()
+    assert stats["turns"] == 8
+    assert stats["hedges"] == 2
+    assert stats["over_budget"] == 6
+    assert stats["hedge_rate"] <= 0.25
+    assert spare.calls == stats["hedges"]
+
+class KeyedClient:
+    """Stands in for a genai client: streams "<api_key> " after the key's first-chunk latency."""
+
+    def __init__(self, api_key, latency):
+        self.api_key = api_key
+        self.latency = latency
+
+    async def send_message_stream(self, message):
+        await asyncio.sleep(self.latency)
+
+        async def chunks():
+            yield SimpleNamespace(text=f"{self.api_key} ", usage_metadata=None)
+
+        return chunks()
+
+class KeyedTurn(SimpleNamespace):
+    def fork(self, client, model):
+        return client
+
+def test_hedge_on_the_same_backend_goes_to_another_key():
+    latency = {"key-slow": 0.5, "key-fast": 0.01}
+    pool = KeyPool(["key-slow", "key-fast"], client_factory=lambda api_key: KeyedClient(api_key, latency[api_key]))
+    # key-fast has less headroom, so only the exclusion keeps the hedge off key-slow
+    pool.keys[1].requests.extend([time.monotonic()] * 5)
+    router = Router({"primary": (GeminiProvider(pool), "model-a")}, hedge=True, hedge_default_delay=0.02, hedge_max_rate=1.0)
+    turn = KeyedTurn(history=[], chat=None, backend=None, keys=[], lost=False)
+    _, chunks = asyncio.run(answer(router, "primary", turn))
+    assert chunks == ["key-fast "]
+    assert [key.api_key for key in turn.keys] == ["key-slow", "key-fast"]
+    assert router.hedge_stats()["hedge_wins"] == 1
+
+def test_losing_hedge_counts_tokens_but_no_request():
+    latency = {"key-slow": 0.5, "key-fast": 0.01}
+    recorded = []
+    pool = KeyPool(["key-slow", "key-fast"], client_factory=lambda api_key: KeyedClient(api_key, latency[api_key]),
+                   on_usage=lambda model, usage_metadata, estimated_tokens, requests: recorded.append(requests))
+    router = Router({"primary": (GeminiProvider(pool), "model-a")}, hedge=True, hedge_default_delay=0.02, hedge_max_rate=1.0)
+
+    async def run():
+        await answer(router, "primary", KeyedTurn(history=[], chat=None, backend=None, keys=[], lost=False))
+        await asyncio.sleep(0.05)  # losers are discarded in the background
+
+    asyncio.run(run())
+    # Both calls are metered (the cancelled one with its estimated prompt tokens); only the winner is a request
+    assert sorted(recorded) == [0, 1]
@@ -0,0 +1,141 @@
+"""webhook.WebhookServer with synthetic updates: secret check, backpressure, graceful shutdown and the shard worker routes."""
+import os
+import sys
+import time
+import asyncio
+
+import aiohttp
+from aiohttp.test_utils import make_mocked_request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "fake://test")
+
+import db
+import history
+from session_cache import SessionCache
+from shards import add_worker_routes
+from webhook import SECRET_HEADER, WebhookServer
+
+SECRET = "test-secret"
+
+class FakeBot:
+    """Handles each update in `delay` seconds, or once `gate` is set."""
+
+    def __init__(self, delay=0.0, gate=None):
+        self.delay = delay
+        self.gate = gate
+        self.processed = []
+
+    async def process_new_updates(self, updates):
+        if self.gate is not None:
+            await self.gate.wait()
+        await asyncio.sleep(self.delay)
+        self.processed.extend(u.update_id for u in updates)
+
+async def started(bot, **kwargs):
+    server = WebhookServer(bot, SECRET, host="127.0.0.1", port=0, **kwargs)
+    await server.start()
+    host, port = server._runner.addresses[0][:2]
+    return server, f"http://{host}:{port}{server.path}"
+
+async def post(session, url, update_id, secret=SECRET):
+    headers = {SECRET_HEADER: secret} if secret is not None else {}
+    async with session.post(url, json={"update_id": update_id}, headers=headers) as response:
+        return response.status
+
+def test_wrong_or_missing_secret_is_rejected():
+    async def run():
+        bot = FakeBot()
+        server, url = await started(bot, workers=1)
+        async with aiohttp.ClientSession() as session:
+            assert await post(session, url, 1, secret="wrong") == 403
+            assert await post(session, url, 2, secret=None) == 403
+            assert await post(session, url, 3) == 200
+        await server.stop()
+        assert bot.processed == [3]
+        assert server.metrics["rejected_secret"] == 2
+
+    asyncio.run(run())
+
+def test_non_ascii_secret_is_a_403_not_a_500():
+    async def run():
+        server = WebhookServer(FakeBot(), SECRET)
+        request = make_mocked_request("POST", server.path, headers={SECRET_HEADER: "sécret-✓"})
+        response = await server.handle(request)
+        assert response.status == 403
+
+    asyncio.run(run())
+
+def test_full_queue_answers_503():
+    async def run():
+        gate = asyncio.Event()
+        bot = FakeBot(gate=gate)
+        server, url = await started(bot, workers=1, queue_size=1)
+        async with aiohttp.ClientSession() as session:
+            assert await post(session, url, 1) == 200  # taken by the worker, blocked on the gate
+            await asyncio.sleep(0.05)
+            assert await post(session, url, 2) == 200  # waits in the queue
+            assert await post(session, url, 3) == 503
+        gate.set()
+        await server.stop()
+        assert bot.processed == [1, 2]
+        assert server.metrics["rejected_full"] == 1
+
+    asyncio.run(run())
+
+def test_stop_drains_queued_and_in_flight_updates():
+    async def run():
+        bot = FakeBot(delay=0.2)
+        server, url = await started(bot, workers=2, shutdown_grace=5.0)
+        async with aiohttp.ClientSession() as session:
+            for update_id in range(1, 5):
+                assert await post(session, url, update_id) == 200
+        await server.stop()
+        assert sorted(bot.processed) == [1, 2, 3, 4]
+        assert server.metrics["processed"] == 4
+
+    asyncio.run(run())
+
+def test_stop_gives_up_after_shutdown_grace():
+    async def run():
+        bot = FakeBot(delay=5.0)
+        server, url = await started(bot, workers=1, shutdown_grace=0.2)
+        async with aiohttp.ClientSession() as session:
+            assert await post(session, url, 1) == 200
+        begun = time.monotonic()
+        await server.stop()
+        assert time.monotonic() - begun < 1.0
+        assert bot.processed == []
+
+    asyncio.run(run())
+
+def test_reshard_keeps_sessions_when_history_is_not_flushed(monkeypatch):
+    async def failing_execute(query, *args):
+        raise ConnectionError("database is down")
+
+    async def run():
+        server = WebhookServer(FakeBot(), SECRET, host="127.0.0.1", port=0)
+        sessions, forgotten = SessionCache("test"), []
+        for user_id in range(20):
+            sessions[str(user_id)] = object()
+        add_worker_routes(server, 0, [sessions], forgotten.append)
+        await server.start()
+        host, port = server._runner.addresses[0][:2]
+        url = f"http://{host}:{port}/reshard"
+        history.store._pending.append(("1", "chat", "{}"))
+        async with aiohttp.ClientSession() as session:
+            monkeypatch.setattr(db, "execute", failing_execute)
+            async with session.post(url, json={"count": 2}, headers={SECRET_HEADER: SECRET}) as response:
+                assert response.status == 503
+            assert len(sessions) == 20 and forgotten == []
+
+            monkeypatch.undo()
+            monkeypatch.setattr(db, "execute", lambda query, *args: asyncio.sleep(0))
+            async with session.post(url, json={"count": 2}, headers={SECRET_HEADER: SECRET}) as response:
+                assert response.status == 200
+                dropped = (await response.json())["dropped"]
+            assert 0 < dropped < 20 and len(sessions) == 20 - dropped and len(forgotten) == dropped
+            assert not history.store._pending
+        await server.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import contextvars
+import datetime
+from config import conf
+from session_cache import SessionCache
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_daily (
+    user_id         TEXT NOT NULL,
+    day             DATE NOT NULL,
+    model           TEXT NOT NULL,
+    requests        BIGINT NOT NULL DEFAULT 0,
+    prompt_tokens   BIGINT NOT NULL DEFAULT 0,
+    response_tokens BIGINT NOT NULL DEFAULT 0,
+    images          BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, day, model)
+);
+CREATE INDEX IF NOT EXISTS usage_daily_day_idx ON usage_daily (day);
+"""
+
+db.prepare("usage_today", "SELECT coalesce(sum(requests), 0), coalesce(sum(prompt_tokens + response_tokens), 0), "
+                          "coalesce(sum(images), 0) FROM usage_daily WHERE user_id = $1 AND day = $2")
+db.prepare("usage_by_user", "SELECT user_id, sum(requests), sum(prompt_tokens), sum(response_tokens), sum(images) "
+                            "FROM usage_daily WHERE day = $1 GROUP BY user_id "
+                            "ORDER BY sum(prompt_tokens + response_tokens) DESC LIMIT $2")
+db.prepare("usage_by_model", "SELECT model, count(DISTINCT user_id), sum(requests), sum(prompt_tokens), "
+                             "sum(response_tokens), sum(images) FROM usage_daily WHERE day = $1 GROUP BY model ORDER BY model")
+
+COUNTERS = ("requests", "prompt_tokens", "response_tokens", "images")
+
+# Set per update by handlers.admitted, so model calls deep in gemini.py know whose quota they spend
+user_var = contextvars.ContextVar("usage_user", default=None)
+
+def today():
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+class UsageMeter:
+    """Per-user, per-model daily usage with write-behind counters.
+
+    record() only adds to in-memory counters keyed by (user, day, model); a
+    background task upserts them into usage_daily every flush_interval in one
+    multi-row INSERT ... ON CONFLICT, so no model call waits on the database.
+    Today's totals per user are cached (loaded once from Postgres, then kept
+    up to date by record()), which is what quota checks read.
+    """
+
+    def __init__(self, flush_interval=10.0, max_batch=500, max_users=5000):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = {}  # (user_id, day, model) -> [requests, prompt_tokens, response_tokens, images]
+        self.today = SessionCache("usage_today", max_entries=max_users)  # user_id -> (day, {requests, tokens, images})
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.metrics = {"records": 0, "rows_written": 0, "flushes": 0, "flush_errors": 0, "quota_loads": 0, "quota_rejections": 0}
+
+    async def start(self):
+        await db.execute(SCHEMA)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        await self.flush()
+
+    def record(self, model, prompt_tokens=0, response_tokens=0, images=0, requests=1, user_id=None):
+        """Counts one model call (or extra images) against the current update's user; never blocks."""
+        user_id = user_id or user_var.get()
+        if user_id is None or not model or not (requests or prompt_tokens or response_tokens or images):
+            return
+        day = today()
+        counters = self._pending.setdefault((user_id, day, model), [0, 0, 0, 0])
+        for i, n in enumerate((requests, prompt_tokens, response_tokens, images)):
+            counters[i] += n
+        self.metrics["records"] += 1
+        cached = self.today.get(user_id)
+        if cached is not None and cached[0] == day:
+            totals = cached[1]
+            totals["requests"] += requests
+            totals["tokens"] += prompt_tokens + response_tokens
+            totals["images"] += images
+
+    def record_response(self, model, usage_metadata, estimated_tokens=0, requests=1):
+        """Counts a Gemini call from the usage_metadata of its (last) response chunk.
+
+        A call cancelled before any usage came back counts with its estimated prompt tokens.
+        A losing hedge passes requests=0: its tokens cost the same, but it isn't another user request.
+        """
+        prompt = getattr(usage_metadata, "prompt_token_count", None) or estimated_tokens
+        total = getattr(usage_metadata, "total_token_count", None) or prompt
+        self.record(model, prompt_tokens=prompt, response_tokens=max(total - prompt, 0), requests=requests)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            rows = list(pending.items())
+            for start in range(0, len(rows), self.max_batch):
+                batch = rows[start:start + self.max_batch]
+                values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(batch))
+                args = [v for key, counters in batch for v in (*key, *counters)]
+                try:
+                    await db.execute(
+                        f"INSERT INTO usage_daily (user_id, day, model, {', '.join(COUNTERS)}) VALUES {values} "
+                        "ON CONFLICT (user_id, day, model) DO UPDATE SET "
+                        + ", ".join(f"{c} = usage_daily.{c} + EXCLUDED.{c}" for c in COUNTERS),
+                        *args,
+                    )
+                except Exception as e:
+                    # Merge the unwritten counters back and retry on the next tick
+                    for key, counters in rows[start:]:
+                        merged = self._pending.setdefault(key, [0, 0, 0, 0])
+                        for i, n in enumerate(counters):
+                            merged[i] += n
+                    self.metrics["flush_errors"] += 1
+                    logger.error(f"Usage flush of {len(rows) - start} rows failed: {e}")
+                    return
+                self.metrics["rows_written"] += len(batch)
+                self.metrics["flushes"] += 1
+
+    async def totals(self, user_id):
+        """Today's requests, tokens and images of user_id, from the cache or loaded once from Postgres."""
+        day = today()
+        cached = self.today.get(user_id)
+        if cached is not None and cached[0] == day:
+            return cached[1]
+        self.metrics["quota_loads"] += 1
+        rows = await db.execute_prepared("usage_today", user_id, day, fetch=True)
+        requests, tokens, images = rows[0] if rows else (0, 0, 0)
+        totals = {"requests": int(requests), "tokens": int(tokens), "images": int(images)}
+        # Counters not flushed yet aren't in the table
+        for (u, d, _), counters in self._pending.items():
+            if u == user_id and d == day:
+                totals["requests"] += counters[0]
+                totals["tokens"] += counters[1] + counters[2]
+                totals["images"] += counters[3]
+        self.today[user_id] = (day, totals)
+        return totals
+
+    async def exceeded(self, user_id, images=False):
+        """Name of the daily quota user_id has used up, or None. images: the request generates images."""
+        limits = {
+            "requests": conf["quota_daily_requests"],
+            "tokens": conf["quota_daily_tokens"],
+            "images": conf["quota_daily_images"] if images else None,
+        }
+        if all(limit is None for limit in limits.values()):
+            return None
+        totals = await self.totals(user_id)
+        for name, limit in limits.items():
+            if limit is not None and totals[name] >= limit:
+                self.metrics["quota_rejections"] += 1
+                return name
+        return None
+
+    async def report(self, day=None, limit=10):
+        """Plain-text usage summary of one day: totals per model and the heaviest users."""
+        day = day or today()
+        await self.flush()
+        by_model = await db.execute_prepared("usage_by_model", day, fetch=True) or []
+        by_user = await db.execute_prepared("usage_by_user", day, limit, fetch=True) or []
+        lines = [f"Usage on {day.isoformat()} (UTC)", "", "Per model: users / requests / prompt + response tokens / images"]
+        for model, users, requests, prompt, response, images in by_model:
+            lines.append(f"{model}: {users} / {requests} / {prompt} + {response} / {images}")
+        if not by_model:
+            lines.append("no usage recorded")
+        lines += ["", f"Top {limit} users by tokens: requests / prompt + response tokens / images"]
+        for user_id, requests, prompt, response, images in by_user:
+            lines.append(f"{user_id}: {requests} / {prompt} + {response} / {images}")
+        return "\n".join(lines)
+
+    def stats(self):
+        return dict(self.metrics, pending=len(self._pending), cached_users=len(self.today))
+
+meter = UsageMeter(
+    flush_interval=conf["usage_flush_interval"],
+    max_batch=conf["usage_max_batch"],
+    max_users=conf["session_max_entries"],
+)
+
+metrics.stats_gauge("usage", "Usage metering write-behind state and quota checks", meter.stats)
@@ -0,0 +1,114 @@
+import hmac
+import json
+import signal
+import asyncio
+import logging
+from aiohttp import web
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class WebhookServer:
+    """Receives Telegram updates over HTTPS instead of long polling.
+
+    Verified updates go into a bounded queue served by a fixed number of
+    worker tasks, each handing one update at a time to the bot's registered
+    handlers. When the queue is full the request gets a 503 and Telegram
+    redelivers it later. On shutdown the listener closes first, then queued
+    and in-flight updates are drained before the workers stop.
+
+    With an empty url no webhook is registered with Telegram, so the server
+    can be exercised locally by POSTing update JSON to the path.
+    """
+
+    def __init__(self, bot, secret, url="", host="0.0.0.0", port=8080, path="/telegram",
+                 queue_size=1000, workers=64, shutdown_grace=30.0):
+        self.bot = bot
+        self.secret = secret
+        self.url = url
+        self.host = host
+        self.port = port
+        self.path = path
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.workers = workers
+        self.shutdown_grace = shutdown_grace
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle)
+        self._runner = None
+        self._tasks = []
+        self._stopping = asyncio.Event()
+        self.metrics = {"received": 0, "rejected_secret": 0, "rejected_full": 0, "bad_request": 0, "processed": 0, "errors": 0}
+
+    async def handle(self, request):
+        # Compared as bytes: compare_digest raises TypeError on non-ASCII str
+        token = request.headers.get(SECRET_HEADER, "").encode(errors="replace")
+        if not hmac.compare_digest(token, self.secret.encode()):
+            self.metrics["rejected_secret"] += 1
+            return web.Response(status=403)
+        if self._stopping.is_set():
+            return web.Response(status=503)
+        try:
+            update = types.Update.de_json(await request.json())
+        except (ValueError, KeyError, TypeError, json.JSONDecodeError) as e:
+            self.metrics["bad_request"] += 1
+            logger.warning(f"Malformed webhook update: {e}")
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.metrics["rejected_full"] += 1
+            return web.Response(status=503)
+        self.metrics["received"] += 1
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.bot.process_new_updates([update])
+                self.metrics["processed"] += 1
+            except Exception as e:
+                self.metrics["errors"] += 1
+                logger.error(f"Error processing update {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        if self.url:
+            await self.bot.set_webhook(url=self.url + self.path, secret_token=self.secret)
+            logger.info(f"Webhook registered at {self.url}{self.path}")
+        logger.info(f"Webhook server listening on {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        """Stops accepting updates, drains the queue and in-flight handlers, then stops the workers."""
+        self._stopping.set()
+        if self._runner:
+            await self._runner.shutdown()
+        try:
+            await asyncio.wait_for(self.queue.join(), self.shutdown_grace)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shutdown grace period over, {self.queue.qsize()} updates left unprocessed")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def run(self):
+        """Serves until SIGINT/SIGTERM, then shuts down gracefully."""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stopping.set)
+        await self.start()
+        await self._stopping.wait()
+        logger.info("Shutting down webhook server...")
+        await self.stop()
+
+    def stats(self):
+        return dict(self.metrics, queue_depth=self.queue.qsize())